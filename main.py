@@ -2,12 +2,30 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 from tkinter import simpledialog
+from tkinter import filedialog
+import argparse
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import datetime
+import functools
+import itertools
+import json
 import os
 import io
+import shutil
+import socket
+import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
 import pandas as pd
-from tksheet import Sheet
+from tksheet import Sheet, float_formatter
 
 def get_base_path():
     """Get the base path for data files - works for both script and executable"""
@@ -59,6 +77,2568 @@ NUTRIENT_FIELDS = [
     ("Omega-6 Fatty Acids", "g")
 ]
 
+# Unit scales relative to the base unit of each dimension (g for mass, kcal for energy)
+UNIT_SCALES = {
+    "kg": ("mass", 1000.0),
+    "g": ("mass", 1.0),
+    "mg": ("mass", 1e-3),
+    "µg": ("mass", 1e-6),
+    "μg": ("mass", 1e-6),
+    "ug": ("mass", 1e-6),
+    "mcg": ("mass", 1e-6),
+    "kcal": ("energy", 1.0),
+    "kj": ("energy", 1 / 4.184),
+}
+
+# Header names accepted as the food name column when importing external tables
+NAME_ALIASES = ("name", "food", "food name", "description", "food description")
+
+# Header names accepted as the serving size (in grams) column when importing
+SERVING_ALIASES = ("serving", "serving size", "serving weight", "portion")
+
+# Other header names accepted for schema nutrients when importing, matched without their unit
+NUTRIENT_ALIASES = {
+    "energy": "Calories / Energy", "calories": "Calories / Energy", "energy value": "Calories / Energy",
+    "fat": "Total Fat", "total lipid (fat)": "Total Fat", "lipids": "Total Fat",
+    "saturated fatty acids": "Saturated Fat", "fatty acids, total saturated": "Saturated Fat",
+    "monounsaturated fatty acids": "Monounsaturated Fat", "fatty acids, total monounsaturated": "Monounsaturated Fat",
+    "polyunsaturated fatty acids": "Polyunsaturated Fat", "fatty acids, total polyunsaturated": "Polyunsaturated Fat",
+    "trans fatty acids": "Trans Fat", "fatty acids, total trans": "Trans Fat",
+    "carbohydrate": "Carbohydrates", "carbohydrate, by difference": "Carbohydrates",
+    "fiber": "Dietary Fiber", "fibre": "Dietary Fiber", "dietary fibre": "Dietary Fiber",
+    "fiber, total dietary": "Dietary Fiber",
+    "sugars": "Total Sugars", "sugar": "Total Sugars", "sugars, total": "Total Sugars", "added sugar": "Added Sugars",
+    "vitamin b1": "Vitamin B1 (Thiamine)", "thiamin": "Vitamin B1 (Thiamine)", "thiamine": "Vitamin B1 (Thiamine)",
+    "vitamin b2": "Vitamin B2 (Riboflavin)", "riboflavin": "Vitamin B2 (Riboflavin)",
+    "vitamin b3": "Vitamin B3 (Niacin)", "niacin": "Vitamin B3 (Niacin)",
+    "vitamin b-6": "Vitamin B6", "vitamin b9": "Vitamin B9 (Folate)", "folate": "Vitamin B9 (Folate)",
+    "folate, total": "Vitamin B9 (Folate)", "vitamin b-12": "Vitamin B12",
+    "vitamin c, total ascorbic acid": "Vitamin C", "vitamin a, rae": "Vitamin A",
+    "omega-3": "Omega-3 Fatty Acids", "omega 3 fatty acids": "Omega-3 Fatty Acids",
+    "omega-6": "Omega-6 Fatty Acids", "omega 6 fatty acids": "Omega-6 Fatty Acids",
+}
+
+
+def split_header_unit(header):
+    """Split a header like 'Protein (g)' into ('Protein', 'g'); unknown suffixes are kept in the name."""
+    header = header.strip()
+    if header.endswith(")") and " (" in header:
+        name, unit = header[:-1].rsplit(" (", 1)
+        if unit.strip().lower() in UNIT_SCALES:
+            return name.strip(), unit.strip()
+    return header, ""
+
+
+def unit_factor(from_unit, to_unit):
+    """Return the multiplier converting a value in from_unit into to_unit (1.0 if either is unknown)."""
+    source = UNIT_SCALES.get((from_unit or "").lower())
+    target = UNIT_SCALES.get((to_unit or "").lower())
+    if not source or not target:
+        return 1.0
+    if source[0] != target[0]:
+        raise ValueError(f"Cannot convert {from_unit} to {to_unit}")
+    return source[1] / target[1]
+
+
+@functools.lru_cache(maxsize=None)
+def load_units():
+    """Load nutrient units from data/units.csv, falling back to NUTRIENT_FIELDS for missing entries.
+
+    Parsed once per process; callers must treat the returned dict as read-only.
+    """
+    units = {name: unit for name, unit in NUTRIENT_FIELDS}
+    units_path = os.path.join(get_base_path(), "data", "units.csv")
+    try:
+        with open(units_path, mode='r', newline='', encoding='utf-8') as file:
+            rows = list(csv.reader(file))
+        if len(rows) >= 2:
+            for name, unit in zip(rows[0], rows[1]):
+                if unit.strip():
+                    units[name.strip()] = unit.strip()
+    except Exception as e:
+        print(f"Warning: Could not load units: {e}")
+    return units
+
+
+# Bump when nutrients are added to NUTRIENT_FIELDS. Files resolve their headers
+# by name, so older files simply leave the new slots blank, and SQLiteStore
+# adds the missing columns when it opens a database written under an older version.
+SCHEMA_VERSION = 1
+
+
+class NutrientSchema:
+    """Canonical nutrient registry: a stable slot, unit, display name and mode per nutrient.
+
+    Slots follow NUTRIENT_FIELDS (without Name and Amount); units come from
+    data/units.csv and modes from data/nutrient_modes.csv. resolve() maps a
+    header tuple to slots once per distinct header set, so vectors kept in slot
+    order line up with any plan or food file without per-row string matching.
+    """
+
+    def __init__(self, fields, units, modes, version=SCHEMA_VERSION):
+        self.version = version
+        self.names = tuple(name for name, _ in fields if name not in ('Name', 'Amount'))
+        self.slot = {name: idx for idx, name in enumerate(self.names)}
+        self.unit_of = {**dict(fields), **units}
+        self.units = tuple(self.unit_of[name] for name in self.names)
+        self.display_names = tuple(f"{name} ({unit})" if unit else name for name, unit in zip(self.names, self.units))
+        self.modes = tuple(modes.get(name, 'irrelevant') for name in self.names)
+        self.fields = (('Name', ''), ('Amount', self.unit_of['Amount'])) + tuple(zip(self.names, self.units))
+        self.food_fields = tuple(name for name, _ in self.fields)
+        self._resolved = {}
+
+    def resolve(self, headers):
+        """(column indexes, slots) of the schema nutrients in a header tuple, matched by name without unit."""
+        resolved = self._resolved.get(headers)
+        if resolved is None:
+            pairs = [(idx, self.slot[name]) for idx, name in
+                     enumerate(split_header_unit(str(header))[0] for header in headers) if name in self.slot]
+            resolved = (np.array([idx for idx, _ in pairs], dtype=int), np.array([slot for _, slot in pairs], dtype=int))
+            self._resolved[headers] = resolved
+        return resolved
+
+    def food_vectors(self, food_items):
+        """(foods x slots) per-serving matrix of food store dicts; blank or invalid cells are 0."""
+        if not food_items:
+            return np.zeros((0, len(self.names)))
+        frame = pd.DataFrame.from_records(food_items, columns=list(self.names))
+        return np.nan_to_num(numeric_matrix(frame, list(self.names)))
+
+
+@functools.lru_cache(maxsize=None)
+def nutrient_schema():
+    """The process-wide NutrientSchema, read from the data files on first use."""
+    modes = {}
+    try:
+        modes_df = pd.read_csv(os.path.join(get_base_path(), "data", "nutrient_modes.csv"))
+        if len(modes_df):
+            modes = dict(zip(modes_df.columns, modes_df.iloc[0]))
+    except Exception as e:
+        print(f"Warning: Could not load nutrient modes: {e}")
+    units = load_units()
+    known = {name for name, _ in NUTRIENT_FIELDS}
+    unknown = sorted((set(modes) | set(units)) - known)
+    if unknown:
+        print(f"Warning: Ignoring nutrients missing from the schema: {', '.join(unknown)}")
+    return NutrientSchema(NUTRIENT_FIELDS, {name: unit for name, unit in units.items() if name in known},
+                          {name: mode for name, mode in modes.items() if name in known})
+
+
+@functools.lru_cache(maxsize=256)
+def conversion_factors(headers, declared_units=None):
+    """Precompute canonical headers and a per-column factor vector for a tuple of headers.
+
+    Units come from a header suffix ("Sodium (g)") or from declared_units, a tuple
+    aligned with headers such as the units row of the food store. Columns without
+    a known unit, plus Name and Amount, keep a factor of 1. Returns a tuple of
+    canonical headers and a read-only numpy array of factors.
+    """
+    units = load_units()
+    canonical = []
+    factors = np.ones(len(headers))
+    for i, header in enumerate(headers):
+        name, unit = split_header_unit(header)
+        if declared_units and i < len(declared_units) and declared_units[i]:
+            unit = declared_units[i]
+        target = units.get(name)
+        if name in ('Name', 'Amount') or not target:
+            canonical.append(header)
+            continue
+        factors[i] = unit_factor(unit, target)
+        canonical.append(f"{name} ({target})" if header.strip() != name else name)
+    factors.flags.writeable = False
+    return tuple(canonical), factors
+
+
+def normalize_units(df, declared_units=None):
+    """Convert a plan or food DataFrame to canonical units with one vectorized multiply."""
+    headers, factors = conversion_factors(tuple(df.columns), declared_units)
+    convert = np.flatnonzero(factors != 1.0)
+    if len(convert):
+        df = df.copy()
+        block = df.iloc[:, convert].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float) * factors[convert]
+        for j, col_idx in enumerate(convert):
+            df.isetitem(int(col_idx), block[:, j])
+    df.columns = list(headers)
+    return df
+
+
+def is_units_row(values, name_idx=0):
+    """Return True for a units row (blank name, every other cell blank or a known unit)."""
+    if not values or (name_idx < len(values) and str(values[name_idx]).strip()):
+        return False
+    cells = [str(v).strip().lower() for i, v in enumerate(values) if i != name_idx]
+    return any(cells) and all(not cell or cell in UNIT_SCALES for cell in cells)
+
+
+def detect_delimiter(source, source_path):
+    """Guess an import table's delimiter from its extension or its first 64 KiB, leaving source at the start."""
+    if os.path.splitext(source_path)[1].lower() in (".tsv", ".tab"):
+        return "\t"
+    try:
+        delimiter = csv.Sniffer().sniff(source.read(64 * 1024), delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = ","
+    source.seek(0)
+    return delimiter
+
+
+def unit_family_matches(unit, field):
+    """Whether a value in unit can be converted to the food store unit of field (True when either is unknown)."""
+    source = UNIT_SCALES.get((unit or "").lower())
+    target = UNIT_SCALES.get(nutrient_schema().unit_of.get(field, "").lower())
+    return not source or not target or source[0] == target[0]
+
+
+def resolve_import_columns(header, column_map=None, serving_column=None):
+    """Match an import table's header row onto the food store fields.
+
+    Columns match by column_map, then by field name or NUTRIENT_ALIASES without
+    their unit suffix; a column whose unit cannot convert to its field's unit
+    (say grams for energy) or whose field is already taken does not match.
+    Returns (name index, serving index, [(source index, field name, header
+    unit)], headers of the columns that were not matched).
+    """
+    column_map = column_map or {}
+    fieldnames = nutrient_schema().food_fields
+    field_lookup = {name.casefold(): name for name in fieldnames}
+    name_idx = None
+    serving_idx = None
+    nutrient_columns = []
+    ignored = []
+    for idx, raw_header in enumerate(header):
+        base_name, unit = split_header_unit(raw_header)
+        if serving_column is not None:
+            is_serving = serving_column in (raw_header.strip(), base_name)
+        else:
+            is_serving = base_name.casefold() in SERVING_ALIASES
+        if is_serving and serving_idx is None:
+            serving_idx = idx
+            continue
+
+        target = column_map.get(raw_header.strip(), column_map.get(base_name))
+        if target is None:
+            if base_name.casefold() in NAME_ALIASES:
+                target = "Name"
+            else:
+                target = field_lookup.get(base_name.casefold(), NUTRIENT_ALIASES.get(base_name.casefold()))
+        if target == "Name" and name_idx is None:
+            name_idx = idx
+        elif (target and target not in ("Name", "Amount") and target in fieldnames
+              and unit_family_matches(unit, target) and all(target != taken for _, taken, _ in nutrient_columns)):
+            nutrient_columns.append((idx, target, unit))
+        else:
+            ignored.append(raw_header.strip())
+    return name_idx, serving_idx, nutrient_columns, ignored
+
+
+def import_food_table(source_path, store, column_map=None, delimiter=None,
+                      basis_amount=100.0, serving_column=None, batch_size=1000,
+                      progress_callback=None):
+    """Stream an external CSV/TSV food composition table into the food store.
+
+    Source columns are matched onto NUTRIENT_FIELDS by resolve_import_columns,
+    and units given in header suffixes such as "Sodium (g)" or "Energy (kJ)"
+    or in a units row under the header are converted to the food store units.
+    Values given per basis_amount grams are rescaled to one serving when a
+    serving column exists and Amount is that serving in grams; otherwise the
+    values stay per basis_amount grams and Amount is basis_amount. Names
+    already in the store or earlier in the file are skipped. Rows are converted
+    and appended in batches of batch_size, so memory only grows with the set of
+    names. store is the food store CSV path or a SQLiteStore.
+
+    Returns a dict with 'read', 'imported', 'duplicates' and 'skipped' counts
+    and 'ignored', the headers of the source columns that were not imported.
+    """
+    fieldnames = list(nutrient_schema().food_fields)
+
+    with open(source_path, mode='r', newline='', encoding='utf-8-sig') as source:
+        if delimiter is None:
+            delimiter = detect_delimiter(source, source_path)
+        reader = csv.reader(source, delimiter=delimiter)
+        header = next(reader, None)
+        if not header:
+            raise ValueError("The source file is empty")
+
+        # Resolve every source column once so the row loop only does index lookups
+        name_idx, serving_idx, nutrient_columns, ignored = resolve_import_columns(header, column_map, serving_column)
+        if name_idx is None:
+            raise ValueError("No name column found in the source file")
+
+        # An optional units row directly under the header overrides header suffixes
+        first_row = next(reader, None)
+        if first_row is not None and is_units_row(first_row, name_idx):
+            nutrient_columns = [(idx, target, first_row[idx].strip() if idx < len(first_row) and first_row[idx].strip() else unit)
+                                for idx, target, unit in nutrient_columns]
+            ignored += [header[idx].strip() for idx, target, unit in nutrient_columns
+                        if not unit_family_matches(unit, target)]
+            nutrient_columns = [column for column in nutrient_columns if unit_family_matches(column[2], column[1])]
+            first_row = None
+        rows = itertools.chain([first_row] if first_row is not None else [], reader)
+
+        source_indexes = [idx for idx, _, _ in nutrient_columns]
+        target_fields = [target for _, target, _ in nutrient_columns]
+        _, factors = conversion_factors(tuple(f"{target} ({unit})" if unit else target
+                                              for _, target, unit in nutrient_columns))
+
+        stats = {'read': 0, 'imported': 0, 'duplicates': 0, 'skipped': 0, 'ignored': ignored}
+        with contextlib.ExitStack() as stack:
+            if isinstance(store, SQLiteStore):
+                seen_names = {name.strip().casefold() for name in store.food_names()}
+                append_batch = store.add_food_items
+            else:
+                touch_lock = stack.enter_context(file_lock(store))
+                seen_names = set()
+                store_exists = os.path.exists(store) and os.path.getsize(store) > 0
+                needs_newline = False
+                if store_exists:
+                    with open(store, mode='r', newline='', encoding='utf-8') as store_file:
+                        store_reader = csv.DictReader(store_file)
+                        fieldnames = store_reader.fieldnames or fieldnames
+                        for item in store_reader:
+                            seen_names.add((item.get('Name') or "").strip().casefold())
+                    with open(store, mode='rb') as store_file:
+                        store_file.seek(-1, os.SEEK_END)
+                        needs_newline = store_file.read(1) not in (b"\n", b"\r")
+
+                store_file = stack.enter_context(open(store, mode='a', newline='', encoding='utf-8'))
+                writer = csv.DictWriter(store_file, fieldnames=fieldnames, extrasaction='ignore')
+                if not store_exists:
+                    writer.writeheader()
+                elif needs_newline:
+                    store_file.write("\n")
+
+                def append_batch(food_items):
+                    writer.writerows(food_items)
+                    store_file.flush()
+                    touch_lock()
+
+            def write_batch(names, cells, servings):
+                # Parse the whole batch at once, then apply unit factors and serving scale in one multiply
+                block = pd.DataFrame(cells, columns=target_fields, dtype=object)
+                if delimiter != ",":
+                    block = block.apply(lambda col: col.str.replace(",", ".", regex=False))
+                grams = pd.to_numeric(pd.Series(servings, dtype=object), errors='coerce').to_numpy(dtype=float)
+                # Without a usable serving size the values stay per basis_amount grams
+                grams = np.where(np.isfinite(grams) & (grams > 0), grams, basis_amount)
+                values = (block.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+                          * (factors * (grams / basis_amount)[:, None]))
+                food_items = []
+                for name, amount, row_values in zip(names, grams.tolist(), values.tolist()):
+                    food_item = {'Name': name, 'Amount': format(amount, ".6g")}
+                    for field_name, value in zip(target_fields, row_values):
+                        food_item[field_name] = format(value, ".6g") if value == value else ""
+                    food_items.append(food_item)
+                append_batch(food_items)
+
+            names, cells, servings = [], [], []
+            for row in rows:
+                stats['read'] += 1
+                name = row[name_idx].strip() if name_idx < len(row) else ""
+                if not name:
+                    stats['skipped'] += 1
+                    continue
+                key = name.casefold()
+                if key in seen_names:
+                    stats['duplicates'] += 1
+                    continue
+                seen_names.add(key)
+
+                names.append(name)
+                cells.append([row[idx] if idx < len(row) else "" for idx in source_indexes])
+                servings.append(row[serving_idx] if serving_idx is not None and serving_idx < len(row) else None)
+
+                if len(names) >= batch_size:
+                    write_batch(names, cells, servings)
+                    stats['imported'] += len(names)
+                    names, cells, servings = [], [], []
+                    if progress_callback:
+                        progress_callback(stats['read'], stats['imported'])
+
+            if names:
+                write_batch(names, cells, servings)
+                stats['imported'] += len(names)
+            if progress_callback:
+                progress_callback(stats['read'], stats['imported'])
+
+    return stats
+
+def read_food_items(path):
+    """Read a food store CSV into a list of dicts of strings."""
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        # Use DictReader to read the file directly
+        dict_reader = csv.DictReader(file)
+        food_items = list(dict_reader)
+        fieldnames = dict_reader.fieldnames or []
+
+    # Drop the units row written by save_food_items_to_csv and convert any
+    # columns stored in non-canonical units with one multiply per load
+    if food_items and 'Name' in fieldnames and is_units_row(
+            [food_items[0].get(f) or "" for f in fieldnames], fieldnames.index('Name')):
+        units_row = food_items.pop(0)
+        declared_units = tuple(units_row.get(f) or "" for f in fieldnames)
+        _, factors = conversion_factors(tuple(fieldnames), declared_units)
+        convert = np.flatnonzero(factors != 1.0)
+        if food_items and len(convert):
+            columns = [fieldnames[i] for i in convert]
+            block = (pd.DataFrame(food_items, columns=columns)
+                     .apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float) * factors[convert])
+            for food_item, row_values in zip(food_items, block.tolist()):
+                for col, value in zip(columns, row_values):
+                    food_item[col] = format(value, ".6g") if value == value else ""
+    return food_items
+
+
+def food_value(food_item, header):
+    """Look up a plan column in a food item, accepting headers with or without a unit suffix."""
+    if header in food_item:
+        return food_item[header]
+    return food_item.get(split_header_unit(header)[0], "0")
+
+
+# Most (food, servings) row vectors kept by FOOD_ROWS
+FOOD_ROW_CACHE_SIZE = 4096
+
+
+def food_id(food_item, schema):
+    """A food's identity for caching: its name and nutrient values as stored, so an edited food gets a new ID."""
+    return (food_item.get('Name', ''),) + tuple(map(food_item.get, schema.names))
+
+
+class FoodRowCache:
+    """Bounded LRU of food row vectors (schema slot order) keyed by (food ID, servings, schema version).
+
+    Parsing a food dict dominates the cost of a row; a food seen once at one
+    serving is never parsed again, and another servings value costs only a
+    multiply. One instance (FOOD_ROWS) is shared by the plan screen, the JSON
+    API and the batch tools; it is thread safe. Vectors are read-only.
+    """
+
+    def __init__(self, maxsize=FOOD_ROW_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rows = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        row = self._rows.get(key)
+        if row is not None:
+            self._rows.move_to_end(key)
+        return row
+
+    def _put(self, key, row):
+        row.flags.writeable = False
+        self._rows[key] = row
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+        return row
+
+    def row(self, food_item, servings=1.0):
+        """A food's nutrient vector for a number of servings."""
+        schema = nutrient_schema()
+        key = (food_id(food_item, schema), float(servings), schema.version)
+        with self._lock:
+            row = self._get(key)
+            if row is not None:
+                self.hits += 1
+                return row
+        if servings == 1.0:
+            return self.vectors([food_item])[0]
+        row = self.row(food_item) * float(servings)
+        with self._lock:
+            self.misses += 1
+            return self._put(key, row)
+
+    def vectors(self, food_items):
+        """(foods x slots) per-serving matrix; distinct misses are parsed together in one pass.
+
+        When a batch misses more foods than a quarter of the cache (a
+        whole-store scan) they are not stored, so it cannot evict the working set.
+        """
+        schema = nutrient_schema()
+        # Batches repeat the same dicts (one food added many times), so each object is keyed once
+        keys_by_object = {}
+        keys = [keys_by_object.get(id(food_item)) or keys_by_object.setdefault(
+                    id(food_item), (food_id(food_item, schema), 1.0, schema.version))
+                for food_item in food_items]
+        first_index = {}
+        for k, key in enumerate(keys):
+            first_index.setdefault(key, k)
+        with self._lock:
+            found = {key: self._get(key) for key in first_index}
+        missing = [key for key, row in found.items() if row is None]
+        if missing:
+            parsed = schema.food_vectors([food_items[first_index[key]] for key in missing])
+            store = len(missing) <= self.maxsize // 4
+            with self._lock:
+                for key, row in zip(missing, parsed):
+                    found[key] = self._put(key, row) if store else row
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+        if not keys:
+            return np.zeros((0, len(schema.names)))
+        return np.vstack([found[key] for key in keys])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._rows), 'maxsize': self.maxsize,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self.hits = self.misses = 0
+
+
+FOOD_ROWS = FoodRowCache()
+
+
+def food_matrix(food_items, headers):
+    """Build a (foods x columns) float matrix of per-serving values for the given plan headers.
+
+    Schema nutrients are copied from the slot-ordered food vectors; any other
+    column is looked up by name.
+    """
+    headers = tuple(headers)
+    matrix = np.zeros((len(food_items), len(headers)))
+    if not food_items:
+        return matrix
+    schema = nutrient_schema()
+    cols, slots = schema.resolve(headers)
+    matrix[:, cols] = FOOD_ROWS.vectors(food_items)[:, slots]
+    others = sorted(set(range(len(headers))) - set(cols.tolist()))
+    if others:
+        frame = pd.DataFrame.from_records(food_items)
+        keys = [headers[i] if headers[i] in frame.columns else split_header_unit(headers[i])[0] for i in others]
+        matrix[:, others] = np.nan_to_num(numeric_matrix(frame.reindex(columns=keys), keys))
+    return matrix
+
+
+# Food database candidates offered to the optimizer: the best gap fillers, a per-serving cost
+# that keeps barely useful ones at zero, and the fewest servings worth adding to a plan
+OPTIMIZER_CANDIDATES = 20
+OPTIMIZER_FOOD_COST = 0.02
+OPTIMIZER_MIN_SERVINGS = 0.25
+
+
+def optimize_servings(nutrient_matrix, targets, modes, min_servings=0.0, max_servings=10.0,
+                      initial=None, overshoot_weight=0.05, regularization=1e-3, food_cost=0.0,
+                      max_iter=3000, tol=1e-9):
+    """Solve serving amounts that bring nutrient totals closest to the targets.
+
+    nutrient_matrix is (foods x nutrients) per serving. Totals are measured
+    relative to each target; 'good' nutrients are penalized below the target
+    (and lightly above it by overshoot_weight), 'harmful' ones above it, and
+    'irrelevant' ones or good columns without a positive target are ignored.
+    food_cost (a scalar or one value per food) is charged per serving; as an
+    L1 term on non-negative servings it leaves foods that barely help at zero.
+    The bounded program is solved with accelerated projected gradient, so each
+    iteration is two matrix-vector products over the food matrix.
+    """
+    nutrient_matrix = np.asarray(nutrient_matrix, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    n_foods = nutrient_matrix.shape[0]
+    lower = np.broadcast_to(np.asarray(min_servings, dtype=float), (n_foods,))
+    upper = np.broadcast_to(np.asarray(max_servings, dtype=float), (n_foods,))
+    cost = np.broadcast_to(np.asarray(food_cost, dtype=float), (n_foods,))
+
+    modes = np.asarray(modes, dtype=object)
+    active = np.isfinite(targets) & (((modes == 'good') & (targets > 0)) | (modes == 'harmful'))
+    below_weight = np.where(modes[active] == 'good', 1.0, 0.0)
+    above_weight = np.where(modes[active] == 'good', overshoot_weight, 1.0)
+
+    # Scale each nutrient by its target so all deviations are relative (a zero limit stays absolute)
+    scale = np.where(targets[active] > 0, targets[active], 1.0)
+    scaled = np.nan_to_num(nutrient_matrix[:, active]) / scale
+    goal = targets[active] / scale
+    lipschitz = 2.0 * np.linalg.norm(scaled, 2) ** 2 + 2.0 * regularization if scaled.size else 1.0
+    step = 1.0 / lipschitz
+
+    x = np.clip(np.zeros(n_foods) if initial is None else np.asarray(initial, dtype=float), lower, upper)
+    y, momentum = x.copy(), 1.0
+    for _ in range(max_iter):
+        residual = y @ scaled - goal
+        gradient = scaled @ (2.0 * (below_weight * np.minimum(residual, 0.0)
+                                    + above_weight * np.maximum(residual, 0.0))) + 2.0 * regularization * y + cost
+        x_next = np.clip(y - step * gradient, lower, upper)
+        next_momentum = (1.0 + np.sqrt(1.0 + 4.0 * momentum * momentum)) / 2.0
+        y = x_next + ((momentum - 1.0) / next_momentum) * (x_next - x)
+        converged = np.max(np.abs(x_next - x), initial=0.0) < tol
+        x, momentum = x_next, next_momentum
+        if converged:
+            break
+    return x
+
+
+class NutrientIndex:
+    """Per-serving nutrient matrix of the food store for one set of plan headers."""
+
+    def __init__(self, food_items, headers, key=None):
+        self.key = key
+        self.food_items = food_items
+        self.headers = list(headers)
+        self.matrix = food_matrix(food_items, self.headers)
+
+
+def rank_gap_fillers(nutrient_matrix, targets, totals, modes, top_k=10, harmful_penalty=2.0):
+    """Rank foods by how well one serving closes the gaps on good nutrients.
+
+    The score is the summed fraction of each good-nutrient deficit (target minus
+    total) that one serving covers, minus harmful_penalty times how far it pushes
+    harmful nutrients past their limits, relative to the limit. Returns the
+    indices and scores of the best top_k foods with a positive score, best first.
+    """
+    nutrient_matrix = np.asarray(nutrient_matrix, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    totals = np.nan_to_num(np.asarray(totals, dtype=float))
+    modes = np.asarray(modes, dtype=object)
+    known = np.isfinite(targets)
+
+    deficit = np.where(known, targets - totals, 0.0)
+    gap = known & (modes == 'good') & (deficit > 0)
+    if not gap.any() or not len(nutrient_matrix):
+        return np.array([], dtype=int), np.array([])
+    scores = (np.minimum(nutrient_matrix[:, gap], deficit[gap]) / deficit[gap]).sum(axis=1)
+
+    harmful = known & (modes == 'harmful')
+    if harmful.any():
+        limits = targets[harmful]
+        headroom = np.maximum(limits - totals[harmful], 0.0)
+        overflow = np.maximum(nutrient_matrix[:, harmful] - headroom, 0.0) / np.where(limits > 0, limits, 1.0)
+        scores -= harmful_penalty * overflow.sum(axis=1)
+
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > top_k:
+        candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return order, scores[order]
+
+
+# Optional per-serving price column of the food CSV, used by the "price" analytics basis
+PRICE_FIELD = "Price"
+
+# Percentile bounds for "high <nutrient>" and "low <nutrient>" analytics filters
+HIGH_PERCENTILE = 75.0
+LOW_PERCENTILE = 25.0
+
+
+def parse_food_filter(text, schema):
+    """Parse "high protein, low sodium, iron >= 90" into (slot, low, high) percentile bounds.
+
+    Nutrients match by name, case-insensitively, or by a unique name prefix.
+    Raises ValueError naming the term that could not be read.
+    """
+    def find_slot(name):
+        key = name.strip().casefold()
+        names = [nutrient.casefold() for nutrient in schema.names]
+        if key in names:
+            return names.index(key)
+        matches = [slot for slot, nutrient in enumerate(names) if nutrient.startswith(key)]
+        if len(matches) != 1:
+            raise ValueError(f"Unknown or ambiguous nutrient: '{name.strip()}'")
+        return matches[0]
+
+    bounds = []
+    for term in (term.strip() for term in text.split(',')):
+        if not term:
+            continue
+        word, _, rest = term.partition(' ')
+        if word.casefold() == 'high':
+            bounds.append((find_slot(rest), HIGH_PERCENTILE, 100.0))
+            continue
+        if word.casefold() == 'low':
+            bounds.append((find_slot(rest), 0.0, LOW_PERCENTILE))
+            continue
+        for op in ('>=', '<=', '>', '<'):
+            if op in term:
+                name, _, number = term.partition(op)
+                try:
+                    percentile = float(number.strip().rstrip('%'))
+                except ValueError:
+                    raise ValueError(f"Expected a percentile in '{term}'") from None
+                bounds.append((find_slot(name), percentile, 100.0) if '>' in op
+                              else (find_slot(name), 0.0, percentile))
+                break
+        else:
+            raise ValueError(f"Could not read filter '{term}' (use 'high X', 'low X' or 'X >= 90')")
+    return bounds
+
+
+class FoodAnalytics:
+    """Nutrient density rankings over the whole food store.
+
+    The store is read once into a (foods x schema slots) float matrix of
+    per-serving values. Per-100-kcal and per-price values and per-nutrient
+    percentiles (0-100 within the store, ties averaged) are derived from it
+    with column operations and cached by basis, so ranking and filtering
+    never go back to the food dicts. Foods without calories or a price have
+    NaN on those bases and drop out of rankings that use them.
+    """
+
+    BASES = ('serving', 'kcal', 'price')
+
+    def __init__(self, food_df, schema=None, stamp=None):
+        self.stamp = stamp
+        self.schema = schema or nutrient_schema()
+        self.names = (food_df['Name'].fillna('').astype(str).tolist() if 'Name' in food_df.columns
+                      else [''] * len(food_df))
+        cols, slots = self.schema.resolve(tuple(food_df.columns))
+        self.matrix = np.zeros((len(food_df), len(self.schema.names)))
+        self.matrix[:, slots] = np.nan_to_num(numeric_matrix(food_df, [food_df.columns[c] for c in cols]))
+        kcal = self.matrix[:, self.schema.slot['Calories / Energy']]
+        self.kcal = np.where(kcal > 0, kcal, np.nan)
+        price = (numeric_matrix(food_df, [PRICE_FIELD])[:, 0] if PRICE_FIELD in food_df.columns
+                 else np.zeros(len(food_df)))
+        self.price = np.where(price > 0, price, np.nan)
+        self.has_price = bool(np.isfinite(self.price).any())
+        modes = np.array(self.schema.modes, dtype=object)
+        self.good_slots = np.flatnonzero(modes == 'good')
+        self.harmful_slots = np.flatnonzero(modes == 'harmful')
+        self._values = {}
+        self._percentiles = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def values(self, basis='serving'):
+        """Nutrient values per serving, per 100 kcal or per unit of price."""
+        if basis not in self._values:
+            if basis == 'serving':
+                values = self.matrix
+            elif basis == 'kcal':
+                values = self.matrix / self.kcal[:, None] * 100.0
+            elif basis == 'price':
+                values = self.matrix / self.price[:, None]
+            else:
+                raise ValueError(f"Unknown basis: {basis}")
+            self._values[basis] = values
+        return self._values[basis]
+
+    def percentiles(self, slots, basis='serving'):
+        """(foods x len(slots)) percentiles on a basis: 0 lowest, 100 highest, NaN where the value is.
+
+        Columns are ranked on first use only, so a filter on two nutrients
+        sorts two columns.
+        """
+        values = self.values(basis)
+        for slot in slots:
+            if (basis, slot) not in self._percentiles:
+                column = values[:, slot]
+                order = np.argsort(column, kind='stable')  # NaNs sort last
+                count = int(np.isfinite(column).sum())
+                ordered = column[order[:count]]
+                # Equal values share the average of their ranks
+                starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]]) if count else np.zeros(0, dtype=int)
+                ends = np.r_[starts[1:], count] - 1
+                percentiles = np.full(len(column), np.nan)
+                percentiles[order[:count]] = np.repeat((starts + ends) / 2.0, ends - starts + 1) / max(count - 1, 1) * 100.0
+                self._percentiles[(basis, slot)] = percentiles
+        return np.column_stack([self._percentiles[(basis, slot)] for slot in slots] or [np.zeros((len(self), 0))])
+
+    def density_scores(self, basis='serving'):
+        """Mean percentile over good nutrients minus mean percentile over harmful ones."""
+        def row_mean(slots):
+            block = self.percentiles(slots, basis)
+            counts = np.isfinite(block).sum(axis=1)
+            return np.where(counts > 0, np.nansum(block, axis=1) / np.maximum(counts, 1), np.nan)
+
+        scores = row_mean(self.good_slots)
+        if len(self.harmful_slots):
+            scores = scores - np.nan_to_num(row_mean(self.harmful_slots))
+        return scores
+
+    def select(self, bounds, basis='serving'):
+        """Boolean mask of foods inside every (slot, low, high) percentile bound."""
+        mask = np.ones(len(self), dtype=bool)
+        for slot, low, high in bounds:
+            percentiles = self.percentiles([slot], basis)[:, 0]
+            mask &= (percentiles >= low) & (percentiles <= high)
+        return mask
+
+    def rank(self, nutrient=None, basis='serving', bounds=(), ascending=False):
+        """Indices and scores of the foods passing bounds, ranked by one nutrient or by density score."""
+        scores = (self.density_scores(basis) if nutrient is None
+                  else self.values(basis)[:, self.schema.slot[nutrient]])
+        candidates = np.flatnonzero(self.select(bounds, basis) & np.isfinite(scores))
+        order = candidates[np.argsort(scores[candidates] if ascending else -scores[candidates], kind='stable')]
+        return order, scores[order]
+
+# Sidecar lock files work across machines on a synced share, unlike fcntl/msvcrt locks
+LOCK_TIMEOUT = 5.0
+LOCK_STALE_AFTER = 60.0
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT, stale_after=LOCK_STALE_AFTER):
+    """Advisory lock for writing path, held as an exclusive path + '.lock' file.
+
+    Yields a function that refreshes the lock during long writes. A lock not
+    refreshed for stale_after seconds is treated as abandoned; TimeoutError is
+    raised if the lock cannot be taken within timeout seconds.
+    """
+    lock_path = path + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue  # Released (or broken by someone else) meanwhile
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{os.path.basename(path)} is being written from another place; try again")
+            time.sleep(0.05)
+    try:
+        with os.fdopen(fd, "w") as lock_file:
+            lock_file.write(f"{socket.gethostname()} {os.getpid()}\n")
+        yield lambda: os.utime(lock_path)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(lock_path)
+
+
+# First line of a plan CSV carrying its save counter, used to detect conflicting saves
+PLAN_VERSION_PREFIX = "# version: "
+
+
+def read_plan_version(filepath):
+    """Return the version counter of a plan file (0 for missing or pre-versioning files)."""
+    try:
+        with open(filepath, newline='', encoding='utf-8') as file:
+            first_line = file.readline()
+    except FileNotFoundError:
+        return 0
+    if first_line.startswith(PLAN_VERSION_PREFIX):
+        return int(first_line[len(PLAN_VERSION_PREFIX):].strip(" ,\r\n") or 0)
+    return 0
+
+
+def read_plan_csv(filepath):
+    """Read a plan CSV, returning (DataFrame, version)."""
+    with open(filepath, newline='', encoding='utf-8') as file:
+        first_line = file.readline()
+        version = 0
+        if first_line.startswith(PLAN_VERSION_PREFIX):
+            version = int(first_line[len(PLAN_VERSION_PREFIX):].strip(" ,\r\n") or 0)
+        else:
+            file.seek(0)
+        return pd.read_csv(file), version
+
+
+def write_plan_csv(filepath, df, version):
+    """Atomically replace a plan CSV with df under the given version; returns the version.
+
+    Callers hold file_lock(filepath) around the read-compare-write.
+    """
+    return write_plan_text(filepath, df.to_csv(index=False), version)
+
+
+def write_plan_text(filepath, csv_text, version):
+    """write_plan_csv for CSV text that is already rendered."""
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+        file.write(f"{PLAN_VERSION_PREFIX}{version}\n")
+        file.write(csv_text)
+    os.replace(tmp_path, filepath)
+    return version
+
+
+def write_plan_if_version(filepath, csv_text, version):
+    """Save a plan's CSV text as version + 1 unless it was saved elsewhere since version.
+
+    Returns (True, new version), or (False, version on disk) on a conflict.
+    """
+    with file_lock(filepath):
+        disk_version = read_plan_version(filepath)
+        if disk_version != version:
+            return False, disk_version
+        return True, write_plan_text(filepath, csv_text, version + 1)
+
+
+def delete_plan_file(filepath):
+    """Remove a plan CSV under its file lock, so a save in progress elsewhere finishes first."""
+    with file_lock(filepath):
+        os.remove(filepath)
+
+
+# Most plans whose totals are kept; the least recently used go first
+PLAN_TOTALS_CACHE_SIZE = 1024
+
+# Per-plan totals keyed by file path, each stored with the (mtime, size) it was computed from
+PLAN_TOTALS_CACHE = collections.OrderedDict()
+PLAN_TOTALS_LOCK = threading.Lock()
+
+
+def plan_totals(filepath):
+    """Return (recommended, totals) Series for a plan's nutrient columns, cached by file mtime."""
+    stat = os.stat(filepath)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with PLAN_TOTALS_LOCK:
+        cached = PLAN_TOTALS_CACHE.get(filepath)
+        if cached and cached[0] == stamp:
+            PLAN_TOTALS_CACHE.move_to_end(filepath)
+            return cached[1]
+
+    recommended, totals = summarize_plan(normalize_units(read_plan_csv(filepath)[0]))
+    with PLAN_TOTALS_LOCK:
+        PLAN_TOTALS_CACHE[filepath] = (stamp, (recommended, totals))
+        PLAN_TOTALS_CACHE.move_to_end(filepath)
+        while len(PLAN_TOTALS_CACHE) > PLAN_TOTALS_CACHE_SIZE:
+            PLAN_TOTALS_CACHE.popitem(last=False)
+    return recommended, totals
+
+
+def numeric_matrix(df, columns):
+    """Float matrix of the given DataFrame columns; text cells that are not numbers become NaN."""
+    values = df[columns]
+    # Only text columns need parsing; numeric ones convert straight to the float matrix
+    text_columns = values.select_dtypes(exclude='number').columns
+    if len(text_columns):
+        values = values.assign(**{column: pd.to_numeric(values[column], errors='coerce') for column in text_columns})
+    return values.to_numpy(dtype=float)
+
+
+def summarize_plan(plan_df):
+    """Return (recommended, totals) Series over the nutrient columns of a plan DataFrame."""
+    nutrient_headers = [header for header in plan_df.columns if header not in ('Name', 'Amount')]
+    matrix = numeric_matrix(plan_df, nutrient_headers)
+    recommended = pd.Series(matrix[0] if len(matrix) else np.nan, index=nutrient_headers)
+    totals = pd.Series(np.nansum(matrix[1:], axis=0), index=nutrient_headers)
+    return recommended, totals
+
+
+def aggregate_days(filepaths, window=7):
+    """Aggregate plans (one per day, in order) into day x nutrient matrices.
+
+    Returns (totals, rolling, recommended) DataFrames indexed by plan name, where
+    rolling is the trailing window-day mean of totals and recommended holds each
+    day's Recommended row. Unchanged plans come from PLAN_TOTALS_CACHE.
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in filepaths]
+    per_day = [plan_totals(path) for path in filepaths]
+    recommended = pd.DataFrame([day[0] for day in per_day], index=names)
+    totals = pd.DataFrame([day[1] for day in per_day], index=names).reindex(columns=recommended.columns)
+    rolling = totals.rolling(window, min_periods=1).mean()
+    return totals, rolling, recommended
+
+
+class PlanArchive:
+    """Retired plans packed into one deflate-compressed zip under plans/archive/.
+
+    index.json beside the zip holds, per plan, its member name, last-modified
+    and archived dates, version, food count and its Recommended and total
+    nutrient values in canonical units. Listings and reports read only the
+    index; a plan body is decompressed only when that one plan is extracted.
+    Writers hold the archive's file lock; the index is replaced atomically
+    after the zip, so a crash leaves at most an unindexed member.
+    """
+
+    def __init__(self, plans_dir):
+        self.directory = os.path.join(plans_dir, "archive")
+        self.path = os.path.join(self.directory, "plans.zip")
+        self.index_path = os.path.join(self.directory, "index.json")
+        self._index = None
+        self._index_stamp = None
+
+    def entries(self):
+        """{plan name: index entry}, re-read only when index.json changes."""
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return {}
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._index_stamp:
+            with open(self.index_path, encoding='utf-8') as file:
+                self._index = json.load(file)
+            self._index_stamp = stamp
+        return self._index
+
+    def __contains__(self, name):
+        return name in self.entries()
+
+    def _write_index(self, entries):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(entries, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+    def add(self, plans):
+        """Archive (name, plan_df, version, modified datetime) tuples; returns the names stored."""
+        os.makedirs(self.directory, exist_ok=True)
+        archived = datetime.datetime.now().isoformat(timespec='seconds')
+        with file_lock(self.path):
+            entries = dict(self.entries())
+            stored = []
+            with zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+                members = set(archive.namelist())
+                for name, plan_df, version, modified in plans:
+                    # A re-archived plan gets a fresh member; the old one goes at the next compaction
+                    member = f"{name}.csv"
+                    serial = 1
+                    while member in members:
+                        serial += 1
+                        member = f"{name}.{serial}.csv"
+                    archive.writestr(member, plan_df.to_csv(index=False))
+                    members.add(member)
+                    recommended, totals = summarize_plan(normalize_units(plan_df))
+                    entries[name] = {
+                        'member': member,
+                        'modified': modified.isoformat(timespec='seconds'),
+                        'archived': archived,
+                        'version': version,
+                        'schema': nutrient_schema().version,
+                        'foods': max(len(plan_df) - 1, 0),
+                        'recommended': {header: _json_value(value) for header, value in recommended.items()},
+                        'totals': {header: _json_value(value) for header, value in totals.items()},
+                    }
+                    stored.append(name)
+            self._write_index(entries)
+        return stored
+
+    def read(self, name):
+        """Decompress one archived plan into a DataFrame shaped like the plan CSV."""
+        member = self.entries()[name]['member']
+        with zipfile.ZipFile(self.path) as archive:
+            with archive.open(member) as file:
+                return pd.read_csv(file, encoding='utf-8')
+
+    def remove(self, names):
+        """Drop plans from the archive and rewrite the zip without their (or any stale) members."""
+        with file_lock(self.path):
+            entries = {name: entry for name, entry in self.entries().items() if name not in set(names)}
+            keep = {entry['member'] for entry in entries.values()}
+            tmp_path = self.path + ".tmp"
+            with zipfile.ZipFile(self.path) as source, \
+                    zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as target:
+                for info in source.infolist():
+                    if info.filename in keep:
+                        with source.open(info) as src, target.open(info, 'w') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmp_path, self.path)
+            self._write_index(entries)
+
+    def totals(self):
+        """(totals, recommended) DataFrames indexed by plan name, straight from the index."""
+        entries = self.entries()
+        totals = pd.DataFrame([entry['totals'] for entry in entries.values()], index=list(entries), dtype=float)
+        recommended = pd.DataFrame([entry['recommended'] for entry in entries.values()], index=list(entries),
+                                   dtype=float)
+        return totals, recommended
+
+
+def archive_plans(plan_names, plans_dir, store=None):
+    """Move plans into the PlanArchive; returns the names archived.
+
+    CSV plans are read and removed under their file locks; with a SQLiteStore
+    the plans are read from and then deleted in the database.
+    """
+    archive = PlanArchive(plans_dir)
+    plans, locks = [], contextlib.ExitStack()
+    with locks:
+        for name in plan_names:
+            if store is not None:
+                plans.append((name, store.get_plan(name), 1, datetime.datetime.now()))
+                continue
+            path = os.path.join(plans_dir, f"{name}.csv")
+            locks.enter_context(file_lock(path))
+            plan_df, version = read_plan_csv(path)
+            plans.append((name, plan_df, version, datetime.datetime.fromtimestamp(os.path.getmtime(path))))
+        archived = archive.add(plans)
+        for name in archived:
+            if store is not None:
+                store.delete_plan(name)
+            else:
+                os.remove(os.path.join(plans_dir, f"{name}.csv"))
+    return archived
+
+
+def restore_plan(plan_name, plans_dir, store=None):
+    """Extract one plan from the PlanArchive back into plans/ (or the database) and drop it from the archive."""
+    archive = PlanArchive(plans_dir)
+    entry = archive.entries()[plan_name]
+    plan_df = archive.read(plan_name)
+    if store is not None:
+        if store.has_plan(plan_name):
+            raise FileExistsError(f"A plan named '{plan_name}' already exists")
+        store.save_plan(plan_name, normalize_units(plan_df))
+    else:
+        path = os.path.join(plans_dir, f"{plan_name}.csv")
+        with file_lock(path):
+            if os.path.exists(path):
+                raise FileExistsError(f"A plan named '{plan_name}' already exists")
+            write_plan_csv(path, plan_df, entry.get('version', 0) + 1)
+    archive.remove([plan_name])
+
+
+# Long-format records written by export_dataset, per chunk of source rows
+EXPORT_COLUMNS = ("plan", "row", "food", "amount", "nutrient", "value", "unit")
+EXPORT_CHUNK_ROWS = 5000
+
+
+def long_records(df, plan=None, first_row=0):
+    """Melt a canonical-unit plan or food DataFrame into EXPORT_COLUMNS records.
+
+    Each non-blank nutrient cell becomes one record. For plans, row 0 is the
+    Recommended row and amount is servings; for foods plan is None and amount
+    is the serving size in grams.
+    """
+    units = load_units()
+    headers = [header for header in df.columns if header not in ('Name', 'Amount')]
+    nutrients = [split_header_unit(header)[0] for header in headers]
+    matrix = numeric_matrix(df, headers)
+    rows, cols = np.nonzero(~np.isnan(matrix))
+    foods = df['Name'].to_numpy(dtype=object) if 'Name' in df.columns else np.full(len(df), None)
+    amounts = numeric_matrix(df, ['Amount'])[:, 0] if 'Amount' in df.columns else np.full(len(df), np.nan)
+    return pd.DataFrame({
+        'plan': plan,
+        'row': rows + first_row,
+        'food': foods[rows],
+        'amount': amounts[rows],
+        'nutrient': np.array(nutrients, dtype=object)[cols],
+        'value': matrix[rows, cols],
+        'unit': np.array([units.get(name, "") for name in nutrients], dtype=object)[cols],
+    }, columns=list(EXPORT_COLUMNS))
+
+
+class ExportWriter:
+    """Append record chunks to a JSONL or Parquet file, published atomically on commit.
+
+    Parquet needs the optional pyarrow package; each chunk becomes one row
+    group, so memory stays bounded by the chunk size.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.fmt = fmt
+        if fmt == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow); use --format jsonl instead")
+            self._pa = pa
+            self._schema = pa.schema([("plan", pa.string()), ("row", pa.int64()), ("food", pa.string()),
+                                      ("amount", pa.float64()), ("nutrient", pa.string()),
+                                      ("value", pa.float64()), ("unit", pa.string())])
+            self._writer = pq.ParquetWriter(self.tmp_path, self._schema, compression="zstd")
+        else:
+            self._writer = open(self.tmp_path, 'w', encoding='utf-8')
+        self.rows = 0
+
+    def write(self, records):
+        if records.empty:
+            return
+        if self.fmt == "parquet":
+            self._writer.write_table(self._pa.Table.from_pandas(records, schema=self._schema, preserve_index=False))
+        else:
+            records.to_json(self._writer, orient='records', lines=True, force_ascii=False)
+        self.rows += len(records)
+
+    def commit(self):
+        self._writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self._writer.close()
+        os.remove(self.tmp_path)
+
+
+def _food_chunks(csv_file, store, chunk_rows):
+    """Yield the food store in canonical-unit DataFrame chunks without loading it whole."""
+    if isinstance(store, SQLiteStore):
+        cursor = store.conn.execute(store._select_foods_sql)
+        headers = store.plan_headers()
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield pd.DataFrame(rows, columns=headers)
+    declared_units = None
+    for chunk in pd.read_csv(csv_file, dtype=str, keep_default_na=False, chunksize=chunk_rows, encoding='utf-8'):
+        if declared_units is None:
+            # The units row written by save_food_items_to_csv sits under the header
+            first = chunk.iloc[0].tolist() if len(chunk) else []
+            name_idx = list(chunk.columns).index('Name') if 'Name' in chunk.columns else 0
+            declared_units = tuple(first) if is_units_row(first, name_idx) else ()
+            if declared_units:
+                chunk = chunk.iloc[1:]
+        yield normalize_units(chunk, declared_units or None)
+
+
+def read_food_frame(csv_file, store=None):
+    """The whole food store as one canonical-unit DataFrame, numbers parsed by the C reader."""
+    if isinstance(store, SQLiteStore):
+        return pd.DataFrame(store.conn.execute(store._select_foods_sql).fetchall(), columns=store.plan_headers())
+    with open(csv_file, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        first = next(reader, [])
+    # The units row written by save_food_items_to_csv sits under the header
+    declared_units = tuple(first) if first and is_units_row(first, header.index('Name') if 'Name' in header else 0) else ()
+    food_df = pd.read_csv(csv_file, skiprows=[1] if declared_units else None, dtype={'Name': str}, encoding='utf-8')
+    return normalize_units(food_df, declared_units or None)
+
+
+def _source_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def export_dataset(output_dir, csv_file, plans_dir, store=None, fmt="jsonl", chunk_rows=EXPORT_CHUNK_ROWS,
+                   full=False):
+    """Stream the food store and every plan into long-format JSONL or Parquet files.
+
+    Writes output_dir/foods.<ext> and output_dir/plans/<plan>.<ext> with
+    EXPORT_COLUMNS records in canonical units, plus manifest.json holding the
+    mtime and size each output was built from. Sources whose stamp matches the
+    manifest are skipped unless full is set, and outputs of deleted plans are
+    removed. Foods are read in chunks of chunk_rows; with a SQLiteStore the
+    database file stamp stands in for per-plan mtimes. Returns stats:
+    exported, skipped, removed, records and seconds.
+    """
+    started = time.perf_counter()
+    ext = {"jsonl": "jsonl", "parquet": "parquet"}[fmt]
+    os.makedirs(os.path.join(output_dir, "plans"), exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    try:
+        with open(manifest_path, encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get('format') != fmt or manifest.get('schema') != nutrient_schema().version:
+        manifest = {}
+    previous = manifest.get('sources', {})
+    sources = {}
+    stats = {'exported': 0, 'skipped': 0, 'removed': 0, 'records': 0}
+
+    def export(key, chunks, path, stamp):
+        if not full and stamp is not None and previous.get(key) == stamp and os.path.exists(path):
+            sources[key] = stamp
+            stats['skipped'] += 1
+            return
+        writer = ExportWriter(path, fmt)
+        try:
+            for chunk in chunks():
+                writer.write(chunk)
+        except Exception:
+            writer.discard()
+            raise
+        writer.commit()
+        sources[key] = stamp
+        stats['exported'] += 1
+        stats['records'] += writer.rows
+
+    def food_records():
+        first_row = 0
+        for chunk in _food_chunks(csv_file, store, chunk_rows):
+            yield long_records(chunk, first_row=first_row)
+            first_row += len(chunk)
+
+    if isinstance(store, SQLiteStore):
+        database_stamp = [_source_stamp(store.db_path), _source_stamp(store.db_path + "-wal")]
+        plan_names = store.list_plans()
+    else:
+        database_stamp = None
+        plan_names = sorted(os.path.splitext(name)[0] for name in os.listdir(plans_dir) if name.endswith(".csv"))
+    export("foods", food_records, os.path.join(output_dir, f"foods.{ext}"), database_stamp or _source_stamp(csv_file))
+
+    for name in plan_names:
+        if store is not None:
+            load = lambda name=name: store.get_plan(name)
+            stamp = database_stamp
+        else:
+            path = os.path.join(plans_dir, f"{name}.csv")
+            load = lambda path=path: normalize_units(read_plan_csv(path)[0])
+            stamp = _source_stamp(path)
+        export(f"plans/{name}", lambda name=name, load=load: [long_records(load(), plan=name)],
+               os.path.join(output_dir, "plans", f"{name}.{ext}"), stamp)
+
+    for key in set(previous) - set(sources):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(output_dir, f"{key}.{ext}"))
+        stats['removed'] += 1
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'format': fmt, 'schema': nutrient_schema().version, 'columns': list(EXPORT_COLUMNS),
+                   'sources': sources}, file, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def load_nutrient_modes(plan_headers=()):
+    """{nutrient name: mode} from the schema, also keyed by the given plan headers."""
+    schema = nutrient_schema()
+    nutrient_modes = dict(zip(schema.names, schema.modes))
+    plan_headers = tuple(plan_headers)
+    for col, slot in zip(*(part.tolist() for part in schema.resolve(plan_headers))):
+        nutrient_modes[plan_headers[col]] = schema.modes[slot]
+    return nutrient_modes
+
+
+def nutrient_status(mode, recommended, total):
+    """Color status ('red', 'green' or None) of one nutrient's Recommended cell."""
+    if mode == 'good':
+        if recommended > total:
+            return 'red'  # not meeting good nutrient target
+        if recommended < total:
+            return 'green'  # exceeding good nutrient target
+    elif mode == 'harmful':
+        if recommended > total:
+            return 'green'  # staying below harmful limit
+        if recommended < total:
+            return 'red'  # exceeding harmful limit
+    return None  # irrelevant nutrients keep the default color
+
+
+def nutrient_status_codes(modes, recommended, totals):
+    """Vectorized nutrient_status: 1 for green, -1 for red, 0 for no color.
+
+    totals may be one plan's vector or a (variants x nutrients) matrix; blank
+    targets count as 0 like in the sheet.
+    """
+    modes = np.asarray(modes, dtype=object)
+    over = np.sign(np.nan_to_num(np.asarray(totals, dtype=float))
+                   - np.nan_to_num(np.asarray(recommended, dtype=float)))
+    return np.where(modes == 'good', over, np.where(modes == 'harmful', -over, 0)).astype(int)
+
+
+STATUS_COLORS = {'red': '#FF6B6B', 'green': '#51CF66'}
+
+def safe_plan_name(name):
+    """Plan file name for a user-given plan name: letters, digits and spaces only."""
+    return "".join(c for c in name if c.isalpha() or c.isdigit() or c.isspace()).rstrip()
+
+
+# Roster columns recognised as the plan name, checked in this order
+PLAN_NAME_ALIASES = ("plan", "plan name", "client", "client name") + NAME_ALIASES
+
+# Roster columns recognised as client profile fields
+PROFILE_ALIASES = {'sex': ("sex", "gender"), 'age': ("age",), 'weight': ("weight", "body weight"),
+                   'activity': ("activity", "activity level", "pal")}
+
+# Physical activity levels (PAL) multiplying the basal energy rules
+ACTIVITY_LEVELS = {"sedentary": 1.4, "low active": 1.6, "active": 1.8, "very active": 2.0}
+
+ClientProfile = collections.namedtuple("ClientProfile", "sex age weight activity")
+
+
+def make_profile(sex, age, weight, activity="sedentary"):
+    """Normalize raw profile fields into a hashable ClientProfile.
+
+    sex becomes male/female, age whole years, weight kg rounded to 0.1, and
+    activity a PAL multiplier (a level name from ACTIVITY_LEVELS or a number).
+    """
+    sex = str(sex).strip().lower()
+    sex = {"m": "male", "f": "female", "man": "male", "woman": "female"}.get(sex, sex)
+    if sex not in ("male", "female"):
+        raise ValueError(f"Unknown sex: {sex!r}")
+    activity = str(activity).strip().lower() or "sedentary"
+    pal = ACTIVITY_LEVELS[activity] if activity in ACTIVITY_LEVELS else float(activity)
+    age, weight = int(float(age)), round(float(weight), 1)
+    if age <= 0 or weight <= 0 or pal <= 0:
+        raise ValueError("Age, weight and activity must be positive")
+    return ClientProfile(sex, age, weight, round(pal, 2))
+
+
+def roster_name_column(roster):
+    folded = {str(column).strip().casefold(): column for column in roster.columns}
+    return next((folded[alias] for alias in PLAN_NAME_ALIASES if alias in folded), roster.columns[0])
+
+
+def roster_profiles(roster):
+    """ClientProfile per roster row, or None where the roster has no (valid) profile for it."""
+    folded = {split_header_unit(str(column))[0].casefold(): column for column in roster.columns}
+    columns = {field: next((folded[alias] for alias in aliases if alias in folded), None)
+               for field, aliases in PROFILE_ALIASES.items()}
+    if not all(columns[field] for field in ('sex', 'age', 'weight')):
+        return [None] * len(roster)
+    activities = roster[columns['activity']] if columns['activity'] else pd.Series("", index=roster.index)
+    profiles = []
+    for sex, age, weight, activity in zip(roster[columns['sex']], roster[columns['age']],
+                                          roster[columns['weight']], activities.fillna("")):
+        try:
+            profiles.append(make_profile(sex, age, weight, activity))
+        except (TypeError, ValueError):
+            profiles.append(None)
+    return profiles
+
+
+def roster_target_overrides(roster, name_column):
+    """(schema slots, clients x slots matrix) of roster columns named like a nutrient.
+
+    The roster must already be in canonical units (normalize_units); blank or
+    non-numeric cells are NaN, meaning the earlier target is kept.
+    """
+    columns, slots = nutrient_schema().resolve(tuple(roster.columns))
+    keep = [k for k, idx in enumerate(columns.tolist()) if roster.columns[idx] != name_column]
+    columns, slots = columns[keep], slots[keep]
+    if not len(columns):
+        return slots, np.empty((len(roster), 0))
+    return slots, roster.iloc[:, columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+
+@functools.lru_cache(maxsize=8)
+def load_target_rules(rules_path, stamp):
+    """Parse the DRI-style rule table into arrays; stamp (mtime_ns, size) keys the cache to the file version.
+
+    Each rule gives base + per_kg * weight (times PAL when activity scaled) +
+    per_1000_kcal * energy / 1000 for one nutrient, sex ('any' matches both) and
+    age range [age_from, age_to). Values are in the canonical schema units.
+    """
+    rules = pd.read_csv(rules_path)
+    position = nutrient_schema().slot
+    unknown = set(rules['Nutrient']) - set(position)
+    if unknown:
+        raise ValueError(f"Unknown nutrients in target rules: {', '.join(sorted(unknown))}")
+    return {
+        'column': rules['Nutrient'].map(position).to_numpy(dtype=int),
+        'sex': rules['Sex'].str.strip().str.lower().to_numpy(),
+        'age_from': rules['Age From'].to_numpy(dtype=float),
+        'age_to': rules['Age To'].to_numpy(dtype=float),
+        'base': rules['Base'].to_numpy(dtype=float),
+        'per_kg': rules['Per Kg'].to_numpy(dtype=float),
+        'per_1000_kcal': rules['Per 1000 kcal'].to_numpy(dtype=float),
+        'activity_scaled': rules['Activity Scaled'].astype(bool).to_numpy(),
+    }
+
+
+def profile_targets(profile, rules_path=None):
+    """Recommended vector for a ClientProfile in schema slot order (NaN where no rule applies).
+
+    Memoized per (profile, rule file version): editing data/target_rules.csv
+    changes the key, so the next call recomputes while repeated profiles are free.
+    """
+    rules_path = rules_path or os.path.join(get_base_path(), "data", "target_rules.csv")
+    stat = os.stat(rules_path)
+    return _profile_targets(profile, rules_path, (stat.st_mtime_ns, stat.st_size))
+
+
+@functools.lru_cache(maxsize=4096)
+def _profile_targets(profile, rules_path, stamp):
+    rules = load_target_rules(rules_path, stamp)
+    matches = np.flatnonzero(((rules['sex'] == profile.sex) | (rules['sex'] == 'any'))
+                             & (rules['age_from'] <= profile.age) & (profile.age < rules['age_to']))
+    # The first matching rule per nutrient wins
+    columns, first = np.unique(rules['column'][matches], return_index=True)
+    rows = matches[first]
+    fixed = rules['base'][rows] + rules['per_kg'][rows] * profile.weight
+    fixed = np.where(rules['activity_scaled'][rows], fixed * profile.activity, fixed)
+    schema = nutrient_schema()
+    energy_slot = schema.slot["Calories / Energy"]
+    energy = fixed[columns == energy_slot][0] if energy_slot in columns else np.nan
+    per_energy = rules['per_1000_kcal'][rows]
+    values = np.where(per_energy != 0, fixed + per_energy * energy / 1000.0, fixed)
+    targets = np.full(len(schema.names), np.nan)
+    targets[columns] = values
+    targets.setflags(write=False)
+    return targets
+
+
+@functools.lru_cache(maxsize=64)
+def target_columns(headers):
+    """(plan column indexes, schema slots, unit factors) for a tuple of plan headers.
+
+    Dividing a canonical target by its factor gives the value in the column's own unit.
+    """
+    plan_cols, slots = nutrient_schema().resolve(headers)
+    return plan_cols, slots, conversion_factors(headers)[1][plan_cols]
+
+
+def retarget_plans(profiles_path, plans_dir, store=None, rules_path=None, max_workers=None):
+    """Recompute the Recommended row of every plan in a profiles CSV from its client profile.
+
+    The CSV has a plan name column plus Sex, Age, Weight (kg) and optionally
+    Activity. Roster columns named like a nutrient override the rule targets as
+    in generate_plans. Nutrients with neither keep their current target. CSV plans are
+    patched by a thread pool under their file locks, re-rendering only the
+    Recommended line; a SQLiteStore is updated in one transaction. Only the
+    first row of a repeated name is used. Returns stats: updated, missing (no
+    such plan), skipped (no valid profile or override, or a repeated name), failed,
+    seconds and plans_per_second.
+    """
+    started = time.perf_counter()
+    roster = normalize_units(pd.read_csv(profiles_path, encoding='utf-8-sig'))
+    name_column = roster_name_column(roster)
+    names = [safe_plan_name(str(name)) if name == name else "" for name in roster[name_column]]
+    profiles = roster_profiles(roster)
+    override_slots, overrides = roster_target_overrides(roster, name_column)
+    stats = {'updated': 0, 'missing': 0, 'skipped': 0, 'failed': 0}
+    jobs, seen = [], set()
+    for row, (name, profile) in enumerate(zip(names, profiles)):
+        if not name or name.casefold() in seen or not (profile or (~np.isnan(overrides[row])).any()):
+            stats['skipped'] += 1
+            continue
+        seen.add(name.casefold())
+        jobs.append((name, row))
+
+    def client_targets(row):
+        profile = profiles[row]
+        targets = (profile_targets(profile, rules_path).copy() if profile
+                   else np.full(len(nutrient_schema().names), np.nan))
+        values = overrides[row]
+        targets[override_slots] = np.where(np.isnan(values), targets[override_slots], values)
+        return targets
+
+    def patch_plan(name, row):
+        path = os.path.join(plans_dir, f"{name}.csv")
+        if not os.path.exists(path):
+            return 'missing'
+        targets = client_targets(row)
+        with file_lock(path):
+            with open(path, newline='', encoding='utf-8') as file:
+                lines = file.read().splitlines(keepends=True)
+            version = read_plan_version(path)
+            start = 1 if lines and lines[0].startswith(PLAN_VERSION_PREFIX) else 0
+            header = next(csv.reader([lines[start]]))
+            recommended = next(csv.reader([lines[start + 1]]))
+            plan_cols, target_idx, factors = target_columns(tuple(header))
+            values = targets[target_idx] / factors
+            for col, value in zip(plan_cols.tolist(), values.tolist()):
+                if value == value:
+                    recommended[col] = format(value, ".10g")
+            line = io.StringIO()
+            ending = lines[start + 1][len(lines[start + 1].rstrip("\r\n")):] or "\n"
+            csv.writer(line, lineterminator=ending).writerow(recommended)
+            lines[start + 1] = line.getvalue()
+            write_plan_text(path, "".join(lines[start:]), version + 1)
+        return 'updated'
+
+    if isinstance(store, SQLiteStore):
+        updates = []
+        for name, row in jobs:
+            if store.has_plan(name):
+                updates.append((name, [None if value != value else float(value)
+                                       for value in client_targets(row)]))
+            else:
+                stats['missing'] += 1
+        store.set_plan_targets(updates)
+        stats['updated'] = len(updates)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(patch_plan, name, row): name for name, row in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    stats[future.result()] += 1
+                except Exception as e:
+                    stats['failed'] += 1
+                    print(f"Warning: Could not retarget plan '{futures[future]}': {e}")
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['plans_per_second'] = stats['updated'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+def generate_plans(roster_path, plans_dir, template_path=None, store=None, max_workers=None,
+                   overwrite=False, progress_callback=None, rules_path=None):
+    """Create one plan per roster row from the plan template.
+
+    The template is read once. Each client's Recommended row starts from the
+    template, then takes the profile_targets of its Sex/Age/Weight/Activity
+    columns when the roster has them, then any roster column named like a
+    nutrient (with or without a unit; units are converted); blank cells keep
+    the earlier value. CSV plans are written by
+    a thread pool, each under its file lock through a temp file and atomic
+    rename. A SQLiteStore is written serially on its single connection.
+    Existing plans and repeated names are skipped unless overwrite is set.
+    Returns stats: created, skipped, failed, seconds and plans_per_second.
+    """
+    started = time.perf_counter()
+    template_path = template_path or os.path.join(get_base_path(), "templates", "plan_template.csv")
+    template = normalize_units(pd.read_csv(template_path))
+    roster = normalize_units(pd.read_csv(roster_path, encoding='utf-8-sig'))
+
+    name_column = roster_name_column(roster)
+
+    # All Recommended rows at once, as a (clients x nutrient columns) matrix
+    target_idx = [idx for idx, header in enumerate(template.columns) if header not in ('Name', 'Amount')]
+    template = template.astype({template.columns[idx]: float for idx in target_idx})
+    defaults = pd.to_numeric(template.iloc[0, target_idx], errors='coerce').to_numpy(dtype=float)
+    targets = np.tile(defaults, (len(roster), 1))
+
+    plan_cols, rule_idx, factors = target_columns(tuple(template.columns))
+    slots = np.searchsorted(target_idx, plan_cols)
+    profiles = roster_profiles(roster)
+    for row, profile in enumerate(profiles):
+        if profile:
+            values = profile_targets(profile, rules_path)[rule_idx] / factors
+            targets[row, slots] = np.where(np.isnan(values), targets[row, slots], values)
+
+    # Roster nutrient columns -> template columns, through their schema slots
+    position = {slot: k for k, slot in enumerate(rule_idx.tolist())}
+    override_slots, overrides = roster_target_overrides(roster, name_column)
+    picked = [(k, position[slot]) for k, slot in enumerate(override_slots.tolist()) if slot in position]
+    if picked:
+        source, dest = [k for k, _ in picked], [k for _, k in picked]
+        values = overrides[:, source] / factors[dest]
+        targets[:, slots[dest]] = np.where(np.isnan(values), targets[:, slots[dest]], values)
+
+    stats = {'created': 0, 'skipped': 0, 'failed': 0}
+    jobs, seen = [], set()
+    for row, raw_name in enumerate(roster[name_column].tolist()):
+        name = safe_plan_name(str(raw_name)) if raw_name == raw_name else ""
+        if not name or name.casefold() in seen:
+            stats['skipped'] += 1
+            continue
+        seen.add(name.casefold())
+        jobs.append((name, row))
+
+    def build_plan(row):
+        plan_df = template.copy()
+        if target_idx:
+            plan_df.iloc[0, target_idx] = targets[row]
+        return plan_df
+
+    # Every CSV plan shares the template text except its Recommended line, so render the rest once
+    template_lines = template.to_csv(index=False).splitlines(keepends=True)
+    header_line, food_lines = template_lines[0], "".join(template_lines[2:])
+    recommended_values = template.iloc[0].tolist() if len(template) else [""] * len(template.columns)
+
+    def render_plan(row):
+        values = list(recommended_values)
+        for idx, value in zip(target_idx, targets[row].tolist()):
+            values[idx] = format(value, ".10g") if value == value else value
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow("" if value != value else value for value in values)
+        return header_line + line.getvalue() + food_lines
+
+    def write_plan(name, row):
+        path = os.path.join(plans_dir, f"{name}.csv")
+        with file_lock(path):
+            exists = os.path.exists(path)
+            if exists and not overwrite:
+                return 'skipped'
+            write_plan_text(path, render_plan(row), read_plan_version(path) + 1 if exists else 1)
+        return 'created'
+
+    done = 0
+    if isinstance(store, SQLiteStore):
+        for name, row in jobs:
+            if store.has_plan(name) and not overwrite:
+                stats['skipped'] += 1
+            else:
+                store.save_plan(name, build_plan(row))
+                stats['created'] += 1
+            done += 1
+            if progress_callback and done % 100 == 0:
+                progress_callback(done, len(jobs))
+    else:
+        os.makedirs(plans_dir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(write_plan, name, row): name for name, row in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    stats[future.result()] += 1
+                except Exception as e:
+                    stats['failed'] += 1
+                    print(f"Warning: Could not create plan '{futures[future]}': {e}")
+                done += 1
+                if progress_callback and done % 100 == 0:
+                    progress_callback(done, len(jobs))
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['plans_per_second'] = stats['created'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+# Label written into the Name cell of a plan's Recommended row
+RECOMMENDED_LABEL = "Recommended Amount"
+
+def format_plan_number(value, **kwargs):
+    """Display formatter for plan sheet cells: the sheet keeps raw floats, rounding is view-only."""
+    return "" if value != value else f"{value:.2f}"
+
+
+# tksheet formatter for every numeric plan column; blanks are stored as None
+PLAN_NUMBER_FORMAT = float_formatter(datatypes=(float, type(None)), to_str_function=format_plan_number)
+
+# How often the CSV files are checked for changes made elsewhere
+FILE_POLL_MS = 2000
+
+# How often finished background file operations are collected on the Tk loop
+IO_POLL_MS = 25
+
+# Food rows handed to the plan sheet at a time; longer plans are paged from the plan model
+PLAN_PAGE_ROWS = 500
+
+# Number of built screens kept hidden for instant navigation (least recently shown go first)
+VIEW_CACHE_LIMIT = 3
+
+
+class SQLiteStore:
+    """Optional SQLite storage for foods and plans.
+
+    One connection in WAL mode is reused for the whole session. Foods, plans
+    (holding their Recommended targets) and plan rows are indexed tables with
+    one REAL column per nutrient, so row edits are single-row statements and
+    plan totals can be computed with SQL aggregates.
+    """
+
+    def __init__(self, db_path, check_same_thread=True):
+        self.db_path = db_path
+        schema = nutrient_schema()
+        self.nutrients = list(schema.names)
+        self.units = schema.unit_of
+        self.conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+
+        columns = ", ".join(f'"{name}" REAL' for name in self.nutrients)
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS foods (id INTEGER PRIMARY KEY, "
+                              f"name TEXT NOT NULL UNIQUE COLLATE NOCASE, amount REAL, {columns})")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY, "
+                              f"name TEXT NOT NULL UNIQUE, {columns})")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS plan_rows (id INTEGER PRIMARY KEY, "
+                              f"plan_id INTEGER NOT NULL REFERENCES plans(id) ON DELETE CASCADE, "
+                              f"position INTEGER NOT NULL, name TEXT, amount REAL, {columns})")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS plan_rows_plan_position ON plan_rows (plan_id, position)")
+            # Databases from an older schema version get the nutrients added since as blank columns
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < schema.version:
+                for table in ("foods", "plans", "plan_rows"):
+                    existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                    for name in self.nutrients:
+                        if name not in existing:
+                            self.conn.execute(f'ALTER TABLE {table} ADD COLUMN "{name}" REAL')
+                self.conn.execute(f"PRAGMA user_version = {schema.version}")
+
+        # Statements are built once; sqlite3 caches the prepared form by SQL text
+        quoted = ", ".join(f'"{name}"' for name in self.nutrients)
+        marks = ", ".join("?" for _ in self.nutrients)
+        assignments = ", ".join(f'"{name}" = ?' for name in self.nutrients)
+        self._insert_food_sql = f"INSERT OR IGNORE INTO foods (name, amount, {quoted}) VALUES (?, ?, {marks})"
+        self._select_foods_sql = f"SELECT name, amount, {quoted} FROM foods ORDER BY id"
+        self._insert_plan_sql = f"INSERT INTO plans (name, {quoted}) VALUES (?, {marks})"
+        self._insert_row_sql = (f"INSERT INTO plan_rows (plan_id, position, name, amount, {quoted}) "
+                                f"VALUES (?, ?, ?, ?, {marks})")
+        self._update_row_sql = (f"UPDATE plan_rows SET name = ?, amount = ?, {assignments} "
+                                f"WHERE plan_id = ? AND position = ?")
+        self._select_rows_sql = f"SELECT name, amount, {quoted} FROM plan_rows WHERE plan_id = ? ORDER BY position"
+        self._select_targets_sql = f"SELECT {quoted} FROM plans WHERE id = ?"
+        self._all_targets_sql = f"SELECT name, {quoted} FROM plans"
+        sums = ", ".join(f'SUM(r."{name}")' for name in self.nutrients)
+        self._totals_sql = f"SELECT p.name, {sums} FROM plans p LEFT JOIN plan_rows r ON r.plan_id = p.id GROUP BY p.id"
+
+    @staticmethod
+    def _number(value):
+        """Convert a CSV/sheet cell into a float, or None when blank or invalid."""
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return None if number != number else number
+
+    @staticmethod
+    def _text(value):
+        """Format a stored number back into the string form the CSV loaders produce."""
+        return "" if value is None else format(value, ".10g")
+
+    def _food_params(self, food_item):
+        return ([food_item.get('Name', '').strip(), self._number(food_item.get('Amount'))]
+                + [self._number(food_item.get(name)) for name in self.nutrients])
+
+    def _row_params(self, headers, values):
+        """Map a plan row (headers with unit suffixes) onto name, amount and nutrient columns."""
+        by_name = {}
+        for header, value in zip(headers, values):
+            by_name[split_header_unit(header)[0]] = value
+        name = by_name.get('Name')
+        name = "" if name is None or (isinstance(name, float) and name != name) else str(name)
+        return [name, self._number(by_name.get('Amount'))] + [self._number(by_name.get(n)) for n in self.nutrients]
+
+    def _plan_id(self, plan_name):
+        row = self.conn.execute("SELECT id FROM plans WHERE name = ?", (plan_name,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown plan: {plan_name}")
+        return row[0]
+
+    # --- Foods ---
+
+    def load_food_items(self):
+        fieldnames = ['Name', 'Amount'] + self.nutrients
+        return [{field: (row[0] if i == 0 else self._text(row[i])) for i, field in enumerate(fieldnames)}
+                for row in self.conn.execute(self._select_foods_sql)]
+
+    def food_names(self):
+        return [row[0] for row in self.conn.execute("SELECT name FROM foods")]
+
+    def add_food_items(self, food_items):
+        """Insert foods whose names are not in the store yet; returns how many were added."""
+        with self.conn:
+            return self.conn.executemany(self._insert_food_sql,
+                                         (self._food_params(item) for item in food_items)).rowcount
+
+    def replace_food_items(self, food_items):
+        with self.conn:
+            self.conn.execute("DELETE FROM foods")
+            self.conn.executemany(self._insert_food_sql, (self._food_params(item) for item in food_items))
+
+    def delete_food_item(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM foods WHERE name = ?", (name,))
+
+    # --- Plans ---
+
+    def list_plans(self):
+        return [row[0] for row in self.conn.execute("SELECT name FROM plans ORDER BY name")]
+
+    def has_plan(self, plan_name):
+        return self.conn.execute("SELECT 1 FROM plans WHERE name = ?", (plan_name,)).fetchone() is not None
+
+    def plan_headers(self):
+        return ['Name', 'Amount'] + [f"{name} ({self.units[name]})" if self.units.get(name) else name
+                                     for name in self.nutrients]
+
+    def get_plan(self, plan_name):
+        """Return a plan as a DataFrame shaped like its CSV (Recommended row first)."""
+        plan_id = self._plan_id(plan_name)
+        targets = self.conn.execute(self._select_targets_sql, (plan_id,)).fetchone()
+        rows = [[RECOMMENDED_LABEL, None] + list(targets)]
+        rows.extend(list(row) for row in self.conn.execute(self._select_rows_sql, (plan_id,)))
+        return pd.DataFrame(rows, columns=self.plan_headers())
+
+    def save_plan(self, plan_name, plan_df):
+        """Replace a plan's targets and rows from a DataFrame shaped like the plan CSV."""
+        headers = list(plan_df.columns)
+        data = plan_df.values.tolist()
+        targets = self._row_params(headers, data[0])[2:] if data else [None] * len(self.nutrients)
+        with self.conn:
+            self.conn.execute("DELETE FROM plans WHERE name = ?", (plan_name,))
+            plan_id = self.conn.execute(self._insert_plan_sql, [plan_name] + targets).lastrowid
+            self.conn.executemany(self._insert_row_sql,
+                                  ([plan_id, position] + self._row_params(headers, values)
+                                   for position, values in enumerate(data[1:], start=1)))
+
+    def set_plan_targets(self, updates):
+        """Overwrite Recommended targets for many plans in one transaction.
+
+        updates holds (plan_name, values) with values aligned to self.nutrients;
+        None keeps the current target.
+        """
+        assignments = ", ".join(f'"{name}" = COALESCE(?, "{name}")' for name in self.nutrients)
+        with self.conn:
+            self.conn.executemany(f"UPDATE plans SET {assignments} WHERE name = ?",
+                                  (list(values) + [plan_name] for plan_name, values in updates))
+
+    def delete_plan(self, plan_name):
+        with self.conn:
+            self.conn.execute("DELETE FROM plans WHERE name = ?", (plan_name,))
+
+    def insert_plan_row(self, plan_name, position, headers, values):
+        """Insert a food row at position (1 = first food row), shifting later rows down."""
+        plan_id = self._plan_id(plan_name)
+        with self.conn:
+            self.conn.execute("UPDATE plan_rows SET position = position + 1 WHERE plan_id = ? AND position >= ?",
+                              (plan_id, position))
+            self.conn.execute(self._insert_row_sql, [plan_id, position] + self._row_params(headers, values))
+
+    def insert_plan_rows(self, plan_name, position, headers, rows):
+        """Insert several consecutive food rows starting at position in one transaction."""
+        plan_id = self._plan_id(plan_name)
+        with self.conn:
+            self.conn.execute("UPDATE plan_rows SET position = position + ? WHERE plan_id = ? AND position >= ?",
+                              (len(rows), plan_id, position))
+            self.conn.executemany(self._insert_row_sql,
+                                  ([plan_id, position + k] + self._row_params(headers, values)
+                                   for k, values in enumerate(rows)))
+
+    def update_plan_row(self, plan_name, position, headers, values):
+        plan_id = self._plan_id(plan_name)
+        with self.conn:
+            self.conn.execute(self._update_row_sql, self._row_params(headers, values) + [plan_id, position])
+
+    def update_plan_rows(self, plan_name, headers, rows):
+        """Update several food rows, given as (position, values) pairs, in one transaction."""
+        plan_id = self._plan_id(plan_name)
+        with self.conn:
+            self.conn.executemany(self._update_row_sql, (self._row_params(headers, values) + [plan_id, position]
+                                                         for position, values in rows))
+
+    def delete_plan_row(self, plan_name, position):
+        plan_id = self._plan_id(plan_name)
+        with self.conn:
+            self.conn.execute("DELETE FROM plan_rows WHERE plan_id = ? AND position = ?", (plan_id, position))
+            self.conn.execute("UPDATE plan_rows SET position = position - 1 WHERE plan_id = ? AND position > ?",
+                              (plan_id, position))
+
+    def plan_totals(self, plan_names=None):
+        """Return (totals, recommended) DataFrames indexed by plan name, summed in SQL."""
+        headers = self.plan_headers()[2:]
+        sums = self.conn.execute(self._totals_sql).fetchall()
+        totals = pd.DataFrame([row[1:] for row in sums], index=[row[0] for row in sums], columns=headers)
+        targets = self.conn.execute(self._all_targets_sql).fetchall()
+        recommended = pd.DataFrame([row[1:] for row in targets], index=[row[0] for row in targets], columns=headers)
+        if plan_names is not None:
+            totals, recommended = totals.reindex(plan_names), recommended.reindex(plan_names)
+        return totals.astype(float), recommended.astype(float)
+
+    # --- CSV import/export ---
+
+    def data_version(self):
+        """Stamp that moves whenever this or another connection writes, for cheap staleness checks."""
+        return self.conn.total_changes, self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def is_empty(self):
+        return (self.conn.execute("SELECT COUNT(*) FROM foods").fetchone()[0] == 0
+                and self.conn.execute("SELECT COUNT(*) FROM plans").fetchone()[0] == 0)
+
+    def import_csv(self, food_csv, plans_dir):
+        """Load the food store CSV and every plan CSV into the database."""
+        if os.path.exists(food_csv):
+            self.add_food_items(read_food_items(food_csv))
+        if os.path.isdir(plans_dir):
+            for filename in sorted(os.listdir(plans_dir)):
+                if filename.endswith(".csv"):
+                    plan_df = normalize_units(read_plan_csv(os.path.join(plans_dir, filename))[0])
+                    self.save_plan(os.path.splitext(filename)[0], plan_df)
+
+    def export_csv(self, food_csv, plans_dir):
+        """Write the database back out as a food store CSV and one CSV per plan."""
+        with file_lock(food_csv), open(food_csv, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=['Name', 'Amount'] + self.nutrients)
+            writer.writeheader()
+            writer.writerows(self.load_food_items())
+        os.makedirs(plans_dir, exist_ok=True)
+        for plan_name in self.list_plans():
+            plan_path = os.path.join(plans_dir, f"{plan_name}.csv")
+            with file_lock(plan_path):
+                write_plan_csv(plan_path, self.get_plan(plan_name), read_plan_version(plan_path) + 1)
+
+
+class PlanModel:
+    """Numeric state of an open plan with a bounded undo/redo command log.
+
+    Every food row gets a stable ID when it is added. Row data lives in slots
+    of preallocated arrays, found through a compact ID -> slot index, so adds,
+    deletes and amount changes never renumber other rows; freed slots are
+    reused. order holds the row IDs in sheet order, with an ID -> position
+    index so rows are found by ID in O(1); an insert or delete mid-plan only
+    marks the positions after it stale, and they are refreshed in one pass
+    on the next lookup that needs them. Totals are maintained
+    incrementally, so an edit, undo or redo costs O(columns). Commands are
+    compact tuples: ('amount', row_id, old, new), ('add', row_id, position,
+    food_item, amount), ('delete', row_id, position, food_item, amount) and
+    ('batch', [commands]).
+    """
+
+    HISTORY_LIMIT = 500
+
+    def __init__(self, nutrient_count, capacity=16):
+        self.order = []
+        self._positions = {}  # Row ID -> index in order; entries from _positions_valid on may be stale
+        self._positions_valid = 0
+        self.slot_of = {}
+        self.food_items = [None] * capacity
+        self.vectors = np.zeros((capacity, nutrient_count))
+        self.slot_amounts = np.zeros(capacity)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.next_id = 1
+        self.totals = np.zeros(nutrient_count)
+        self.amount_total = 0.0
+        self.undo_stack = collections.deque(maxlen=self.HISTORY_LIMIT)
+        self.redo_stack = collections.deque(maxlen=self.HISTORY_LIMIT)
+
+    def __len__(self):
+        return len(self.order)
+
+    def _take_slot(self):
+        if not self.free_slots:
+            capacity = len(self.slot_amounts)
+            self.vectors = np.vstack([self.vectors, np.zeros_like(self.vectors)])
+            self.slot_amounts = np.concatenate([self.slot_amounts, np.zeros(capacity)])
+            self.food_items.extend([None] * capacity)
+            self.free_slots = list(range(2 * capacity - 1, capacity - 1, -1))
+        return self.free_slots.pop()
+
+    def add_row(self, food_item, per_serving, amount, position=None, row_id=None):
+        """Add a row (appended unless position is given) and return its ID; undo passes the old ID back."""
+        if row_id is None:
+            row_id = self.next_id
+            self.next_id += 1
+        slot = self._take_slot()
+        self.slot_of[row_id] = slot
+        self.food_items[slot] = food_item
+        self.vectors[slot] = per_serving
+        self.slot_amounts[slot] = amount
+        if position is None or position >= len(self.order):
+            if self._positions_valid == len(self.order):
+                self._positions[row_id] = len(self.order)
+                self._positions_valid += 1
+            self.order.append(row_id)
+        else:
+            self.order.insert(position, row_id)
+            self._positions_valid = min(self._positions_valid, position)
+        self.totals += self.vectors[slot] * amount
+        self.amount_total += amount
+        return row_id
+
+    def load_rows(self, food_items, vectors, amounts):
+        """Append many rows at once (opening a plan): one array assignment and one matrix product."""
+        slots = [self._take_slot() for _ in food_items]
+        row_ids = list(range(self.next_id, self.next_id + len(slots)))
+        self.next_id += len(slots)
+        self.slot_of.update(zip(row_ids, slots))
+        for slot, food_item in zip(slots, food_items):
+            self.food_items[slot] = food_item
+        self.vectors[slots] = vectors
+        self.slot_amounts[slots] = amounts
+        self.order.extend(row_ids)
+        self.totals += np.asarray(amounts, dtype=float) @ np.asarray(vectors, dtype=float)
+        self.amount_total += float(np.sum(amounts))
+        return row_ids
+
+    def rename(self, row_id, name):
+        slot = self.slot_of[row_id]
+        self.food_items[slot] = {**self.food_items[slot], 'Name': name}
+
+    def remove_row(self, row_id):
+        """Remove a row and return its (position, food_item, amount)."""
+        position = self.position(row_id)
+        del self.order[position]
+        del self._positions[row_id]
+        self._positions_valid = min(self._positions_valid, position)
+        slot = self.slot_of.pop(row_id)
+        food_item, amount = self.food_items[slot], float(self.slot_amounts[slot])
+        self.totals -= self.vectors[slot] * amount
+        self.amount_total -= amount
+        self.food_items[slot] = None
+        self.free_slots.append(slot)
+        return position, food_item, amount
+
+    def set_amount(self, row_id, amount):
+        """Change one row's amount and return the previous amount."""
+        slot = self.slot_of[row_id]
+        old_amount = float(self.slot_amounts[slot])
+        self.totals += self.vectors[slot] * (amount - old_amount)
+        self.amount_total += amount - old_amount
+        self.slot_amounts[slot] = amount
+        return old_amount
+
+    def row_id_at(self, position):
+        return self.order[position]
+
+    def position(self, row_id):
+        position = self._positions.get(row_id)
+        if position is None or position >= self._positions_valid:
+            if row_id not in self.slot_of:
+                raise ValueError(f"Unknown plan row: {row_id}")
+            for position in range(self._positions_valid, len(self.order)):
+                self._positions[self.order[position]] = position
+            self._positions_valid = len(self.order)
+            position = self._positions[row_id]
+        return position
+
+    def food_item(self, row_id):
+        return self.food_items[self.slot_of[row_id]]
+
+    def amount(self, row_id):
+        return float(self.slot_amounts[self.slot_of[row_id]])
+
+    def per_serving(self, row_id):
+        return self.vectors[self.slot_of[row_id]]
+
+    def matrix(self):
+        """Per-serving vectors of all rows in sheet order."""
+        return self.vectors[[self.slot_of[row_id] for row_id in self.order]]
+
+    def amounts(self):
+        """Amounts of all rows in sheet order."""
+        return self.slot_amounts[[self.slot_of[row_id] for row_id in self.order]]
+
+    def scenarios(self):
+        """A PlanScenarios set whose first variant is the plan as it stands now."""
+        return PlanScenarios(self.matrix(), self.amounts())
+
+    def record(self, command):
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+
+    def pop_undo(self):
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        self.redo_stack.append(command)
+        return command
+
+    def pop_redo(self):
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        self.undo_stack.append(command)
+        return command
+
+
+class PlanScenarios:
+    """What-if variants of one plan, evaluated together.
+
+    Variant v has servings amounts[v] (foods) and the plan's per-serving
+    vectors (foods x nutrients), except that a swap variant replaces one row's
+    vector. Totals come from one (variants x foods) @ (foods x nutrients)
+    product per block plus a rank-one correction for swapped rows, so no
+    (variants x foods x nutrients) array is built. Variant 0 is the base plan
+    and diffs are against it. Totals are computed lazily on first evaluation.
+    """
+
+    def __init__(self, vectors, amounts, name="Current"):
+        self.base_vectors = np.asarray(vectors, dtype=float)
+        self.base_amounts = np.asarray(amounts, dtype=float)
+        self.names = []
+        self._blocks = []
+        self._totals = None
+        self.add([name], self.base_amounts[None])
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, names, amounts, swap=None):
+        """Add len(names) variants with (k x foods) amounts.
+
+        swap is None for the base foods, or (position, per_serving) giving each
+        variant's (k x nutrients) vector for the row at position.
+        """
+        self.names.extend(names)
+        self._blocks.append((np.asarray(amounts, dtype=float), swap))
+        self._totals = None
+
+    def scale(self, factor):
+        """Variant with every serving multiplied by factor."""
+        self.add([f"Servings x{factor:g}"], self.base_amounts[None] * factor)
+
+    def set_amount(self, position, amount):
+        """Variant with one row's servings changed."""
+        amounts = self.base_amounts.copy()
+        amounts[position] = amount
+        self.add([f"Item {position + 1} = {amount:g}"], amounts[None])
+
+    def swap(self, position, names, per_serving, amount=None):
+        """One variant per candidate food replacing the row at position.
+
+        per_serving is (candidates x nutrients); the row keeps its servings
+        unless amount is given.
+        """
+        per_serving = np.atleast_2d(np.asarray(per_serving, dtype=float))
+        amounts = np.broadcast_to(self.base_amounts, (len(per_serving), len(self.base_amounts)))
+        if amount is not None:
+            amounts = amounts.copy()
+            amounts[:, position] = amount
+        self.add([f"Item {position + 1} -> {name}" for name in names], amounts, (position, per_serving))
+
+    def totals(self):
+        """(variants x nutrients) nutrient totals."""
+        if self._totals is None:
+            blocks = []
+            for amounts, swap in self._blocks:
+                totals = amounts @ self.base_vectors
+                if swap is not None:
+                    position, per_serving = swap
+                    totals += amounts[:, position, None] * (per_serving - self.base_vectors[position])
+                blocks.append(totals)
+            self._totals = np.concatenate(blocks)
+        return self._totals
+
+    def evaluate(self, recommended, modes):
+        """Totals, their difference from the base plan and nutrient_status_codes for all variants."""
+        totals = self.totals()
+        return totals, totals - totals[0], nutrient_status_codes(modes, recommended, totals)
+
+
+def open_configured_store(csv_file, plans_dir, check_same_thread=True):
+    """Open the SQLite store when GURGENDIET_STORAGE=sqlite, importing the CSVs into a new database.
+
+    Returns None for the default CSV storage.
+    """
+    if os.environ.get("GURGENDIET_STORAGE", "").lower() != "sqlite":
+        return None
+    db = SQLiteStore(os.path.join(get_base_path(), "data", "gurgen.db"), check_same_thread=check_same_thread)
+    if db.is_empty():
+        db.import_csv(csv_file, plans_dir)
+    return db
+
+
+def _json_value(value):
+    """Make a DataFrame cell JSON-safe (numpy scalars to Python, NaN to null)."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    return None if isinstance(value, float) and value != value else value
+
+
+class PlanVersionConflict(Exception):
+    """An edit was based on an older plan version than the one on disk."""
+
+    def __init__(self, version):
+        super().__init__(f"Plan was changed elsewhere (now at version {version})")
+        self.version = version
+
+
+class PlanService:
+    """Headless plan engine behind the --serve HTTP API.
+
+    The food store stays loaded and name-indexed in memory and is reloaded only
+    when its file or database changes. Plan and totals responses are cached per
+    plan version, so reads of an unchanged plan skip the parse entirely. One
+    lock guards all state; requests arrive on the server's worker threads.
+    """
+
+    def __init__(self, csv_file, plans_dir, db=None):
+        self.csv_file = csv_file
+        self.plans_dir = plans_dir
+        self.db = db
+        self.lock = threading.Lock()
+        self.food_items = []
+        self._folded_names = []
+        self._foods_by_name = {}
+        self._food_stamp = None
+        self._responses = {}
+
+    # --- food store ---
+
+    def _food_data_stamp(self):
+        if self.db:
+            return self.db.data_version()
+        try:
+            stat = os.stat(self.csv_file)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _foods(self):
+        stamp = self._food_data_stamp()
+        if stamp != self._food_stamp or not self.food_items:
+            if self.db:
+                self.food_items = self.db.load_food_items()
+            else:
+                self.food_items = read_food_items(self.csv_file) if os.path.exists(self.csv_file) else []
+            self._folded_names = [item.get('Name', '').strip().casefold() for item in self.food_items]
+            self._foods_by_name = dict(zip(self._folded_names, self.food_items))
+            self._food_stamp = stamp
+        return self.food_items
+
+    def list_foods(self, limit=None):
+        with self.lock:
+            return self._foods()[:limit]
+
+    def search_foods(self, query, limit=50):
+        """Foods whose name contains query (case-insensitive), in store order."""
+        folded_query = query.strip().casefold()
+        with self.lock:
+            foods = self._foods()
+            matches = (item for item, name in zip(foods, self._folded_names) if folded_query in name)
+            return list(itertools.islice(matches, limit))
+
+    # --- plans ---
+
+    def list_plans(self):
+        with self.lock:
+            if self.db:
+                return self.db.list_plans()
+            return sorted(os.path.splitext(name)[0] for name in os.listdir(self.plans_dir) if name.endswith(".csv"))
+
+    def list_archived(self):
+        """Archived plans with their dates and totals, from the archive index alone."""
+        with self.lock:
+            if not hasattr(self, '_archive'):
+                self._archive = PlanArchive(self.plans_dir)
+            return dict(self._archive.entries())
+
+    def _plan_path(self, name):
+        if not name or name != os.path.basename(name) or name.startswith("."):
+            raise KeyError(f"Unknown plan: {name}")
+        return os.path.join(self.plans_dir, f"{name}.csv")
+
+    def _plan_stamp(self, name):
+        if self.db:
+            if not self.db.has_plan(name):
+                raise KeyError(f"Unknown plan: {name}")
+            return self.db.data_version()
+        path = self._plan_path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise KeyError(f"Unknown plan: {name}") from None
+        return (read_plan_version(path), stat.st_mtime_ns, stat.st_size)
+
+    def _read_plan(self, name):
+        if self.db:
+            return self.db.get_plan(name), None
+        plan_df, version = read_plan_csv(self._plan_path(name))
+        return normalize_units(plan_df), version
+
+    def _cached(self, kind, name, build):
+        stamp = self._plan_stamp(name)
+        cached = self._responses.get((kind, name))
+        if cached and cached[0] == stamp:
+            return cached[1]
+        response = build(name)
+        self._responses[(kind, name)] = (stamp, response)
+        return response
+
+    def get_plan(self, name):
+        """Plan rows as JSON-ready dicts; the Recommended row is returned separately."""
+        with self.lock:
+            return self._cached('plan', name, self._plan_response)
+
+    def _plan_response(self, name):
+        plan_df, version = self._read_plan(name)
+        records = [{header: _json_value(value) for header, value in row.items()}
+                   for row in plan_df.to_dict(orient='records')]
+        return {"name": name, "version": version, "headers": list(plan_df.columns),
+                "recommended": records[0] if records else {}, "rows": records[1:]}
+
+    def plan_totals(self, name):
+        """Totals, Recommended targets and color status per nutrient."""
+        with self.lock:
+            return self._cached('totals', name, self._totals_response)
+
+    def _totals_response(self, name):
+        plan_df, version = self._read_plan(name)
+        nutrient_headers = [header for header in plan_df.columns if header not in ('Name', 'Amount')]
+        values = plan_df[nutrient_headers].apply(pd.to_numeric, errors='coerce')
+        recommended = values.iloc[0] if len(values) else pd.Series(np.nan, index=nutrient_headers)
+        totals = values.iloc[1:].sum(axis=0, min_count=0)
+        amounts = pd.to_numeric(plan_df['Amount'].iloc[1:], errors='coerce') if 'Amount' in plan_df else pd.Series()
+        modes = load_nutrient_modes(plan_df.columns)
+        nutrients = {}
+        for header in nutrient_headers:
+            target, total = _json_value(recommended[header]), _json_value(totals[header])
+            nutrients[header] = {
+                "recommended": target, "total": total, "mode": modes.get(header, 'irrelevant'),
+                "status": nutrient_status(modes.get(header, 'irrelevant'), target or 0.0, total or 0.0)}
+        return {"name": name, "version": version, "rows": len(plan_df) - 1 if len(plan_df) else 0,
+                "amount": _json_value(amounts.sum()), "nutrients": nutrients}
+
+    def set_amount(self, name, row, amount, expected_version=None):
+        """Rescale food row `row` (0-based, below the Recommended row) to `amount` servings.
+
+        Per-serving values come from the food store entry with the same name,
+        falling back to the row itself. With expected_version, the edit is
+        refused if the plan was saved elsewhere in the meantime; the database
+        keeps no plan versions, so SQLite storage rejects it. Returns the new
+        totals.
+        """
+        if amount < 0:
+            raise ValueError("amount must not be negative")
+        with self.lock:
+            if self.db:
+                if expected_version is not None:
+                    raise ValueError("Plan versions are only kept with CSV storage; omit 'version'")
+                plan_df = self.db.get_plan(name)
+                plan_df = self._rescale_row(plan_df, row, amount)
+                self.db.update_plan_row(name, row + 1, list(plan_df.columns), plan_df.iloc[row + 1].tolist())
+            else:
+                path = self._plan_path(name)
+                if not os.path.exists(path):
+                    raise KeyError(f"Unknown plan: {name}")
+                with file_lock(path):
+                    plan_df, version = read_plan_csv(path)
+                    if expected_version is not None and expected_version != version:
+                        raise PlanVersionConflict(version)
+                    plan_df = self._rescale_row(normalize_units(plan_df), row, amount)
+                    write_plan_csv(path, plan_df, version + 1)
+            return self._cached('totals', name, self._totals_response)
+
+    def _rescale_row(self, plan_df, row, amount):
+        if not 0 <= row < len(plan_df) - 1:
+            raise KeyError(f"No food row {row}")
+        label = plan_df.index[row + 1]
+        nutrient_headers = [header for header in plan_df.columns if header not in ('Name', 'Amount')]
+        self._foods()
+        food_item = self._foods_by_name.get(str(plan_df.at[label, 'Name']).strip().casefold())
+        if food_item is not None:
+            per_serving = food_matrix([food_item], nutrient_headers)[0]
+        else:
+            old_amount = pd.to_numeric(pd.Series([plan_df.at[label, 'Amount']]), errors='coerce').fillna(0).iloc[0]
+            values = plan_df.loc[label, nutrient_headers].apply(pd.to_numeric, errors='coerce').fillna(0)
+            per_serving = values.to_numpy(dtype=float) / old_amount if old_amount > 0 else np.zeros(len(nutrient_headers))
+        plan_df = plan_df.copy()
+        plan_df['Amount'] = pd.to_numeric(plan_df['Amount'], errors='coerce')
+        plan_df.loc[label, 'Amount'] = float(amount)
+        plan_df.loc[label, nutrient_headers] = per_serving * amount
+        return plan_df
+
+
+def make_api_handler(service):
+    """Build the request handler class for a PlanService.
+
+    GET  /foods?limit=N              all foods (optionally the first N)
+    GET  /foods/search?q=..&limit=N  foods whose name contains q
+    GET  /plans                      plan names
+    GET  /plans/<name>               plan rows and version
+    GET  /plans/<name>/totals        totals, targets and color status
+    POST /plans/<name>/amount        {"row": i, "amount": x, "version": v?} -> new totals
+    """
+
+    class PlanAPIHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def _dispatch(self, method):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [urllib.parse.unquote(part) for part in url.path.split("/") if part]
+            query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+            try:
+                if method == "GET" and parts == ["foods"]:
+                    limit = int(query["limit"]) if "limit" in query else None
+                    body = {"foods": service.list_foods(limit)}
+                elif method == "GET" and parts == ["foods", "search"]:
+                    body = {"foods": service.search_foods(query.get("q", ""), int(query.get("limit", 50)))}
+                elif method == "GET" and parts == ["plans"]:
+                    body = {"plans": service.list_plans()}
+                elif method == "GET" and parts == ["archive"]:
+                    body = {"plans": service.list_archived()}
+                elif method == "GET" and len(parts) == 2 and parts[0] == "plans":
+                    body = service.get_plan(parts[1])
+                elif method == "GET" and len(parts) == 3 and parts[0] == "plans" and parts[2] == "totals":
+                    body = service.plan_totals(parts[1])
+                elif method == "POST" and len(parts) == 3 and parts[0] == "plans" and parts[2] == "amount":
+                    payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    missing = [field for field in ("row", "amount") if field not in payload]
+                    if missing:
+                        raise ValueError(f"Missing field: {missing[0]}")
+                    body = service.set_amount(parts[1], int(payload["row"]), float(payload["amount"]),
+                                              payload.get("version"))
+                else:
+                    self._send(404, {"error": "Not found"})
+                    return
+            except KeyError as e:
+                self._send(404, {"error": e.args[0]})
+            except (ValueError, TypeError) as e:
+                self._send(400, {"error": str(e)})
+            except PlanVersionConflict as e:
+                self._send(409, {"error": str(e), "version": e.version})
+            except TimeoutError as e:
+                self._send(503, {"error": str(e)})
+            else:
+                self._send(200, body)
+
+        def _send(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return PlanAPIHandler
+
+
+def serve(host="127.0.0.1", port=8765):
+    """Run the plan JSON API on a threaded stdlib server until interrupted; no Tk window is created."""
+    csv_file = os.path.join(get_base_path(), "data", "food_items.csv")
+    plans_dir = "plans"
+    os.makedirs(plans_dir, exist_ok=True)
+    service = PlanService(csv_file, plans_dir, open_configured_store(csv_file, plans_dir, check_same_thread=False))
+    service.list_foods(0)  # Warm the food store before the first request
+    server = ThreadingHTTPServer((host, port), make_api_handler(service))
+    print(f"Serving the plan API on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class IOExecutor:
+    """Runs the GUI's file operations on one background thread.
+
+    Jobs run one at a time in submission order, so a read queued after a save
+    sees the saved file. Finished jobs are collected with widget.after() and
+    their callback (or errback) runs on the Tk thread, where it may touch
+    widgets. on_status is called with the status text of the oldest pending
+    job ("" when idle); a status may be a function returning the text, for
+    jobs that report progress. With inline=True jobs run immediately instead,
+    for storage whose connection belongs to the Tk thread (SQLite).
+    shutdown() finishes everything still pending when the app closes.
+    """
+
+    def __init__(self, widget, inline=False, on_status=None):
+        self.widget = widget
+        self.inline = inline
+        self.on_status = on_status
+        self.pending = collections.deque()  # (future, callback, errback, status)
+        self._poll_job = None
+        self._pool = None if inline else concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+
+    def submit(self, func, *args, callback=None, errback=None, status=""):
+        """Run func(*args) off the Tk thread, then callback(result) or errback(exception) on it."""
+        if self.inline:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            self._finish(future, callback, errback)
+            return future
+        future = self._pool.submit(func, *args)
+        self.pending.append((future, callback, errback, status))
+        if self._poll_job is None:
+            self._poll_job = self.widget.after(IO_POLL_MS, self._poll)
+        self._report()
+        return future
+
+    def wait(self, future):
+        """Block until future's job is done, running its callback and those of the jobs queued before it."""
+        while any(job[0] is future for job in self.pending):
+            job_future, callback, errback, _ = self.pending.popleft()
+            concurrent.futures.wait([job_future])
+            self._finish(job_future, callback, errback)
+        self._report()
+
+    def shutdown(self):
+        """Wait for every pending job and run its callback, including jobs those callbacks queue, then stop the worker."""
+        while self.pending:
+            future, callback, errback, _ = self.pending.popleft()
+            concurrent.futures.wait([future])
+            self._finish(future, callback, errback)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def _poll(self):
+        # The single worker finishes jobs in order, so done jobs are always at the front
+        self._poll_job = None
+        while self.pending and self.pending[0][0].done():
+            future, callback, errback, _ = self.pending.popleft()
+            self._finish(future, callback, errback)
+        if self.pending and self._poll_job is None:
+            self._poll_job = self.widget.after(IO_POLL_MS, self._poll)
+        self._report()
+
+    def _finish(self, future, callback, errback):
+        error = future.exception()
+        try:
+            if error is None:
+                if callback:
+                    callback(future.result())
+            elif errback:
+                errback(error)
+            else:
+                print(f"Warning: Background file operation failed: {error}")
+        except Exception as e:
+            # A failing callback must not stop the remaining jobs from being collected
+            print(f"Warning: Could not handle background file operation result: {e}")
+
+    def _report(self):
+        if self.on_status:
+            status = next((status for _, _, _, status in self.pending if status), "")
+            self.on_status(status() if callable(status) else status)
+
+
 class App(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -85,14 +2665,45 @@ class App(tk.Tk):
         if not os.path.exists(self.plans_dir):
             os.makedirs(self.plans_dir)
 
+        # Optional SQLite storage (GURGENDIET_STORAGE=sqlite); CSV files stay the default.
+        # Existing CSVs are imported the first time the database is created. Like the
+        # files, the database is only used from the I/O thread below.
+        self.db = open_configured_store(self.csv_file, self.plans_dir, check_same_thread=False)
+
+        # Screens built once and kept hidden between visits, in LRU order
+        self.views = collections.OrderedDict()
+        self._food_list_stamp = None
+
         # Dialog management - prevent duplicate dialogs
         self._dialog_lock = False
         self._last_dialog_time = 0
 
-        # Load existing food items and plans from CSV
-        self.food_items = self.load_food_items()
+        # File access runs on one background thread; the status bar shows what is still pending
+        self.status_label = ttk.Label(self, anchor="w")
+        self.status_label.pack(side="bottom", fill="x", padx=20)
+        self.io = IOExecutor(self, on_status=lambda text: self.status_label.config(text=text))
+        self._screen_request = None
+
+        # Version of the open plan as last read or written by us; see save_plan_data
+        self.plan_version = 0
+        self.pending_plan_saves = {}
+        self.pending_food_saves = {}
+
+        # Load existing food items and plans in the background; their screens fill in when they arrive
+        self.plans = []
+        self.food_generation = 0
+        self._food_file_stamp = None
+        self._initial_food_load = self.reload_food_items()
         self.load_plans()
 
+        # Poll the plan and food files for changes saved from other machines (CSV storage only)
+        if not self.db:
+            self.file_stamps = None
+            self.poll_files()
+
+        # Pending saves are finished before the window goes away
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
         # Main menu frame
         self.menu_frame = ttk.Frame(self)
         self.menu_frame.pack(expand=True)
@@ -121,10 +2732,10 @@ class App(tk.Tk):
         self.main_frame.pack(fill="both", expand=True, padx=20, pady=10)
 
     def show_plans(self):
-        self.hide_menu()
-        self.clear_main_frame()
+        self.show_view("plans", self._build_plans_view, self.refresh_plans_list)
 
-        header_frame = ttk.Frame(self.main_frame)
+    def _build_plans_view(self, frame):
+        header_frame = ttk.Frame(frame)
         header_frame.pack(fill="x", pady=10)
 
         title_label = ttk.Label(header_frame, text="Plans", font=('Helvetica', 18, 'bold'))
@@ -133,10 +2744,16 @@ class App(tk.Tk):
         new_button = ttk.Button(header_frame, text="New Plan", command=self.show_new_plan)
         new_button.pack(side="right")
 
+        week_button = ttk.Button(header_frame, text="Week View", command=self.show_week_view)
+        week_button.pack(side="right", padx=(0, 10))
+
+        archived_button = ttk.Button(header_frame, text="Archived", command=self.show_archived_plans)
+        archived_button.pack(side="right", padx=(0, 10))
+
         back_button = ttk.Button(header_frame, text="Back", command=self.show_menu)
         back_button.pack(side="right", padx=(0, 10))
 
-        list_frame = ttk.Frame(self.main_frame)
+        list_frame = ttk.Frame(frame)
         list_frame.pack(fill="both", expand=True)
 
         # Plans will be displayed as buttons
@@ -146,11 +2763,11 @@ class App(tk.Tk):
         self.refresh_plans_list()
 
     def show_food_items(self):
-        self.hide_menu()
-        self.clear_main_frame()
-        
+        self.show_view("food_items", self._build_food_items_view, self.refresh_food_list_if_stale)
+
+    def _build_food_items_view(self, frame):
         # Food Items page header
-        header_frame = ttk.Frame(self.main_frame)
+        header_frame = ttk.Frame(frame)
         header_frame.pack(fill="x", pady=10)
         
         title_label = ttk.Label(header_frame, text="Food Items", font=('Helvetica', 18, 'bold'))
@@ -159,35 +2776,32 @@ class App(tk.Tk):
         new_button = ttk.Button(header_frame, text="New", command=self.show_new_food_item)
         new_button.pack(side="right")
         
+        import_button = ttk.Button(header_frame, text="Import", command=self.import_food_items)
+        import_button.pack(side="right", padx=(0, 10))
+        
         delete_button = ttk.Button(header_frame, text="Delete", command=self.delete_selected_food_item)
         delete_button.pack(side="right", padx=(0, 10))
+
+        analytics_button = ttk.Button(header_frame, text="Analytics", command=self.show_food_analytics)
+        analytics_button.pack(side="right", padx=(0, 10))
         
         back_button = ttk.Button(header_frame, text="Back", command=self.show_menu)
         back_button.pack(side="right", padx=(0, 10))
         
         # Food items list
-        list_frame = ttk.Frame(self.main_frame)
+        list_frame = ttk.Frame(frame)
         list_frame.pack(fill="both", expand=True)
         
         # Create Treeview for food items list (show all fields)
-        self.display_columns = [
-            "Name", "Amount", "Calories / Energy", "Protein", "Total Fat",
-            "Saturated Fat", "Monounsaturated Fat", "Polyunsaturated Fat",
-            "Trans Fat", "Cholesterol", "Carbohydrates", "Dietary Fiber",
-            "Soluble Fiber", "Insoluble Fiber", "Total Sugars", "Added Sugars",
-            "Sodium", "Potassium", "Calcium", "Iron", "Magnesium", "Zinc",
-            "Phosphorus", "Iodine", "Vitamin A", "Vitamin C", "Vitamin D",
-            "Vitamin E", "Vitamin K", "Vitamin B1 (Thiamine)", 
-            "Vitamin B2 (Riboflavin)", "Vitamin B3 (Niacin)", "Vitamin B6",
-            "Vitamin B9 (Folate)", "Vitamin B12", "Omega-3 Fatty Acids",
-            "Omega-6 Fatty Acids"
-        ]
+        schema = nutrient_schema()
+        self.display_columns = list(schema.food_fields)
 
         self.food_tree = ttk.Treeview(list_frame, columns=self.display_columns, show="headings", height=15)
 
         # Configure columns (narrower widths for many columns)
+        headings = ("Name", "Amount") + schema.display_names
         for i, col in enumerate(self.display_columns):
-            self.food_tree.heading(col, text=col)
+            self.food_tree.heading(col, text=headings[i])
             if i == 0:
                 self.food_tree.column(col, width=160, anchor='w')
             else:
@@ -248,11 +2862,17 @@ class App(tk.Tk):
         self.refresh_food_list()
 
     def show_new_food_item(self):
-        self.clear_main_frame()
-        
+        self.show_view("new_food_item", self._build_new_food_item_view, self.clear_food_entries)
+
+    def clear_food_entries(self):
+        """Reset the cached new-food form for the next entry."""
+        for entry in self.food_entries.values():
+            entry.delete(0, tk.END)
+
+    def _build_new_food_item_view(self, frame):
         # Create scrollable frame for the form
-        canvas = tk.Canvas(self.main_frame)
-        scrollbar = ttk.Scrollbar(self.main_frame, orient="vertical", command=canvas.yview)
+        canvas = tk.Canvas(frame)
+        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=canvas.yview)
         scrollable_frame = ttk.Frame(canvas)
         
         scrollable_frame.bind(
@@ -281,8 +2901,8 @@ class App(tk.Tk):
         # Form fields
         self.food_entries = {}
 
-        # Use shared nutrient fields
-        fields = NUTRIENT_FIELDS
+        # Use the schema's nutrient fields
+        fields = nutrient_schema().fields
 
         # Create form fields
         for field_name, unit in fields:
@@ -343,37 +2963,265 @@ class App(tk.Tk):
             return
             
         # Sanitize filename
-        safe_filename = "".join([c for c in plan_name if c.isalpha() or c.isdigit() or c.isspace()]).rstrip()
+        safe_filename = safe_plan_name(plan_name)
         plan_filepath = os.path.join(self.plans_dir, f"{safe_filename}.csv")
-        
-        if os.path.exists(plan_filepath):
-            messagebox.showerror('Error', f'A plan with the name "{plan_name}" already exists.')
-            return
 
-        try:
-            # Read the hardcoded rows from the template
-            template_path = os.path.join(get_base_path(), "templates", "plan_template.csv")
-            hardcoded_df = pd.read_csv(template_path)
-            
-            # Create a new DataFrame for the plan
-            plan_df = hardcoded_df.copy()
-            
-            # Save the new plan to its own CSV file
-            plan_df.to_csv(plan_filepath, index=False)
-            
+        def on_error(e):
+            if isinstance(e, FileExistsError):
+                messagebox.showerror('Error', f'A plan with the name "{plan_name}" already exists.')
+            else:
+                messagebox.showerror('Error', f'Failed to create plan: {e}')
+
+        def on_created(_):
             # No success popup - just reload and redirect
             self.load_plans() # Reload plans to include the new one
             self.show_plans()
-            
-        except Exception as e:
-            messagebox.showerror('Error', f'Failed to create plan: {e}')
+
+        self.io.submit(self.create_plan, safe_filename, plan_filepath, callback=on_created, errback=on_error,
+                       status=f"Creating {plan_name}...")
+
+    def create_plan(self, safe_filename, plan_filepath):
+        """Write a new plan from the template; runs on the I/O thread."""
+        if self.db.has_plan(safe_filename) if self.db else os.path.exists(plan_filepath):
+            raise FileExistsError(plan_filepath)
+
+        # Read the hardcoded rows from the template
+        template_path = os.path.join(get_base_path(), "templates", "plan_template.csv")
+        plan_df = pd.read_csv(template_path)
+
+        # Save the new plan to its own CSV file (or database row)
+        if self.db:
+            self.db.save_plan(safe_filename, normalize_units(plan_df))
+        else:
+            with file_lock(plan_filepath):
+                write_plan_csv(plan_filepath, plan_df, 1)
+
+    def show_week_view(self):
+        """Show per-day plan totals and rolling 7-day averages against the Recommended targets."""
+        self.hide_menu()
+        self.clear_main_frame()
+
+        header_frame = ttk.Frame(self.main_frame)
+        header_frame.pack(fill="x", pady=10)
+
+        title_label = ttk.Label(header_frame, text="Week View", font=('Helvetica', 18, 'bold'))
+        title_label.pack(side="left")
+
+        back_button = ttk.Button(header_frame, text="Back", command=self.show_plans)
+        back_button.pack(side="right")
+
+        # Plans are treated as consecutive days in name order; the selection narrows them down
+        plans = sorted(self.plans, key=lambda plan: plan['Name'])
+
+        body_frame = ttk.Frame(self.main_frame)
+        body_frame.pack(fill="both", expand=True)
+
+        days_listbox = tk.Listbox(body_frame, selectmode=tk.EXTENDED, exportselection=False,
+                                  width=24, font=('Helvetica', 11))
+        for plan in plans:
+            days_listbox.insert(tk.END, plan['Name'])
+        days_listbox.select_set(0, tk.END)
+        days_listbox.pack(side="left", fill="y", padx=(0, 10))
+
+        table_frame = ttk.Frame(body_frame)
+        table_frame.pack(side="left", fill="both", expand=True)
+
+        view_mode = tk.StringVar(value="rolling")
+        modes_frame = ttk.Frame(table_frame)
+        modes_frame.pack(fill="x")
+        for text, value in (("Daily Totals", "daily"), ("Rolling 7-Day Average", "rolling"),
+                            ("Rolling % of Recommended", "percent")):
+            ttk.Radiobutton(modes_frame, text=text, value=value, variable=view_mode,
+                            command=lambda: refresh()).pack(side="left", padx=(0, 10))
+
+        week_tree = ttk.Treeview(table_frame, show="headings", height=15)
+        hscrollbar = ttk.Scrollbar(table_frame, orient="horizontal", command=week_tree.xview)
+        week_tree.configure(xscrollcommand=hscrollbar.set)
+        week_tree.pack(fill="both", expand=True)
+        hscrollbar.pack(fill="x")
+
+        latest_request = [None]
+
+        def aggregate(selected):
+            if self.db:
+                # Totals come straight from SQL aggregates over the plan rows
+                totals, recommended = self.db.plan_totals([plan['Name'] for plan in selected])
+                return totals, totals.rolling(7, min_periods=1).mean(), recommended
+            return aggregate_days([plan['filepath'] for plan in selected])
+
+        def refresh():
+            selected = [plans[i] for i in days_listbox.curselection()]
+            week_tree.delete(*week_tree.get_children())
+            if not selected:
+                return
+            # Plans are read in the background; only the newest selection's result is shown
+            request = latest_request[0] = object()
+            self.io.submit(aggregate, selected, callback=lambda result: show(request, *result),
+                           errback=lambda e: messagebox.showerror("Error", f"Could not aggregate plans: {e}"),
+                           status="Reading plans...")
+
+        def show(request, totals, rolling, recommended):
+            if request is not latest_request[0] or not week_tree.winfo_exists():
+                return
+            if view_mode.get() == "daily":
+                table = totals
+            elif view_mode.get() == "rolling":
+                table = rolling
+            else:
+                table = (rolling / recommended.rolling(7, min_periods=1).mean() * 100).replace([np.inf, -np.inf], np.nan)
+
+            columns = ["Day"] + list(table.columns)
+            week_tree.configure(columns=columns)
+            for i, col in enumerate(columns):
+                week_tree.heading(col, text=col)
+                week_tree.column(col, width=160 if i == 0 else 110, anchor='w' if i == 0 else 'center')
+            for day, row in zip(table.index, table.to_numpy()):
+                week_tree.insert("", "end", values=[day] + ["" if np.isnan(v) else f"{v:.2f}" for v in row])
+            if view_mode.get() != "percent":
+                latest = recommended.iloc[-1].reindex(table.columns).to_numpy(dtype=float)
+                week_tree.insert("", "end", values=["Recommended"] + ["" if np.isnan(v) else f"{v:.2f}" for v in latest])
+
+        days_listbox.bind("<<ListboxSelect>>", lambda event: refresh())
+        refresh()
+
+    # Most foods listed on the analytics screen; the ranking itself covers the whole store
+    ANALYTICS_VIEW_LIMIT = 200
+
+    def get_food_analytics(self, callback):
+        """Pass the food store's FoodAnalytics to callback; the store is re-read in the background only when it changed."""
+        stamp = self.food_data_stamp()
+        analytics = getattr(self, '_food_analytics', None)
+        if analytics is not None and analytics.stamp == stamp:
+            callback(analytics)
+            return
+
+        def on_read(food_df):
+            self._food_analytics = FoodAnalytics(food_df, stamp=stamp)
+            callback(self._food_analytics)
+
+        self.io.submit(read_food_frame, self.csv_file, self.db, callback=on_read,
+                       errback=lambda e: messagebox.showerror("Error", f"Could not load food items: {e}"),
+                       status="Loading food items...")
+
+    def show_food_analytics(self):
+        """Rank every food by nutrient density per serving, per 100 kcal or per unit of price."""
+        self.get_food_analytics(self.when_current(self._show_food_analytics))
+
+    def _show_food_analytics(self, analytics):
+        self.hide_menu()
+        self.clear_main_frame()
+        schema = analytics.schema
+
+        header_frame = ttk.Frame(self.main_frame)
+        header_frame.pack(fill="x", pady=10)
+
+        title_label = ttk.Label(header_frame, text="Food Analytics", font=('Helvetica', 18, 'bold'))
+        title_label.pack(side="left")
+
+        back_button = ttk.Button(header_frame, text="Back", command=self.show_food_items)
+        back_button.pack(side="right")
+
+        bases = {"Per serving": 'serving', "Per 100 kcal": 'kcal'}
+        if analytics.has_price:
+            bases["Per unit of price"] = 'price'
+        rank_choices = ["Density score"] + list(schema.names)
+
+        controls_frame = ttk.Frame(self.main_frame)
+        controls_frame.pack(fill="x", pady=(0, 5))
+        rank_var = tk.StringVar(value=rank_choices[0])
+        basis_var = tk.StringVar(value="Per 100 kcal")
+        filter_var = tk.StringVar()
+        ascending_var = tk.BooleanVar(value=False)
+        ttk.Label(controls_frame, text="Rank by:").pack(side="left")
+        ttk.Combobox(controls_frame, textvariable=rank_var, values=rank_choices, state='readonly',
+                     width=24).pack(side="left", padx=(5, 10))
+        ttk.Combobox(controls_frame, textvariable=basis_var, values=list(bases), state='readonly',
+                     width=16).pack(side="left", padx=(0, 10))
+        ttk.Label(controls_frame, text="Filter:").pack(side="left")
+        filter_entry = ttk.Entry(controls_frame, textvariable=filter_var, width=36)
+        filter_entry.pack(side="left", padx=(5, 10))
+        ttk.Checkbutton(controls_frame, text="Lowest first", variable=ascending_var,
+                        command=lambda: refresh()).pack(side="left", padx=(0, 10))
+        ttk.Button(controls_frame, text="Apply", command=lambda: refresh()).pack(side="left")
+
+        hint = (f"Filters are percentiles within the food database, e.g. 'high protein, low sodium' "
+                f"(top {100 - HIGH_PERCENTILE:g}% / bottom {LOW_PERCENTILE:g}%) or 'iron >= 90'.")
+        if not analytics.has_price:
+            hint += f" Add a '{PRICE_FIELD}' column to the food CSV to rank by cost."
+        ttk.Label(self.main_frame, text=hint, wraplength=900).pack(anchor='w')
+        summary_label = ttk.Label(self.main_frame)
+        summary_label.pack(anchor='w', pady=(5, 0))
+
+        table_frame = ttk.Frame(self.main_frame)
+        table_frame.pack(fill="both", expand=True)
+        analytics_tree = ttk.Treeview(table_frame, show="headings", height=18)
+        vscrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=analytics_tree.yview)
+        hscrollbar = ttk.Scrollbar(table_frame, orient="horizontal", command=analytics_tree.xview)
+        analytics_tree.configure(yscrollcommand=vscrollbar.set, xscrollcommand=hscrollbar.set)
+        hscrollbar.pack(side="bottom", fill="x")
+        analytics_tree.pack(side="left", fill="both", expand=True)
+        vscrollbar.pack(side="right", fill="y")
+
+        def refresh():
+            basis = bases[basis_var.get()]
+            nutrient = None if rank_var.get() == rank_choices[0] else rank_var.get()
+            try:
+                bounds = parse_food_filter(filter_var.get(), schema)
+            except ValueError as e:
+                messagebox.showerror("Invalid Filter", str(e), parent=self)
+                return
+            order, scores = analytics.rank(nutrient, basis, bounds, ascending=ascending_var.get())
+            shown = order[:self.ANALYTICS_VIEW_LIMIT]
+            summary_label.config(text=f"{len(order)} of {len(analytics)} foods match"
+                                      + (f"; showing the first {len(shown)}" if len(order) > len(shown) else ""))
+
+            # Ranked value, calories and price, then value and percentile of each filtered nutrient
+            filter_slots = list(dict.fromkeys(slot for slot, _, _ in bounds))
+            score_heading = (rank_var.get() if nutrient is None
+                             else f"{schema.display_names[schema.slot[nutrient]]} {basis_var.get().lower()}")
+            columns = ["#", "Name", score_heading, "Calories (kcal)", PRICE_FIELD]
+            columns += [f"{schema.names[slot]} {suffix}" for slot in filter_slots for suffix in ("value", "pct")]
+            analytics_tree.delete(*analytics_tree.get_children())
+            analytics_tree.configure(columns=columns)
+            for i, column in enumerate(columns):
+                analytics_tree.heading(column, text=column)
+                analytics_tree.column(column, width=40 if i == 0 else 220 if i == 1 else 120,
+                                      anchor='w' if i == 1 else 'center')
+
+            values = analytics.values(basis)[shown][:, filter_slots]
+            percentiles = analytics.percentiles(filter_slots, basis)[shown]
+            for rank, (food_idx, score) in enumerate(zip(shown.tolist(), scores.tolist()), start=1):
+                row = [rank, analytics.names[food_idx], f"{score:.2f}",
+                       format_plan_number(analytics.matrix[food_idx, schema.slot['Calories / Energy']]),
+                       format_plan_number(analytics.price[food_idx])]
+                for k in range(len(filter_slots)):
+                    row += [format_plan_number(values[rank - 1, k]), format_plan_number(percentiles[rank - 1, k])]
+                analytics_tree.insert("", "end", values=row)
+
+        filter_entry.bind("<Return>", lambda event: refresh())
+        for widget in controls_frame.winfo_children():
+            if isinstance(widget, ttk.Combobox):
+                widget.bind("<<ComboboxSelected>>", lambda event: refresh())
+        refresh()
 
     def load_plans(self):
-        self.plans = []
-        for filename in os.listdir(self.plans_dir):
-            if filename.endswith(".csv"):
-                plan_name = os.path.splitext(filename)[0]
-                self.plans.append({"Name": plan_name, "filepath": os.path.join(self.plans_dir, filename)})
+        """Re-list the plans in the background; the Plans screen is refreshed when they arrive."""
+        self.io.submit(self.list_plans, callback=self._plans_loaded,
+                       errback=lambda e: messagebox.showerror("Error", f"Could not list plans: {e}"),
+                       status="Loading plans...")
+
+    def list_plans(self):
+        """The plans as {"Name", "filepath"} dicts; runs on the I/O thread."""
+        if self.db:
+            return [{"Name": plan_name, "filepath": os.path.join(self.plans_dir, f"{plan_name}.csv")}
+                    for plan_name in self.db.list_plans()]
+        return [{"Name": os.path.splitext(filename)[0], "filepath": os.path.join(self.plans_dir, filename)}
+                for filename in os.listdir(self.plans_dir) if filename.endswith(".csv")]
+
+    def _plans_loaded(self, plans):
+        self.plans = plans
+        if 'plans' in self.views:
+            self.refresh_plans_list()
 
     def refresh_plans_list(self):
         # Clear existing
@@ -397,22 +3245,111 @@ class App(tk.Tk):
                                   command=lambda plan=p: self.delete_plan(plan))
             delete_btn.pack(side='right')
 
+            # Archive plan button
+            archive_btn = ttk.Button(plan_frame, text="Archive",
+                                     command=lambda plan=p: self.archive_plan(plan))
+            archive_btn.pack(side='right', padx=(0, 5))
+
+    def archive_plan(self, plan):
+        """Move a plan into the compressed archive after confirmation."""
+        if not messagebox.askyesno("Archive Plan", f"Move the plan '{plan['Name']}' to the archive?"):
+            return
+
+        def on_error(e):
+            if isinstance(e, TimeoutError):
+                messagebox.showerror("Plan Locked", "The plan or archive is being saved elsewhere. Try again.")
+            else:
+                messagebox.showerror("Error", f"Failed to archive plan: {e}")
+
+        self.io.submit(archive_plans, [plan['Name']], self.plans_dir, self.db, callback=lambda _: self.load_plans(),
+                       errback=on_error, status=f"Archiving {plan['Name']}...")
+
+    def show_archived_plans(self):
+        """List archived plans from the archive index; opening one restores it first."""
+        self.io.submit(lambda: PlanArchive(self.plans_dir).entries(),
+                       callback=self.when_current(self._show_archived_plans),
+                       errback=lambda e: messagebox.showerror("Error", f"Could not read the plan archive: {e}"),
+                       status="Reading archive...")
+
+    def _show_archived_plans(self, entries):
+        self.hide_menu()
+        self.clear_main_frame()
+
+        header_frame = ttk.Frame(self.main_frame)
+        header_frame.pack(fill="x", pady=10)
+
+        title_label = ttk.Label(header_frame, text="Archived Plans", font=('Helvetica', 18, 'bold'))
+        title_label.pack(side="left")
+
+        back_button = ttk.Button(header_frame, text="Back", command=self.show_plans)
+        back_button.pack(side="right")
+
+        energy = nutrient_schema().display_names[nutrient_schema().slot["Calories / Energy"]]
+        columns = ("Name", "Last Modified", "Archived", "Foods", energy)
+        archive_tree = ttk.Treeview(self.main_frame, columns=columns, show="headings", height=15)
+        for i, col in enumerate(columns):
+            archive_tree.heading(col, text=col)
+            archive_tree.column(col, width=200 if i == 0 else 150, anchor='w' if i == 0 else 'center')
+        for name in sorted(entries):
+            entry = entries[name]
+            total = entry['totals'].get(energy)
+            archive_tree.insert("", "end", iid=name, values=(
+                name, entry['modified'].replace("T", " "), entry['archived'].replace("T", " "), entry['foods'],
+                "" if total is None else f"{total:.2f}"))
+        archive_tree.pack(fill="both", expand=True)
+
+        def on_restore(open_after=False):
+            selected = archive_tree.selection()
+            if not selected:
+                messagebox.showwarning("No Selection", "Please select an archived plan.")
+                return
+            name = selected[0]
+
+            def on_restored(_):
+                self.load_plans()
+                if open_after:
+                    self.open_plan_spreadsheet({"Name": name, "filepath": os.path.join(self.plans_dir, f"{name}.csv")})
+                elif archive_tree.winfo_exists() and archive_tree.exists(name):
+                    archive_tree.delete(name)
+
+            def on_error(e):
+                if isinstance(e, TimeoutError):
+                    messagebox.showerror("Plan Locked", "The plan or archive is being saved elsewhere. Try again.")
+                else:
+                    messagebox.showerror("Error", f"Failed to restore plan: {e}")
+
+            self.io.submit(restore_plan, name, self.plans_dir, self.db, callback=on_restored, errback=on_error,
+                           status=f"Restoring {name}...")
+
+        archive_tree.bind("<Double-Button-1>", lambda event: on_restore(open_after=True))
+        open_button = ttk.Button(header_frame, text="Open", command=lambda: on_restore(open_after=True))
+        open_button.pack(side="right", padx=(0, 10))
+        restore_button = ttk.Button(header_frame, text="Restore", command=on_restore)
+        restore_button.pack(side="right", padx=(0, 10))
+
     def delete_plan(self, plan):
         """Delete a plan after confirmation."""
         result = messagebox.askyesno("Delete Plan", 
                                    f"Are you sure you want to delete the plan '{plan['Name']}'?")
         if result:
-            try:
-                # Delete the file
-                os.remove(plan['filepath'])
-                # Reload the plans list
-                self.load_plans()
-                self.refresh_plans_list()
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to delete plan: {e}")
+            # Delete the file, then reload the plans list
+            if self.db:
+                delete, target = self.db.delete_plan, plan['Name']
+            else:
+                delete, target = delete_plan_file, plan['filepath']
+            self.io.submit(delete, target, callback=lambda _: self.load_plans(),
+                           errback=lambda e: messagebox.showerror("Error", f"Failed to delete plan: {e}"),
+                           status=f"Deleting {plan['Name']}...")
 
     def open_plan_spreadsheet(self, plan):
-        """Opens the tksheet spreadsheet for the selected plan in the main window."""
+        """Reads the selected plan in the background, then opens it in the tksheet spreadsheet."""
+        self.io.submit(self.read_plan, plan['filepath'],
+                       callback=self.when_current(lambda plan_data: self.build_plan_sheet(plan, plan_data)),
+                       errback=lambda e: messagebox.showerror("Error", f"Could not open plan: {e}", parent=self),
+                       status=f"Opening {plan['Name']}...")
+
+    def build_plan_sheet(self, plan, plan_data):
+        """Builds the plan screen around the tksheet widget and fills it with plan_data."""
         self.hide_menu()
         self.clear_main_frame()
         
@@ -448,9 +3385,53 @@ class App(tk.Tk):
                                        command=self.delete_selected_food_from_sheet)
         delete_food_button.pack(side='left', padx=(0, 10))
 
+        optimize_button = ttk.Button(controls_frame, text="Optimize Servings",
+                                     command=self.optimize_plan_servings)
+        optimize_button.pack(side='left', padx=(0, 10))
+        optimize_button.configure(takefocus=False)
+
+        suggest_button = ttk.Button(controls_frame, text="Suggest Foods",
+                                    command=self.show_food_suggestions)
+        suggest_button.pack(side='left', padx=(0, 10))
+        suggest_button.configure(takefocus=False)
+
+        scenarios_button = ttk.Button(controls_frame, text="What-If",
+                                      command=self.show_scenarios)
+        scenarios_button.pack(side='left', padx=(0, 10))
+        scenarios_button.configure(takefocus=False)
+
+        profile_button = ttk.Button(controls_frame, text="Profile Targets",
+                                    command=self.show_profile_targets)
+        profile_button.pack(side='left', padx=(0, 10))
+        profile_button.configure(takefocus=False)
+
+        undo_button = ttk.Button(controls_frame, text="Undo", command=self.undo_plan_edit)
+        undo_button.pack(side='left', padx=(0, 10))
+        undo_button.configure(takefocus=False)
+
+        redo_button = ttk.Button(controls_frame, text="Redo", command=self.redo_plan_edit)
+        redo_button.pack(side='left', padx=(0, 10))
+        redo_button.configure(takefocus=False)
+
+        # Paging for long plans; the sheet only ever holds one page of food rows
+        self.next_page_button = ttk.Button(controls_frame, text="Next >", takefocus=False,
+                                           command=lambda: self.render_plan_page(self.page_start + PLAN_PAGE_ROWS))
+        self.next_page_button.pack(side='right')
+        self.page_label = ttk.Label(controls_frame)
+        self.page_label.pack(side='right', padx=5)
+        self.prev_page_button = ttk.Button(controls_frame, text="< Prev", takefocus=False,
+                                           command=lambda: self.render_plan_page(self.page_start - PLAN_PAGE_ROWS))
+        self.prev_page_button.pack(side='right')
+
         # --- tksheet Widget ---
         sheet_frame = ttk.Frame(self.main_frame)
         sheet_frame.pack(fill="both", expand=True)
+        self.sheet_frame = sheet_frame
+        self.suggestions_frame = None
+        self.food_picker_frame = None
+        self.profile_frame = None
+        self.scenarios_frame = None
+        self.plan_scenarios = None
         
         self.sheet = Sheet(sheet_frame,
                            show_toolbar=True,
@@ -460,113 +3441,199 @@ class App(tk.Tk):
                            show_bottom_right_corner=True)
         self.sheet.pack(fill="both", expand=True)
         
-        # Enable editing capabilities
+        # Enable editing capabilities; rows are added and removed only through the plan controls,
+        # which keep the plan model in step (the sheet's own row/column insert and delete do not)
         self.sheet.enable_bindings(("single_select", "row_select", "column_select", "drag_select", 
                                    "column_width_resize", "double_click_column_resize", "row_height_resize", 
                                    "column_height_resize", "arrowkeys", "right_click_popup_menu", 
-                                   "rc_select", "rc_insert_column", "rc_delete_column", "rc_insert_row", 
-                                   "rc_delete_row", "copy", "cut", "paste", "delete", "select_all", 
+                                   "rc_select", "copy", "cut", "paste", "delete", "select_all", 
                                    "edit_cell"))
 
-        self.load_plan_data_to_sheet(plan['filepath'])
+        # Plan-level undo/redo (tksheet's own cell undo is not enabled)
+        for sequence in ("<Control-z>", "<Control-Z>"):
+            self.sheet.bind(sequence, self.undo_plan_edit)
+        for sequence in ("<Control-y>", "<Control-Y>", "<Control-Shift-Z>"):
+            self.sheet.bind(sequence, self.redo_plan_edit)
+
+        self.show_plan_data(plan['filepath'], plan_data)
+
+    def read_plan(self, filepath):
+        """Read a plan as (DataFrame in canonical units, version); runs on the I/O thread."""
+        # Bring columns stored in other units (e.g. "Sodium (g)") to canonical units
+        if self.db:
+            return self.db.get_plan(os.path.splitext(os.path.basename(filepath))[0]), self.plan_version
+        plan_df, version = read_plan_csv(filepath)
+        return normalize_units(plan_df), version
 
     def load_plan_data_to_sheet(self, filepath):
-        """Loads data from the plan's CSV into the tksheet widget."""
+        """Re-reads the open plan in the background and loads it into the tksheet widget."""
+        def on_read(plan_data):
+            if self.plan_sheet_open(filepath):
+                self.show_plan_data(filepath, plan_data)
+
+        self.io.submit(self.read_plan, filepath, callback=on_read,
+                       errback=lambda e: messagebox.showerror(
+                           "Error", f"Could not load plan file into sheet: {e}", parent=self),
+                       status="Loading plan...")
+
+    def show_plan_data(self, filepath, plan_data):
+        """Loads a plan read by read_plan into the tksheet widget."""
         try:
-            self.current_plan_df = pd.read_csv(filepath)
-            
+            self.current_plan_df, self.plan_version = plan_data
+
             # Load nutrient modes for color coding
             self.load_nutrient_modes()
             
-            # Prepare data for tksheet
+            # Prepare data for tksheet: only the Recommended row is read here, food rows go
+            # straight into the plan model and reach the sheet a page at a time
             headers = self.current_plan_df.columns.tolist()
-            data = self.current_plan_df.values.tolist()
-            
-            # The CSV now has: Row 0 = Recommended values
-            # We need to add: Row 1 = Summation (calculated), then food items start from Row 2
-            recommended_row = data[0] if len(data) > 0 else [0] * len(headers)
-            summation_row = [""] * len(headers)  # Will be calculated, start empty
-            
-            # Any additional rows are existing food items
-            food_item_data = data[1:] if len(data) > 1 else []
+            recommended_row = (self.current_plan_df.iloc[0].tolist() if len(self.current_plan_df)
+                               else [0] * len(headers))
+            summation_row = [None] * len(headers)  # Will be calculated, start empty
 
-            # Set up the sheet
+            # Set up the sheet with the special rows; food rows are added by render_plan_page
             self.sheet.headers(headers)
-            self.sheet.set_sheet_data(food_item_data, reset_col_positions=True, reset_row_positions=True)
-            
-            # Insert special rows at the top
-            self.sheet.insert_row(idx=0)
-            self.sheet.set_row_data(0, values=recommended_row)
-            self.sheet.insert_row(idx=1)
-            self.sheet.set_row_data(1, values=summation_row)
+            self.sheet.set_sheet_data([recommended_row, summation_row], reset_col_positions=True,
+                                      reset_row_positions=True, redraw=False)
             
-            # Set row headers to distinguish special rows
-            row_headers = ["Recommended", "Summation"] + [f"Item {i+1}" for i in range(len(food_item_data))]
-            self.sheet.row_index(row_headers)
+            # Numeric columns hold floats; two-decimal rounding happens only when cells are drawn
+            numeric_cols = [i for i, header in enumerate(headers) if header != 'Name']
+            self.sheet.format_column(numeric_cols, formatter_options=PLAN_NUMBER_FORMAT, redraw=False)
             
             # Make "Recommended" and "Summation" rows read-only
             self.sheet.readonly_rows([0, 1])
             
-            # Configure column editability for food items (rows 2+)
+            # Food rows edit only Name and Amount; read-only is set per column, not per cell
             if 'Amount' in headers:
-                amount_col_index = headers.index('Amount')
-                name_col_index = headers.index('Name') if 'Name' in headers else -1
-                
-                # Make all columns read-only except Amount and Name for food item rows
-                for row_idx in range(2, self.sheet.get_total_rows()):
-                    for col_idx in range(len(headers)):
-                        try:
-                            if col_idx == amount_col_index or col_idx == name_col_index:
-                                # Explicitly make Amount and Name columns editable
-                                self.sheet.readonly(rows=[row_idx], columns=[col_idx], readonly=False)
-                            else:
-                                # Make all other columns read-only
-                                self.sheet.readonly(rows=[row_idx], columns=[col_idx], readonly=True)
-                        except TypeError:
-                            # Try alternative API syntax
-                            try:
-                                if col_idx == amount_col_index or col_idx == name_col_index:
-                                    self.sheet.readonly((row_idx, col_idx), readonly=False)
-                                else:
-                                    self.sheet.readonly((row_idx, col_idx), readonly=True)
-                            except:
-                                print(f"Could not set readonly for cell ({row_idx}, {col_idx})")
-
-            # Bind multiple event types for data changes to update summation
+                self.sheet.readonly_columns([i for i, header in enumerate(headers)
+                                             if header not in ('Name', 'Amount')])
+
+            self.build_plan_model(headers, self.current_plan_df.iloc[1:])
+
+            # Every kind of cell change goes through one queue, applied once per event-loop turn
+            self.pending_edits = {}
+            self.pending_edit_job = None
             try:
-                self.sheet.extra_bindings("end_edit_table", self.update_summation_and_row)
-                self.sheet.extra_bindings("end_edit_cell", self.update_summation_and_row)
-                self.sheet.extra_bindings("cell_edited", self.update_summation_and_row)
+                for binding in ("end_edit_table", "end_paste", "end_delete", "end_ctrl_x"):
+                    self.sheet.extra_bindings(binding, self.queue_plan_edits)
             except Exception as e:
                 print(f"Error adding event bindings: {e}")
             
-            self.update_summation_row_tksheet()
-            self.apply_color_coding()  # Apply color coding after initial load
+            # A reload of the same plan (e.g. saved elsewhere) stays on the page being viewed
+            if filepath != getattr(self, '_paged_plan', None):
+                self.page_start = 0
+                self._paged_plan = filepath
+            self.render_plan_page()  # Also writes the summation and applies color coding
 
         except Exception as e:
             messagebox.showerror("Error", f"Could not load plan file into sheet: {e}", parent=self)
 
+    def build_plan_model(self, headers, food_df):
+        """Attach base food data to the loaded food rows and build the plan model from them in bulk."""
+        self.plan_nutrient_cols = [i for i, header in enumerate(headers) if header not in ('Name', 'Amount')]
+        nutrient_headers = [headers[i] for i in self.plan_nutrient_cols]
+        self.plan_model = PlanModel(len(self.plan_nutrient_cols), capacity=max(16, len(food_df)))
+        if food_df.empty:
+            return
+
+        amounts = (np.nan_to_num(numeric_matrix(food_df, ['Amount'])[:, 0]) if 'Amount' in headers
+                   else np.zeros(len(food_df)))
+        names = food_df['Name'].astype(str).tolist() if 'Name' in headers else [""] * len(food_df)
+
+        # Loaded rows keep their own saved values, scaled back to one serving; only rows saved
+        # without an amount take the food store entry with the same name
+        foods_by_name = {item.get('Name', '').strip().casefold(): item for item in self.load_food_items()}
+        matched = [foods_by_name.get(name.strip().casefold()) for name in names]
+        row_values = np.nan_to_num(numeric_matrix(food_df, nutrient_headers))
+        vectors = np.divide(row_values, amounts[:, None], out=np.zeros_like(row_values),
+                            where=amounts[:, None] > 0)
+        from_store = [k for k, food_item in enumerate(matched) if food_item is not None and not amounts[k] > 0]
+        if from_store:
+            vectors[from_store] = food_matrix([matched[k] for k in from_store], nutrient_headers)
+        from_store = set(from_store)
+
+        nutrient_names = [split_header_unit(header)[0] for header in nutrient_headers]
+        food_items = []
+        for k, (name, food_item, vector) in enumerate(zip(names, matched, vectors)):
+            if food_item is None:
+                food_item = {'Name': name, 'Amount': "1", **dict(zip(nutrient_names, vector.tolist()))}
+            elif k not in from_store:
+                food_item = {**food_item, 'Name': name, **dict(zip(nutrient_names, vector.tolist()))}
+            elif food_item.get('Name') != name:
+                food_item = {**food_item, 'Name': name}
+            food_items.append(food_item)
+        self.plan_model.load_rows(food_items, vectors, amounts)
+
+    def page_positions(self):
+        """Model positions of the food rows on the current page."""
+        return range(self.page_start, min(self.page_start + PLAN_PAGE_ROWS, len(self.plan_model)))
+
+    def sheet_row(self, position):
+        """Sheet row showing a model position, or None when it is on another page."""
+        if position in self.page_positions():
+            return position - self.page_start + 2
+        return None
+
+    def model_row(self, position, headers=None):
+        """Sheet row values for the food row at a model position."""
+        row_id = self.plan_model.row_id_at(position)
+        return self.build_food_row(self.plan_model.food_item(row_id), self.plan_model.amount(row_id),
+                                   headers or self.sheet.headers(), self.plan_model.per_serving(row_id))
+
+    def render_plan_page(self, start=None):
+        """Hand the sheet the Recommended and Summation rows plus one page of food rows.
+
+        Rows are built from the plan model only for the page shown, so opening
+        or paging a plan costs at most PLAN_PAGE_ROWS rows however long it is.
+        Formatting and read-only options live on columns and the two special
+        rows, and highlighting only ever touches the Recommended row.
+        """
+        if start is not None:
+            self.page_start = start
+        count = len(self.plan_model)
+        last_start = max(count - 1, 0) // PLAN_PAGE_ROWS * PLAN_PAGE_ROWS
+        self.page_start = min(max(self.page_start, 0) // PLAN_PAGE_ROWS * PLAN_PAGE_ROWS, last_start)
+
+        headers = self.sheet.headers()
+        positions = self.page_positions()
+        rows = [self.sheet.get_row_data(0), self.sheet.get_row_data(1)]
+        rows += [self.model_row(position, headers) for position in positions]
+        self.sheet.set_sheet_data(rows, reset_col_positions=False, reset_row_positions=True,
+                                  keep_formatting=True, redraw=False)
+        self.sheet.row_index(["Recommended", "Summation"] + [f"Item {position + 1}" for position in positions],
+                             redraw=False)
+        self.write_summation_row()
+
+        if getattr(self, 'page_label', None) is not None and self.page_label.winfo_exists():
+            self.page_label.config(text=f"Items {positions.start + 1}-{positions.stop} of {count}"
+                                   if count else "No items")
+            self.prev_page_button.state(['!disabled' if positions.start > 0 else 'disabled'])
+            self.next_page_button.state(['!disabled' if positions.stop < count else 'disabled'])
+
+    def show_plan_position(self, position):
+        """Re-render the page holding a model position and scroll it into view."""
+        self.render_plan_page(position)
+        row = self.sheet_row(position)
+        if row is not None:
+            self.sheet.see(row, 0, redraw=True)
+
+    def write_summation_row(self):
+        """Write the plan model's running totals into the Summation row without re-reading the sheet."""
+        headers = self.sheet.headers()
+        summation_values = [None] * len(headers)
+        if 'Name' in headers:
+            summation_values[headers.index('Name')] = ""
+        if 'Amount' in headers and self.plan_model.amount_total > 0:
+            summation_values[headers.index('Amount')] = float(self.plan_model.amount_total)
+        for col_idx, total in zip(self.plan_nutrient_cols, self.plan_model.totals):
+            summation_values[col_idx] = float(total) if total > 0 else None
+        self.sheet.set_row_data(1, values=summation_values, redraw=True)
+        self.apply_color_coding()
+
     def load_nutrient_modes(self):
         """Load nutrient modes from data/nutrient_modes.csv"""
         try:
-            modes_path = os.path.join(get_base_path(), "data", "nutrient_modes.csv")
-            modes_df = pd.read_csv(modes_path)
-            self.nutrient_modes = {}
-            
-            # Get headers and modes
-            headers = modes_df.columns.tolist()
-            modes = modes_df.iloc[0].tolist() if len(modes_df) > 0 else []
-            
-            # Create mapping with proper header matching
-            for i, header in enumerate(headers):
-                if i < len(modes):
-                    # Map both with and without units for compatibility
-                    self.nutrient_modes[header] = modes[i]
-                    # Also map with units if they exist in the plan headers
-                    for plan_header in self.current_plan_df.columns:
-                        if header in plan_header:
-                            self.nutrient_modes[plan_header] = modes[i]
-            
+            self.nutrient_modes = load_nutrient_modes(self.current_plan_df.columns)
         except Exception as e:
             print(f"Warning: Could not load nutrient modes: {e}")
             self.nutrient_modes = {}
@@ -594,26 +3661,14 @@ class App(tk.Tk):
                 # Get the mode for this nutrient
                 mode = self.nutrient_modes.get(header, 'irrelevant')
                 
-                try:
-                    recommended_val = float(recommended_data[col_idx]) if recommended_data[col_idx] else 0
-                    summation_val = float(summation_data[col_idx]) if summation_data[col_idx] else 0
-                except (ValueError, TypeError):
+                # Cells already hold floats (None when blank)
+                recommended_val = recommended_data[col_idx] or 0.0
+                summation_val = summation_data[col_idx] or 0.0
+                if not isinstance(recommended_val, (int, float)) or not isinstance(summation_val, (int, float)):
                     continue
                 
                 # Determine color based on mode and comparison
-                color = None
-                
-                if mode == 'good':
-                    if recommended_val > summation_val:
-                        color = '#FF6B6B'  # Red - not meeting good nutrient target
-                    elif recommended_val < summation_val:
-                        color = '#51CF66'  # Green - exceeding good nutrient target
-                elif mode == 'harmful':
-                    if recommended_val > summation_val:
-                        color = '#51CF66'  # Green - staying below harmful limit
-                    elif recommended_val < summation_val:
-                        color = '#FF6B6B'  # Red - exceeding harmful limit
-                # mode == 'irrelevant' keeps default color (no change)
+                color = STATUS_COLORS.get(nutrient_status(mode, recommended_val, summation_val))
                 
                 # Apply the color to the recommended value cell
                 if color:
@@ -626,27 +3681,146 @@ class App(tk.Tk):
             print(f"Warning: Could not apply color coding: {e}")
 
     def save_plan_data(self, filepath):
-        """Saves the current state of the tksheet back to the CSV file."""
+        """Saves the open plan back to its CSV file.
+
+        The frame is taken on the Tk thread and written on the I/O thread. While a
+        write of the plan is still pending, later saves only keep their frame, and
+        the newest one is written once that write finishes.
+        """
         try:
-            # Get all data from the sheet, including the special rows
-            all_data = self.sheet.get_sheet_data()
-            
-            # The first row is "Recommended", the rest are food items
-            # We skip the "Summation" row when saving
-            recommended_row = all_data[0]
-            food_item_rows = all_data[2:]
-            
-            # Combine into a list of lists for the DataFrame
-            data_to_save = [recommended_row] + food_item_rows
-            
-            # Create a new DataFrame
-            df_to_save = pd.DataFrame(data_to_save, columns=self.sheet.headers())
-            
-            # Save to CSV
-            df_to_save.to_csv(filepath, index=False)
-            
+            # The sheet only holds one page, so the food rows come from the plan model
+            df_to_save = self.plan_frame()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save plan: {e}", parent=self)
+            return
+
+        if self.db:
+            self.io.submit(self.db.save_plan, os.path.splitext(os.path.basename(filepath))[0], df_to_save,
+                           errback=lambda e: messagebox.showerror("Error", f"Failed to save plan: {e}", parent=self))
+            return
+
+        if filepath in self.pending_plan_saves:
+            self.pending_plan_saves[filepath] = df_to_save
+            return
+        self.write_plan(filepath, df_to_save, self.plan_version)
+
+    def write_plan(self, filepath, df_to_save, version):
+        """Write a plan frame in the background unless the plan was saved elsewhere since version."""
+        self.pending_plan_saves[filepath] = None
+
+        def on_written(result):
+            newer = self.pending_plan_saves.pop(filepath, None)
+            saved, disk_version = result
+            if not saved:
+                self.resolve_plan_conflict(filepath, df_to_save if newer is None else newer, disk_version)
+                return
+            if self.plan_sheet_open(filepath):
+                self.plan_version = disk_version
+            if newer is not None:
+                self.write_plan(filepath, newer, disk_version)
+
+        def on_error(e):
+            self.pending_plan_saves.pop(filepath, None)
+            if isinstance(e, TimeoutError):
+                messagebox.showerror("Plan Locked", f"Could not save plan: {e}", parent=self)
+            else:
+                messagebox.showerror("Error", f"Failed to save plan: {e}", parent=self)
+
+        # Only overwrite the version we loaded; a newer one on disk was saved elsewhere
+        self.io.submit(write_plan_if_version, filepath, df_to_save.to_csv(index=False), version,
+                       callback=on_written, errback=on_error, status="Saving plan...")
+
+    def plan_frame(self):
+        """The open plan shaped like its CSV: the Recommended row, then every food row in the plan model."""
+        headers = self.sheet.headers()
+        model = self.plan_model
+        amounts = model.amounts()
+        values = model.matrix() * amounts[:, None]
+        columns = {header: values[:, k] for k, header in enumerate(headers[i] for i in self.plan_nutrient_cols)}
+        if 'Name' in headers:
+            columns['Name'] = [model.food_item(row_id).get('Name', '') for row_id in model.order]
+        if 'Amount' in headers:
+            columns['Amount'] = amounts
+        food_df = pd.DataFrame(columns, columns=headers)
+        # The Summation row is derived, so it is not saved
+        recommended_df = pd.DataFrame([self.sheet.get_row_data(0)], columns=headers)
+        return pd.concat([recommended_df, food_df], ignore_index=True)
+
+    def resolve_plan_conflict(self, filepath, df_to_save, disk_version):
+        """Ask whether to overwrite a plan saved elsewhere since we loaded it, or load that version."""
+        keep_ours = messagebox.askyesno(
+            "Plan Changed Elsewhere",
+            f"'{os.path.splitext(os.path.basename(filepath))[0]}' was saved from another place "
+            "since you opened it.\n\nYes: overwrite it with your version\nNo: discard your last edit "
+            "and load the saved version", parent=self)
+        if keep_ours:
+            self.write_plan(filepath, df_to_save, disk_version)
+        elif self.plan_sheet_open(filepath):
+            self.load_plan_data_to_sheet(filepath)
+
+    def scan_file_stamps(self):
+        """Map each plan CSV and the food CSV to its (mtime_ns, size)."""
+        stamps = {}
+        with os.scandir(self.plans_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".csv"):
+                    stat = entry.stat()
+                    stamps[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        with contextlib.suppress(OSError):
+            stat = os.stat(self.csv_file)
+            stamps[self.csv_file] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def scan_files(self, plan_path, plan_stamp):
+        """Return (file stamps, version of plan_path if its stamp moved on from plan_stamp); runs on the I/O thread."""
+        stamps = self.scan_file_stamps()
+        if plan_path in stamps and stamps[plan_path] != plan_stamp:
+            return stamps, read_plan_version(plan_path)
+        return stamps, None
+
+    def poll_files(self):
+        """Check the files for changes in the background; files_scanned reschedules the next check."""
+        def on_error(e):
+            print(f"Warning: Could not check plan files for changes: {e}")
+            self.after(FILE_POLL_MS, self.poll_files)
+
+        plan_path = getattr(self, '_current_plan', {}).get('filepath') if self.plan_sheet_open() else None
+        self.io.submit(self.scan_files, plan_path, (self.file_stamps or {}).get(plan_path),
+                       callback=self.files_scanned, errback=on_error)
+
+    def files_scanned(self, result):
+        """Reload whatever changed on disk since the last poll."""
+        try:
+            stamps, plan_disk_version = result
+            # The first scan only records the stamps of what was just loaded
+            previous, self.file_stamps = self.file_stamps or stamps, stamps
+
+            # Plans added or removed elsewhere
+            if set(stamps) - {self.csv_file} != set(previous) - {self.csv_file}:
+                for removed in set(previous) - set(stamps):
+                    with PLAN_TOTALS_LOCK:
+                        PLAN_TOTALS_CACHE.pop(removed, None)
+                self.load_plans()
+
+            # The open plan, unless the change is our own save
+            plan_path = getattr(self, '_current_plan', {}).get('filepath')
+            if (plan_disk_version is not None and plan_disk_version != self.plan_version
+                    and plan_path not in self.pending_plan_saves and self.plan_sheet_open(plan_path)):
+                self.load_plan_data_to_sheet(plan_path)
+
+            # The food items, unless the change is our own save
+            if (stamps.get(self.csv_file) != self._food_file_stamp
+                    and self.csv_file not in self.pending_food_saves):
+                self.reload_food_items(stamps.get(self.csv_file))
+        finally:
+            self.after(FILE_POLL_MS, self.poll_files)
+
+    def plan_sheet_open(self, filepath=None):
+        """Whether a plan screen is showing, and if filepath is given, whether it shows that plan."""
+        sheet_frame = getattr(self, 'sheet_frame', None)
+        if sheet_frame is None or not sheet_frame.winfo_exists():
+            return False
+        return filepath is None or getattr(self, '_current_plan', {}).get('filepath') == filepath
 
     def _on_add_food_clicked(self):
         """Handle add food button click with proper method binding."""
@@ -700,7 +3874,11 @@ class App(tk.Tk):
                     pass
 
     def show_food_item_selection_dialog(self, plan):
-        """Shows an inline food selection interface."""
+        """Shows the food picker as a side panel next to the plan sheet.
+
+        The sheet and its plan model stay alive underneath, so closing the
+        picker costs nothing and no plan data is reloaded.
+        """
         # Destroy any ghost Toplevel windows to eliminate any potential issues
         for widget in self.winfo_children():
             if isinstance(widget, tk.Toplevel):
@@ -709,347 +3887,288 @@ class App(tk.Tk):
                 except:
                     pass
         
-        # Clear the main window and show food selection interface
-        for widget in self.main_frame.winfo_children():
-            widget.destroy()
-        
-        # Title
-        title_label = ttk.Label(self.main_frame, text=f"Select Food Item for {plan}", 
-                               font=('Helvetica', 18, 'bold'))
-        title_label.pack(pady=20)
-        
         # Load food items
         food_items = self.load_food_items()
         if not food_items:
             messagebox.showinfo("No Food Items", "There are no food items to add. Please create some first.")
-            self.open_plan_spreadsheet(plan)  # Go back to spreadsheet
             return
         
-        # Create listbox for food selection
-        listbox_frame = ttk.Frame(self.main_frame)
-        listbox_frame.pack(pady=20, padx=20, fill='both', expand=True)
+        # Replace any open picker; the sheet shrinks to make room on the right
+        self.close_food_picker()
+        panel = ttk.Frame(self.main_frame)
+        panel.pack(side='right', fill='y', padx=(10, 0), before=self.sheet_frame)
+        self.food_picker_frame = panel
         
-        listbox = tk.Listbox(listbox_frame, height=15, font=('Helvetica', 12))
-        scrollbar = ttk.Scrollbar(listbox_frame, orient="vertical", command=listbox.yview)
-        listbox.configure(yscrollcommand=scrollbar.set)
+        # Title
+        title_label = ttk.Label(panel, text=f"Add Foods to {plan['Name']}", 
+                               font=('Helvetica', 14, 'bold'))
+        title_label.pack(pady=(0, 10))
+        
+        # Food list with a servings column; several foods can be picked before committing
+        listbox_frame = ttk.Frame(panel)
+        listbox_frame.pack(pady=(0, 5), fill='both', expand=True)
         
-        food_item_names = [item['Name'] for item in food_items]
-        for name in food_item_names:
-            listbox.insert(tk.END, name)
+        food_tree = ttk.Treeview(listbox_frame, columns=("Name", "Servings"), show="headings",
+                                 selectmode="extended", height=15)
+        food_tree.heading("Name", text="Name")
+        food_tree.heading("Servings", text="Servings")
+        food_tree.column("Name", width=220, anchor='w')
+        food_tree.column("Servings", width=70, anchor='center')
+        scrollbar = ttk.Scrollbar(listbox_frame, orient="vertical", command=food_tree.yview)
+        food_tree.configure(yscrollcommand=scrollbar.set)
         
-        listbox.pack(side='left', fill='both', expand=True)
+        for index, item in enumerate(food_items):
+            food_tree.insert("", "end", iid=str(index), values=(item['Name'], ""))
+        
+        food_tree.pack(side='left', fill='both', expand=True)
         scrollbar.pack(side='right', fill='y')
-        listbox.focus()
+        # The add-button handler hands focus back to the sheet; take it once that has run
+        self.after_idle(food_tree.focus_set)
+        
+        hint_label = ttk.Label(panel, text="Select foods (Ctrl/Shift-click for several) and set their servings.",
+                               wraplength=290)
+        hint_label.pack()
         
         # Buttons frame
-        buttons_frame = ttk.Frame(self.main_frame)
-        buttons_frame.pack(pady=20)
+        buttons_frame = ttk.Frame(panel)
+        buttons_frame.pack(pady=10)
         
-        def on_select_item():
-            selected_indices = listbox.curselection()
-            if not selected_indices:
+        def ask_servings():
+            return simpledialog.askfloat("Servings", "Enter number of servings:", 
+                                         minvalue=0.1, maxvalue=100.0, parent=self)
+        
+        def on_set_servings():
+            selected = food_tree.selection()
+            if not selected:
                 messagebox.showwarning("No Selection", "Please select a food item.")
                 return
-            
-            selected_index = selected_indices[0]
-            selected_food_item = food_items[selected_index]
-            
-            # Ask for amount
-            amount = simpledialog.askfloat("Servings", "Enter number of servings:", 
-                                         minvalue=0.1, maxvalue=100.0, parent=self)
-            
+            amount = ask_servings()
             if amount is not None:
-                # Go back to spreadsheet and add the item
-                self.open_plan_spreadsheet(plan)
-                self.add_food_item_to_tksheet(selected_food_item, amount)
-            else:
-                # Just go back to spreadsheet
-                self.open_plan_spreadsheet(plan)
+                for iid in selected:
+                    food_tree.set(iid, "Servings", f"{amount:g}")
+        
+        def on_add_items():
+            picked = [(food_items[int(iid)], float(food_tree.set(iid, "Servings")))
+                      for iid in food_tree.get_children() if food_tree.set(iid, "Servings")]
+            if not picked:
+                # Nothing has servings yet: ask once for the current selection
+                selected = food_tree.selection()
+                if not selected:
+                    messagebox.showwarning("No Selection", "Please select a food item.")
+                    return
+                amount = ask_servings()
+                if amount is None:
+                    return
+                picked = [(food_items[int(iid)], amount) for iid in selected]
+            
+            # Close the picker and add every picked item to the live sheet in one go
+            self.close_food_picker()
+            self.add_food_items_to_tksheet(picked)
         
         def on_cancel():
-            self.open_plan_spreadsheet(plan)
+            self.close_food_picker()
         
-        # Bind Enter and double-click
-        listbox.bind("<Return>", lambda event: on_select_item())
-        listbox.bind("<Double-Button-1>", lambda event: on_select_item())
+        # Enter and double-click set servings for the selection
+        food_tree.bind("<Return>", lambda event: on_set_servings())
+        food_tree.bind("<Double-Button-1>", lambda event: on_set_servings())
+        food_tree.bind("<Escape>", lambda event: on_cancel())
         
         # Buttons
-        select_button = ttk.Button(buttons_frame, text="Select", command=on_select_item)
+        servings_button = ttk.Button(buttons_frame, text="Set Servings", command=on_set_servings)
+        servings_button.pack(side='left', padx=(0, 10))
+        
+        select_button = ttk.Button(buttons_frame, text="Add Selected", command=on_add_items)
         select_button.pack(side='left', padx=(0, 10))
         
         cancel_button = ttk.Button(buttons_frame, text="Cancel", command=on_cancel)
         cancel_button.pack(side='left')
 
-    def add_food_item_to_tksheet(self, food_item, amount):
-        """Adds a new row for the selected food item to the tksheet."""
+    def close_food_picker(self):
+        """Remove the food picker panel, leaving the plan sheet untouched."""
+        if getattr(self, 'food_picker_frame', None) is not None:
+            self.food_picker_frame.destroy()
+            self.food_picker_frame = None
+            self.sheet.focus_set()
+
+    def build_food_row(self, food_item, amount, headers, per_serving=None):
+        """Build the sheet row for a food item scaled to the given number of servings.
+
+        Values stay floats; the column formatter rounds them only for display.
+        When every nutrient column is in the schema, the scaled values come
+        from the shared FOOD_ROWS cache instead of being recomputed.
+        """
+        new_row = [None] * len(headers)
+        if 'Name' in headers:
+            new_row[headers.index('Name')] = food_item.get('Name', '')
+        if 'Amount' in headers:
+            new_row[headers.index('Amount')] = float(amount)
+        cols, slots = nutrient_schema().resolve(tuple(headers))
+        if len(cols) == len(self.plan_nutrient_cols):
+            for col_idx, value in zip(cols.tolist(), FOOD_ROWS.row(food_item, amount)[slots].tolist()):
+                new_row[col_idx] = value
+            return new_row
+        if per_serving is None:
+            per_serving = food_matrix([food_item], [headers[i] for i in self.plan_nutrient_cols])[0]
+        for col_idx, value in zip(self.plan_nutrient_cols, per_serving * amount):
+            new_row[col_idx] = float(value)
+        return new_row
+
+    def add_food_item_to_tksheet(self, food_item, amount, position=None, record=True, row_id=None):
+        """Adds a new row for the selected food item to the plan (at position, or the end).
+
+        Returns the new row's stable ID; undo passes the original row_id back in.
+        """
         headers = self.sheet.headers()
-        new_row = ["" for _ in headers]
+        nutrient_headers = [headers[i] for i in self.plan_nutrient_cols]
+        per_serving = food_matrix([food_item], nutrient_headers)[0]
+        if position is None:
+            position = len(self.plan_model)
         
-        # Create a mapping between plan headers and food item keys
-        def get_food_value(plan_header, food_item):
-            # Direct match first
-            if plan_header in food_item:
-                return food_item[plan_header]
-            
-            # Handle common variations between plan and food item column names
-            mappings = {
-                'Calories / Energy (kcal)': 'Calories / Energy',
-                'Protein (g)': 'Protein',
-                'Total Fat (g)': 'Total Fat',
-                'Saturated Fat (g)': 'Saturated Fat',
-                'Monounsaturated Fat (g)': 'Monounsaturated Fat',
-                'Polyunsaturated Fat (g)': 'Polyunsaturated Fat',
-                'Trans Fat (g)': 'Trans Fat',
-                'Cholesterol (mg)': 'Cholesterol',
-                'Carbohydrates (g)': 'Carbohydrates',
-                'Dietary Fiber (g)': 'Dietary Fiber',
-                'Soluble Fiber (g)': 'Soluble Fiber',
-                'Insoluble Fiber (g)': 'Insoluble Fiber',
-                'Total Sugars (g)': 'Total Sugars',
-                'Added Sugars (g)': 'Added Sugars',
-                'Sodium (mg)': 'Sodium',
-                'Potassium (mg)': 'Potassium',
-                'Calcium (mg)': 'Calcium',
-                'Iron (mg)': 'Iron',
-                'Magnesium (mg)': 'Magnesium',
-                'Zinc (mg)': 'Zinc',
-                'Phosphorus (mg)': 'Phosphorus',
-                'Iodine (µg)': 'Iodine',
-                'Vitamin A (µg)': 'Vitamin A',
-                'Vitamin C (mg)': 'Vitamin C',
-                'Vitamin D (µg)': 'Vitamin D',
-                'Vitamin E (mg)': 'Vitamin E',
-                'Vitamin K (µg)': 'Vitamin K',
-                'Vitamin B1 (Thiamine) (mg)': 'Vitamin B1 (Thiamine)',
-                'Vitamin B2 (Riboflavin) (mg)': 'Vitamin B2 (Riboflavin)',
-                'Vitamin B3 (Niacin) (mg)': 'Vitamin B3 (Niacin)',
-                'Vitamin B6 (mg)': 'Vitamin B6',
-                'Vitamin B9 (Folate) (µg)': 'Vitamin B9 (Folate)',
-                'Vitamin B12 (µg)': 'Vitamin B12',
-                'Omega-3 Fatty Acids (g)': 'Omega-3 Fatty Acids',
-                'Omega-6 Fatty Acids (g)': 'Omega-6 Fatty Acids'
-            }
-            
-            # Try the mapping
-            food_key = mappings.get(plan_header)
-            if food_key and food_key in food_item:
-                return food_item[food_key]
-            
-            return "0"  # Default if not found
+        # Keep the base food data (per serving) in the plan model under a stable row ID
+        row_id = self.plan_model.add_row(food_item, per_serving, amount, position=position, row_id=row_id)
+        if record:
+            self.plan_model.record(('add', row_id, position, food_item, amount))
         
-        for i, col_name in enumerate(headers):
-            if col_name == 'Name':
-                new_row[i] = food_item.get('Name', '')
-            elif col_name == 'Amount':
-                new_row[i] = f"{amount:.2f}"
-            else:
-                base_value = get_food_value(col_name, food_item)
-                try:
-                    # Since our food items are already per serving (Amount=1), multiply directly by amount
-                    calculated_value = float(base_value) * amount
-                    new_row[i] = f"{calculated_value:.2f}"
-                except (ValueError, TypeError):
-                    new_row[i] = "0.00"
-        
-        # Add the new row to the sheet
-        self.sheet.insert_row()
-        new_row_index = self.sheet.get_total_rows() - 1
-        self.sheet.set_row_data(new_row_index, values=new_row)
-        
-        # Store the base data (per 100g) for recalculations
-        # We need a way to map sheet row index to this data
-        if not hasattr(self, 'sheet_base_data'):
-            self.sheet_base_data = {}
-        self.sheet_base_data[new_row_index] = food_item
-        
-        self.update_summation_row_tksheet()
-        self.update_row_headers()
+        # Show the page holding the new row (this also updates the summation)
+        self.show_plan_position(position)
         
         # Auto-save after adding food item
         if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
-            self.save_plan_data(self._current_plan['filepath'])
+            if self.db:
+                self.save_plan_rows(self.db.insert_plan_row, position + 1, headers, self.model_row(position, headers))
+            else:
+                self.save_plan_data(self._current_plan['filepath'])
+        return row_id
 
-    def recalculate_row(self, row_index, new_amount):
-        """Recalculate a specific row based on new amount."""
-        base_food_item = self.sheet_base_data.get(row_index)
-        if not base_food_item:
-            print(f"No base data for row {row_index}")
-            return
+    def add_food_items_to_tksheet(self, items, record=True, autosave=True):
+        """Append several (food_item, amount) rows in one transaction.
 
+        All rows go into the plan model together, followed by one page render
+        and one save; the additions are logged as one undo batch. With
+        autosave=False the caller renders and saves once for its whole change.
+        Returns the new row IDs.
+        """
+        if not items:
+            return []
         headers = self.sheet.headers()
-        
-        # Create mapping function
-        def get_food_value(plan_header, food_item):
-            if plan_header in food_item:
-                return food_item[plan_header]
-            
-            mappings = {
-                'Calories / Energy (kcal)': 'Calories / Energy',
-                'Protein (g)': 'Protein',
-                'Total Fat (g)': 'Total Fat',
-                'Saturated Fat (g)': 'Saturated Fat',
-                'Monounsaturated Fat (g)': 'Monounsaturated Fat',
-                'Polyunsaturated Fat (g)': 'Polyunsaturated Fat',
-                'Trans Fat (g)': 'Trans Fat',
-                'Cholesterol (mg)': 'Cholesterol',
-                'Carbohydrates (g)': 'Carbohydrates',
-                'Dietary Fiber (g)': 'Dietary Fiber',
-                'Soluble Fiber (g)': 'Soluble Fiber',
-                'Insoluble Fiber (g)': 'Insoluble Fiber',
-                'Total Sugars (g)': 'Total Sugars',
-                'Added Sugars (g)': 'Added Sugars',
-                'Sodium (mg)': 'Sodium',
-                'Potassium (mg)': 'Potassium',
-                'Calcium (mg)': 'Calcium',
-                'Iron (mg)': 'Iron',
-                'Magnesium (mg)': 'Magnesium',
-                'Zinc (mg)': 'Zinc',
-                'Phosphorus (mg)': 'Phosphorus',
-                'Iodine (µg)': 'Iodine',
-                'Vitamin A (µg)': 'Vitamin A',
-                'Vitamin C (mg)': 'Vitamin C',
-                'Vitamin D (µg)': 'Vitamin D',
-                'Vitamin E (mg)': 'Vitamin E',
-                'Vitamin K (µg)': 'Vitamin K',
-                'Vitamin B1 (Thiamine) (mg)': 'Vitamin B1 (Thiamine)',
-                'Vitamin B2 (Riboflavin) (mg)': 'Vitamin B2 (Riboflavin)',
-                'Vitamin B3 (Niacin) (mg)': 'Vitamin B3 (Niacin)',
-                'Vitamin B6 (mg)': 'Vitamin B6',
-                'Vitamin B9 (Folate) (µg)': 'Vitamin B9 (Folate)',
-                'Vitamin B12 (µg)': 'Vitamin B12',
-                'Omega-3 Fatty Acids (g)': 'Omega-3 Fatty Acids',
-                'Omega-6 Fatty Acids (g)': 'Omega-6 Fatty Acids'
-            }
-            
-            food_key = mappings.get(plan_header)
-            if food_key and food_key in food_item:
-                return food_item[food_key]
-            
-            return "0"
-
-        # Recalculate the entire row
-        updated_row_values = []
-        for i, col_name in enumerate(headers):
-            if col_name == 'Name':
-                updated_row_values.append(base_food_item.get('Name', ''))
-            elif col_name == 'Amount':
-                updated_row_values.append(f"{new_amount:.2f}")
+        nutrient_headers = [headers[i] for i in self.plan_nutrient_cols]
+        first_position = len(self.plan_model)
+
+        vectors = food_matrix([food_item for food_item, _ in items], nutrient_headers)
+        commands = []
+        for k, (food_item, amount) in enumerate(items):
+            row_id = self.plan_model.add_row(food_item, vectors[k], amount)
+            commands.append(('add', row_id, first_position + k, food_item, amount))
+        if record:
+            self.plan_model.record(('batch', commands))
+        if not autosave:
+            return [command[1] for command in commands]
+
+        self.show_plan_position(first_position)
+
+        if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
+            if self.db:
+                new_rows = [self.model_row(position, headers)
+                            for position in range(first_position, len(self.plan_model))]
+                self.save_plan_rows(self.db.insert_plan_rows, first_position + 1, headers, new_rows)
             else:
-                base_value = get_food_value(col_name, base_food_item)
-                try:
-                    calculated_value = float(base_value) * new_amount
-                    updated_row_values.append(f"{calculated_value:.2f}")
-                except (ValueError, TypeError):
-                    updated_row_values.append("0.00")
-        
-        # Update the row in the sheet
-        self.sheet.set_row_data(row_index, values=updated_row_values, redraw=True)
+                self.save_plan_data(self._current_plan['filepath'])
+        return [command[1] for command in commands]
 
-    def update_summation_and_row(self, event=None):
-        """Callback for when a cell is edited. Updates the row and the summation."""
-        if not event or (event.get('eventname') != 'end_edit_table' and event.get('eventname') != 'end_edit_cell'):
-            return
-            
-        # For end_edit_table events, get row and column from the event data
-        if hasattr(event, 'row') and hasattr(event, 'column'):
-            row_index, col_index, new_value = event.row, event.column, event.value
-        elif 'loc' in event and hasattr(event['loc'], 'row'):
-            row_index, col_index = event['loc'].row, event['loc'].column
-            new_value = event.get('value', '')
-        else:
+    def refresh_plan_rows(self, positions):
+        """Rewrite changed food rows on the current page from the plan model, then the summation.
+
+        A paste can grow the sheet past the model's rows; then the whole page is re-rendered.
+        """
+        if self.sheet.get_total_rows() != len(self.page_positions()) + 2:
+            self.render_plan_page()
             return
-        
-        # We only care about edits in the 'Amount' column for food item rows
         headers = self.sheet.headers()
-        if headers[col_index] != 'Amount' or row_index < 2: # 0=Rec, 1=Sum
-            return
+        for position in positions:
+            row = self.sheet_row(position)
+            if row is not None:
+                self.sheet.set_row_data(row, values=self.model_row(position, headers), redraw=False)
+        self.write_summation_row()
 
-        try:
-            new_amount = float(new_value)
-        except ValueError:
-            # Revert to old value if input is not a valid float
-            # (tksheet might handle this, but good to be safe)
+    def queue_plan_edits(self, event=None):
+        """Collect the food cells changed by an edit, paste, cut or delete.
+
+        A paste reports all of its cells in one event, and several events can
+        arrive in the same event-loop turn; they are applied together by
+        flush_plan_edits once Tk is idle.
+        """
+        if not event:
             return
+        cells = event.get('cells', {}).get('table') or {}
+        if not cells and 'loc' in event and hasattr(event['loc'], 'row'):
+            cells = {(event['loc'].row, event['loc'].column): None}
+        for row, column in cells:
+            position = self.page_start + row - 2
+            if row >= 2 and position < len(self.plan_model):  # 0=Rec, 1=Sum
+                self.pending_edits[(position, column)] = row
+        if self.pending_edits and self.pending_edit_job is None:
+            self.pending_edit_job = self.after_idle(self.flush_plan_edits)
 
-        # Get the base data for this row
-        base_food_item = self.sheet_base_data.get(row_index)
-        if not base_food_item:
+    def flush_plan_edits(self):
+        """Apply the queued cell changes to the plan model, then update, color and save once."""
+        self.pending_edit_job = None
+        edits, self.pending_edits = self.pending_edits, {}
+        if not edits or not self.plan_sheet_open():
             return
+        headers = self.sheet.headers()
+        model = self.plan_model
 
-        # Create the same mapping function as in add_food_item_to_tksheet
-        def get_food_value(plan_header, food_item):
-            if plan_header in food_item:
-                return food_item[plan_header]
-            
-            mappings = {
-                'Calories / Energy (kcal)': 'Calories / Energy',
-                'Protein (g)': 'Protein',
-                'Total Fat (g)': 'Total Fat',
-                'Saturated Fat (g)': 'Saturated Fat',
-                'Monounsaturated Fat (g)': 'Monounsaturated Fat',
-                'Polyunsaturated Fat (g)': 'Polyunsaturated Fat',
-                'Trans Fat (g)': 'Trans Fat',
-                'Cholesterol (mg)': 'Cholesterol',
-                'Carbohydrates (g)': 'Carbohydrates',
-                'Dietary Fiber (g)': 'Dietary Fiber',
-                'Soluble Fiber (g)': 'Soluble Fiber',
-                'Insoluble Fiber (g)': 'Insoluble Fiber',
-                'Total Sugars (g)': 'Total Sugars',
-                'Added Sugars (g)': 'Added Sugars',
-                'Sodium (mg)': 'Sodium',
-                'Potassium (mg)': 'Potassium',
-                'Calcium (mg)': 'Calcium',
-                'Iron (mg)': 'Iron',
-                'Magnesium (mg)': 'Magnesium',
-                'Zinc (mg)': 'Zinc',
-                'Phosphorus (mg)': 'Phosphorus',
-                'Iodine (µg)': 'Iodine',
-                'Vitamin A (µg)': 'Vitamin A',
-                'Vitamin C (mg)': 'Vitamin C',
-                'Vitamin D (µg)': 'Vitamin D',
-                'Vitamin E (mg)': 'Vitamin E',
-                'Vitamin K (µg)': 'Vitamin K',
-                'Vitamin B1 (Thiamine) (mg)': 'Vitamin B1 (Thiamine)',
-                'Vitamin B2 (Riboflavin) (mg)': 'Vitamin B2 (Riboflavin)',
-                'Vitamin B3 (Niacin) (mg)': 'Vitamin B3 (Niacin)',
-                'Vitamin B6 (mg)': 'Vitamin B6',
-                'Vitamin B9 (Folate) (µg)': 'Vitamin B9 (Folate)',
-                'Vitamin B12 (µg)': 'Vitamin B12',
-                'Omega-3 Fatty Acids (g)': 'Omega-3 Fatty Acids',
-                'Omega-6 Fatty Acids (g)': 'Omega-6 Fatty Acids'
-            }
-            
-            food_key = mappings.get(plan_header)
-            if food_key and food_key in food_item:
-                return food_item[food_key]
-            
-            return "0"
-
-        # Recalculate the entire row
-        updated_row_values = []
-        for i, col_name in enumerate(headers):
-            if col_name == 'Name':
-                updated_row_values.append(base_food_item.get('Name', ''))
-            elif col_name == 'Amount':
-                updated_row_values.append(f"{new_amount:.2f}")
-            else:
-                base_value = get_food_value(col_name, base_food_item)
+        # We only care about edits in the 'Name' and 'Amount' columns; anything else is redrawn from the model
+        commands = []
+        positions = sorted({position for position, _ in edits})
+        for (position, col_index), row_index in edits.items():
+            row_id = model.row_id_at(position)
+            new_value = self.sheet.get_cell_data(row_index, col_index)
+            if headers[col_index] == 'Name':
+                model.rename(row_id, "" if new_value is None else str(new_value))
+            elif headers[col_index] == 'Amount':
                 try:
-                    # Since our food items are already per serving (Amount=1), multiply directly by new amount
-                    calculated_value = float(base_value) * new_amount
-                    updated_row_values.append(f"{calculated_value:.2f}")
-                except (ValueError, TypeError):
-                    updated_row_values.append("0.00")
-        
-        # Update the row in the sheet without triggering this callback again
-        self.sheet.set_row_data(row_index, values=updated_row_values, redraw=True)
-        
-        # Finally, update the summation
-        self.update_summation_row_tksheet()
+                    new_amount = float(new_value)
+                except (TypeError, ValueError):
+                    # Not a number: the row is rewritten with its old amount below
+                    continue
+                old_amount = model.set_amount(row_id, new_amount)
+                if old_amount != new_amount:
+                    commands.append(('amount', row_id, old_amount, new_amount))
+        if commands:
+            model.record(commands[0] if len(commands) == 1 else ('batch', commands))
+
+        self.refresh_plan_rows(positions)
+        self.autosave_plan_rows(positions)
+
+    def autosave_plan_rows(self, positions):
+        """Save changed food rows: just those rows in SQLite, the whole plan CSV otherwise."""
+        if not positions or not (hasattr(self, '_current_plan') and 'filepath' in self._current_plan):
+            return
+        if self.db:
+            headers = self.sheet.headers()
+            self.save_plan_rows(self.db.update_plan_rows, headers,
+                                [(position + 1, self.model_row(position, headers)) for position in positions])
+        else:
+            self.save_plan_data(self._current_plan['filepath'])
+
+    def save_plan_rows(self, write, *args):
+        """Run a SQLite row write of the open plan on the I/O thread, after the writes queued before it."""
+        self.io.submit(write, self._current_plan['Name'], *args,
+                       errback=lambda e: messagebox.showerror("Error", f"Failed to save plan: {e}", parent=self))
+
+    def set_row_amount(self, position, new_amount, record=True):
+        """Rescale a food row to a new amount and update the summation incrementally."""
+        if not 0 <= position < len(self.plan_model):
+            return
+        row_id = self.plan_model.row_id_at(position)
+        old_amount = self.plan_model.set_amount(row_id, new_amount)
+        if record:
+            self.plan_model.record(('amount', row_id, old_amount, new_amount))
+        self.refresh_plan_rows([position])
         
         # Auto-save after amount edit
-        if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
-            self.save_plan_data(self._current_plan['filepath'])
+        self.autosave_plan_rows([position])
 
     def delete_selected_food_from_sheet(self):
         """Delete the currently selected row from the spreadsheet (if it's a food item)."""
@@ -1067,103 +4186,402 @@ class App(tk.Tk):
                 return
             
             # Get the food item name for confirmation
-            selected_row = food_item_rows[0]  # Take the first selected food item row
-            row_data = self.sheet.get_row_data(selected_row)
-            food_name = row_data[0] if row_data else "Unknown"
+            position = self.page_start + min(food_item_rows) - 2  # Take the first selected food item row
+            food_item = self.plan_model.food_item(self.plan_model.row_id_at(position))
+            food_name = food_item.get('Name', "Unknown")
             
             # Confirm deletion
             result = messagebox.askyesno("Delete Food Item", 
                                        f"Are you sure you want to remove '{food_name}' from this plan?")
             if result:
-                # Delete the row
-                self.sheet.delete_row(selected_row)
-                
-                # Remove from our base data tracking
-                if hasattr(self, 'sheet_base_data') and selected_row in self.sheet_base_data:
-                    del self.sheet_base_data[selected_row]
-                
-                # Update row indices in base data (shift down after deletion)
-                if hasattr(self, 'sheet_base_data'):
-                    new_base_data = {}
-                    for row_idx, data in self.sheet_base_data.items():
-                        if row_idx > selected_row:
-                            new_base_data[row_idx - 1] = data
-                        else:
-                            new_base_data[row_idx] = data
-                    self.sheet_base_data = new_base_data
-                
-                # Update summation and row headers
-                self.update_summation_row_tksheet()
-                self.update_row_headers()
-                
-                # Auto-save after deletion
-                if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
-                    self.save_plan_data(self._current_plan['filepath'])
+                self.remove_food_row(position)
                 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to delete food item: {e}")
 
-    def update_summation_row_tksheet(self):
-        """Calculates and updates the 'Summation' row in the tksheet."""
-        headers = self.sheet.headers()
-        total_rows = self.sheet.get_total_rows()
+    def remove_food_row(self, position, record=True):
+        """Remove a food row from the plan model and the sheet, then autosave."""
+        # Drop the row from the plan model; other rows keep their IDs
+        row_id = self.plan_model.row_id_at(position)
+        position, food_item, amount = self.plan_model.remove_row(row_id)
+        if record:
+            self.plan_model.record(('delete', row_id, position, food_item, amount))
         
-        if total_rows <= 2: # Only special rows exist
-            return
-            
-        summation_values = [""] * len(headers)  # Start with empty strings
+        # Re-render the page (renumbering its rows) and the summation
+        self.render_plan_page()
         
-        # Get all food item data (rows from index 2 onwards)
-        try:
-            all_data = self.sheet.get_sheet_data()
-            food_item_data = all_data[2:] if len(all_data) > 2 else []
-        except:
-            # Fallback: get data row by row if get_sheet_data fails
-            food_item_data = []
-            for row_idx in range(2, total_rows):
-                try:
-                    row_data = self.sheet.get_row_data(row_idx)
-                    if row_data:
-                        food_item_data.append(row_data)
-                except:
-                    continue
-
-        for col_idx, col_name in enumerate(headers):
-            if col_name == 'Name':
-                summation_values[col_idx] = ""  # Keep Name blank in summation
-            elif col_name == 'Amount':
-                # Sum all amounts
-                total_amount = 0.0
-                for row in food_item_data:
-                    if row and len(row) > col_idx and row[col_idx]:
-                        try:
-                            total_amount += float(row[col_idx])
-                        except (ValueError, TypeError):
-                            pass
-                summation_values[col_idx] = f"{total_amount:.2f}" if total_amount > 0 else ""
+        # Auto-save after deletion
+        if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
+            if self.db:
+                self.save_plan_rows(self.db.delete_plan_row, position + 1)
             else:
-                # Sum all other nutrient values
-                total = 0.0
-                for row in food_item_data:
-                    if row and len(row) > col_idx and row[col_idx]:
-                        try:
-                            total += float(row[col_idx])
-                        except (ValueError, TypeError):
-                            pass
-                summation_values[col_idx] = f"{total:.2f}" if total > 0 else ""
-
-        # Update the summation row (index 1)
-        self.sheet.set_row_data(1, values=summation_values, redraw=True)
-        
-        # Update color coding after summation changes
-        self.apply_color_coding()
+                self.save_plan_data(self._current_plan['filepath'])
+
+    def undo_plan_edit(self, event=None):
+        """Undo the last add, delete or amount change on the open plan."""
+        if getattr(self, 'plan_model', None) is not None:
+            command = self.plan_model.pop_undo()
+            if command:
+                self.apply_plan_command(command, reverse=True)
+        return "break"
+
+    def redo_plan_edit(self, event=None):
+        """Redo the last undone edit on the open plan."""
+        if getattr(self, 'plan_model', None) is not None:
+            command = self.plan_model.pop_redo()
+            if command:
+                self.apply_plan_command(command, reverse=False)
+        return "break"
+
+    def apply_plan_command(self, command, reverse):
+        """Apply a logged command (or its inverse) through the same incremental paths as live edits."""
+        kind = command[0]
+        if kind == 'batch' and all(sub_command[0] == 'amount' for sub_command in command[1]):
+            # Amount batches (a paste, an optimizer run) are redrawn and saved once
+            model = self.plan_model
+            for _, row_id, old_amount, new_amount in command[1]:
+                model.set_amount(row_id, old_amount if reverse else new_amount)
+            positions = sorted(model.position(sub_command[1]) for sub_command in command[1])
+            self.refresh_plan_rows(positions)
+            self.autosave_plan_rows(positions)
+        elif kind == 'batch':
+            # Batches with adds or deletes (a multi-add, an optimizer run) change the model
+            # first, then are redrawn and saved once
+            headers = self.sheet.headers()
+            nutrient_headers = [headers[i] for i in self.plan_nutrient_cols]
+            for sub_command in (reversed(command[1]) if reverse else command[1]):
+                self.apply_model_command(sub_command, reverse, nutrient_headers)
+            self.render_plan_page()
+            if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
+                self.save_plan_data(self._current_plan['filepath'])
+        elif kind == 'amount':
+            _, row_id, old_amount, new_amount = command
+            self.set_row_amount(self.plan_model.position(row_id),
+                                old_amount if reverse else new_amount, record=False)
+        elif (kind == 'add') != reverse:
+            _, row_id, position, food_item, amount = command
+            self.add_food_item_to_tksheet(food_item, amount, position=position, record=False, row_id=row_id)
+        else:
+            self.remove_food_row(self.plan_model.position(command[1]), record=False)
+
+    def apply_model_command(self, command, reverse, nutrient_headers):
+        """Apply a logged command (or its inverse) to the plan model only, leaving the sheet and file alone."""
+        model = self.plan_model
+        kind = command[0]
+        if kind == 'batch':
+            for sub_command in (reversed(command[1]) if reverse else command[1]):
+                self.apply_model_command(sub_command, reverse, nutrient_headers)
+        elif kind == 'amount':
+            _, row_id, old_amount, new_amount = command
+            model.set_amount(row_id, old_amount if reverse else new_amount)
+        elif (kind == 'add') != reverse:
+            _, row_id, position, food_item, amount = command
+            model.add_row(food_item, food_matrix([food_item], nutrient_headers)[0], amount,
+                          position=position, row_id=row_id)
+        else:
+            model.remove_row(command[1])
+
+    def optimize_plan_servings(self):
+        """Solve serving amounts so the Summation row meets the Recommended targets."""
+        headers = self.sheet.headers()
+        if 'Amount' not in headers:
+            return
+        nutrient_cols = self.plan_nutrient_cols
+        nutrient_headers = [headers[i] for i in nutrient_cols]
+
+        include_db = messagebox.askyesnocancel(
+            "Optimize Servings",
+            f"Also try the {OPTIMIZER_CANDIDATES} foods from the food database that best fill the "
+            "plan's gaps (as in Suggest Foods)?\n\n"
+            "Yes: plan foods and those suggestions\nNo: only foods already in the plan",
+            parent=self)
+        if include_db is None:
+            return
+        max_servings = simpledialog.askfloat("Optimize Servings", "Maximum servings per food:",
+                                             initialvalue=5.0, minvalue=0.1, maxvalue=100.0, parent=self)
+        if max_servings is None:
+            return
+
+        model = self.plan_model
+        plan_count = len(model)
+        recommended = self.sheet.get_row_data(0)
+        targets = pd.to_numeric(pd.Series([recommended[i] for i in nutrient_cols]), errors='coerce').to_numpy(dtype=float)
+        modes = [self.nutrient_modes.get(header, 'irrelevant') for header in nutrient_headers]
+
+        candidates = []
+        if include_db:
+            plan_names = {str(model.food_item(row_id).get('Name', '')).strip().casefold() for row_id in model.order}
+            index = self.get_nutrient_index(nutrient_headers)
+            order, _ = rank_gap_fillers(index.matrix, targets, model.totals, modes,
+                                        top_k=OPTIMIZER_CANDIDATES + len(plan_names))
+            candidates = [index.food_items[k] for k in order.tolist()
+                          if index.food_items[k].get('Name', '').strip().casefold() not in plan_names]
+            candidates = candidates[:OPTIMIZER_CANDIDATES]
+        if not plan_count and not candidates:
+            messagebox.showwarning("Optimize Servings", "There are no foods to optimize.", parent=self)
+            return
+
+        matrix = np.vstack([model.matrix(), food_matrix(candidates, nutrient_headers)])
+        initial = np.concatenate([model.amounts(), np.zeros(len(candidates))])
+        # Foods already in the plan are free; candidates pay per serving, so only useful ones are picked
+        cost = np.concatenate([np.zeros(plan_count), np.full(len(candidates), OPTIMIZER_FOOD_COST)])
+
+        servings = optimize_servings(matrix, targets, modes, 0.0, max_servings, initial=initial, food_cost=cost)
+        # Drop candidates below the minimum and re-solve, so the kept foods take up their share
+        keep = np.concatenate([np.ones(plan_count, dtype=bool), servings[plan_count:] >= OPTIMIZER_MIN_SERVINGS])
+        if not keep.all():
+            servings = optimize_servings(matrix, targets, modes, 0.0, np.where(keep, max_servings, 0.0),
+                                         initial=servings * keep, food_cost=cost)
+        servings = np.round(servings, 2)
+
+        # Rescale existing rows in place, then append candidates the solver picked; the whole
+        # run is logged as one batch so a single undo restores the previous amounts
+        commands = []
+        for position, row_id in enumerate(list(model.order)):
+            new_amount = float(servings[position])
+            old_amount = model.set_amount(row_id, new_amount)
+            commands.append(('amount', row_id, old_amount, new_amount))
+        picked = [(food_item, float(servings[k]))
+                  for k, food_item in enumerate(candidates, start=plan_count)
+                  if servings[k] >= OPTIMIZER_MIN_SERVINGS]
+        for position, (row_id, (food_item, amount)) in enumerate(
+                zip(self.add_food_items_to_tksheet(picked, record=False, autosave=False), picked),
+                start=plan_count):
+            commands.append(('add', row_id, position, food_item, amount))
+        model.record(('batch', commands))
+
+        # One render and one save (a single transaction with SQLite) for the whole run
+        self.render_plan_page()
+        if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
+            self.save_plan_data(self._current_plan['filepath'])
+
+    def get_nutrient_index(self, headers):
+        """Return the food store nutrient matrix for these headers, rebuilt only when the food items change."""
+        key = (self.food_data_stamp(), tuple(headers))
+        index = getattr(self, '_nutrient_index', None)
+        if index is None or index.key != key:
+            index = NutrientIndex(self.load_food_items(), headers, key=key)
+            self._nutrient_index = index
+        return index
+
+    def show_food_suggestions(self):
+        """Show foods whose single serving best closes the plan's red good-nutrient gaps."""
+        headers = self.sheet.headers()
+        nutrient_cols = [i for i, header in enumerate(headers) if header not in ('Name', 'Amount')]
+        nutrient_headers = [headers[i] for i in nutrient_cols]
+
+        all_data = self.sheet.get_sheet_data()
+        if len(all_data) < 2:
+            return
+        targets = pd.to_numeric(pd.Series([all_data[0][i] for i in nutrient_cols]), errors='coerce').to_numpy(dtype=float)
+        totals = self.plan_model.totals.copy()
+        modes = [self.nutrient_modes.get(header, 'irrelevant') for header in nutrient_headers]
+
+        index = self.get_nutrient_index(nutrient_headers)
+        order, scores = rank_gap_fillers(index.matrix, targets, totals, modes)
+
+        # Replace any previous suggestions panel, keeping the sheet in place
+        if getattr(self, 'suggestions_frame', None) is not None:
+            self.suggestions_frame.destroy()
+        panel = ttk.Frame(self.main_frame)
+        panel.pack(fill='x', pady=5, before=self.sheet_frame)
+        self.suggestions_frame = panel
+
+        gaps = [split_header_unit(header)[0] for header, target, total, mode
+                in zip(nutrient_headers, targets, totals, modes) if mode == 'good' and target > total]
+        summary = f"Suggestions for: {', '.join(gaps)}" if gaps else "No good-nutrient gaps to fill."
+        ttk.Label(panel, text=summary, wraplength=700).pack(anchor='w')
+
+        listbox = tk.Listbox(panel, height=min(max(len(order), 1), 8), font=('Helvetica', 11))
+        for food_idx, score in zip(order, scores):
+            listbox.insert(tk.END, f"{index.food_items[food_idx].get('Name', '')}  (closes {score:.2f} gaps per serving)")
+        listbox.pack(side='left', fill='x', expand=True)
 
-    def update_row_headers(self):
-        """Updates the row headers after adding/removing items."""
-        total_rows = self.sheet.get_total_rows()
-        food_item_count = total_rows - 2
-        row_headers = ["Recommended", "Summation"] + [f"Item {i+1}" for i in range(food_item_count)]
-        self.sheet.row_index(row_headers, redraw=True)
+        def on_add():
+            selected = listbox.curselection()
+            if not selected:
+                return
+            self.add_food_item_to_tksheet(index.food_items[order[selected[0]]], 1.0)
+            self.show_food_suggestions()
+
+        def on_close():
+            panel.destroy()
+            self.suggestions_frame = None
+
+        listbox.bind("<Double-Button-1>", lambda event: on_add())
+        ttk.Button(panel, text="Add 1 Serving", command=on_add).pack(side='left', padx=(10, 0))
+        ttk.Button(panel, text="Close", command=on_close).pack(side='left', padx=(10, 0))
+
+    # Most variant columns shown in the diff view; variants are ranked by red cells
+    SCENARIO_VIEW_LIMIT = 50
+
+    def show_scenarios(self):
+        """Show the what-if panel: build variants of the open plan and compare them side by side.
+
+        Variants are taken from the plan as it is when the panel opens (or on
+        Reset); the plan itself is never changed.
+        """
+        if self.scenarios_frame is not None:
+            self.scenarios_frame.destroy()
+        panel = ttk.Frame(self.main_frame)
+        panel.pack(fill='x', pady=5, before=self.sheet_frame)
+        self.scenarios_frame = panel
+        self.plan_scenarios = self.plan_model.scenarios()
+
+        headers = self.sheet.headers()
+        index = self.get_nutrient_index([headers[i] for i in self.plan_nutrient_cols])
+        food_names = [food_item.get('Name', '') for food_item in index.food_items]
+
+        controls = ttk.Frame(panel)
+        controls.pack(fill='x')
+        food_var = tk.StringVar()
+
+        def selected_position():
+            rows = [row for row in self.sheet.get_selected_rows() if row >= 2]
+            if not rows:
+                messagebox.showwarning("No Selection", "Please select a food item row in the plan.", parent=self)
+                return None
+            return self.page_start + min(rows) - 2
+
+        def on_scale():
+            factor = simpledialog.askfloat("What-If", "Multiply all servings by:", initialvalue=0.9,
+                                           minvalue=0.0, parent=self)
+            if factor is not None:
+                self.plan_scenarios.scale(factor)
+                self.refresh_scenario_view()
+
+        def on_swap():
+            position = selected_position()
+            if position is None:
+                return
+            if food_var.get() not in food_names:
+                messagebox.showwarning("No Food", "Choose a food to swap in.", parent=self)
+                return
+            food_idx = food_names.index(food_var.get())
+            self.plan_scenarios.swap(position, [food_names[food_idx]], index.matrix[food_idx])
+            self.refresh_scenario_view()
+
+        def on_swap_all():
+            position = selected_position()
+            if position is not None:
+                self.plan_scenarios.swap(position, food_names, index.matrix)
+                self.refresh_scenario_view()
+
+        def on_reset():
+            self.plan_scenarios = self.plan_model.scenarios()
+            self.refresh_scenario_view()
+
+        def on_close():
+            panel.destroy()
+            self.scenarios_frame = None
+            self.plan_scenarios = None
+
+        ttk.Button(controls, text="Scale Servings...", command=on_scale).pack(side='left')
+        ttk.Combobox(controls, textvariable=food_var, values=sorted(food_names),
+                     width=30).pack(side='left', padx=(10, 5))
+        ttk.Button(controls, text="Swap Selected Row", command=on_swap).pack(side='left')
+        ttk.Button(controls, text="Swap With Every Food", command=on_swap_all).pack(side='left', padx=(5, 0))
+        ttk.Button(controls, text="Reset", command=on_reset).pack(side='left', padx=(10, 0))
+        ttk.Button(controls, text="Close", command=on_close).pack(side='left', padx=(10, 0))
+        self.scenario_summary = ttk.Label(panel)
+        self.scenario_summary.pack(anchor='w')
+
+        self.scenario_sheet = Sheet(panel, height=260, show_top_left=False, show_x_scrollbar=True,
+                                    show_y_scrollbar=True)
+        self.scenario_sheet.pack(fill='x', expand=True)
+        self.scenario_sheet.enable_bindings("single_select", "column_width_resize", "copy")
+        self.refresh_scenario_view()
+
+    def refresh_scenario_view(self):
+        """Evaluate all variants at once and show Target, Current and the best variants as differences."""
+        headers = self.sheet.headers()
+        nutrient_headers = [headers[i] for i in self.plan_nutrient_cols]
+        recommended = self.sheet.get_row_data(0)
+        targets = np.array([recommended[i] if isinstance(recommended[i], (int, float)) else np.nan
+                            for i in self.plan_nutrient_cols], dtype=float)
+        modes = [self.nutrient_modes.get(header, 'irrelevant') for header in nutrient_headers]
+        totals, diffs, status = self.plan_scenarios.evaluate(targets, modes)
+
+        # Fewest red cells first, then most green; the current plan always comes first
+        reds, greens = (status == -1).sum(axis=1), (status == 1).sum(axis=1)
+        order = [0] + [v for v in np.lexsort((-greens, reds)).tolist() if v != 0][:self.SCENARIO_VIEW_LIMIT]
+        self.scenario_summary.config(
+            text=f"{len(self.plan_scenarios)} variants; red cells: current {reds[0]}, best {reds[order[1:]].min()}"
+                 if len(order) > 1 else "Add variants to compare them with the current plan.")
+
+        data = [[format_plan_number(target), format_plan_number(totals[0, n])]
+                + [f"{diffs[v, n]:+.2f}" if diffs[v, n] else "" for v in order[1:]]
+                for n, target in enumerate(targets)]
+        sheet = self.scenario_sheet
+        sheet.dehighlight_all(redraw=False)
+        sheet.set_sheet_data(data, reset_col_positions=True, redraw=False)
+        sheet.headers(["Target", self.plan_scenarios.names[0]] + [self.plan_scenarios.names[v] for v in order[1:]],
+                      redraw=False)
+        sheet.row_index([split_header_unit(header)[0] for header in nutrient_headers], redraw=False)
+        for code, color in ((-1, STATUS_COLORS['red']), (1, STATUS_COLORS['green'])):
+            cells = [(n, col + 1) for col, v in enumerate(order) for n in np.flatnonzero(status[v] == code).tolist()]
+            if cells:
+                sheet.highlight_cells(cells=cells, bg=color, redraw=False)
+        sheet.redraw()
+
+    def show_profile_targets(self):
+        """Show an inline panel that fills the Recommended row from a client profile."""
+        if self.profile_frame is not None:
+            self.profile_frame.destroy()
+        panel = ttk.Frame(self.main_frame)
+        panel.pack(fill='x', pady=5, before=self.sheet_frame)
+        self.profile_frame = panel
+
+        sex_var = tk.StringVar(value="female")
+        age_var = tk.StringVar()
+        weight_var = tk.StringVar()
+        activity_var = tk.StringVar(value="sedentary")
+        ttk.Label(panel, text="Sex:").pack(side='left')
+        ttk.Combobox(panel, textvariable=sex_var, values=("female", "male"), state='readonly',
+                     width=8).pack(side='left', padx=(5, 10))
+        ttk.Label(panel, text="Age:").pack(side='left')
+        age_entry = ttk.Entry(panel, textvariable=age_var, width=5)
+        age_entry.pack(side='left', padx=(5, 10))
+        ttk.Label(panel, text="Weight (kg):").pack(side='left')
+        ttk.Entry(panel, textvariable=weight_var, width=6).pack(side='left', padx=(5, 10))
+        ttk.Label(panel, text="Activity:").pack(side='left')
+        ttk.Combobox(panel, textvariable=activity_var, values=tuple(ACTIVITY_LEVELS),
+                     width=11).pack(side='left', padx=(5, 10))
+
+        def on_apply():
+            try:
+                profile = make_profile(sex_var.get(), age_var.get(), weight_var.get(), activity_var.get())
+            except (TypeError, ValueError):
+                messagebox.showerror("Invalid Profile", "Enter a positive age, weight and activity level.",
+                                     parent=self)
+                return
+            self.apply_profile_targets(profile)
+
+        def on_close():
+            panel.destroy()
+            self.profile_frame = None
+
+        ttk.Button(panel, text="Apply", command=on_apply).pack(side='left')
+        ttk.Button(panel, text="Close", command=on_close).pack(side='left', padx=(10, 0))
+        self.after_idle(age_entry.focus_set)
+
+    def apply_profile_targets(self, profile):
+        """Overwrite the Recommended row with a profile's targets; nutrients without a rule keep their value."""
+        try:
+            targets = profile_targets(profile)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not load target rules: {e}", parent=self)
+            return
+        headers = self.sheet.headers()
+        plan_cols, target_idx, factors = target_columns(tuple(headers))
+        recommended = list(self.sheet.get_row_data(0))
+        for col, value in zip(plan_cols.tolist(), (targets[target_idx] / factors).tolist()):
+            if value == value:
+                recommended[col] = value
+        self.sheet.set_row_data(0, values=recommended, redraw=True)
+        self.write_summation_row()
+        if hasattr(self, '_current_plan') and 'filepath' in self._current_plan:
+            self.save_plan_data(self._current_plan['filepath'])
 
     # Old spreadsheet functions removed - replaced with tksheet implementation
 
@@ -1227,11 +4645,26 @@ class App(tk.Tk):
             messagebox.showerror("Error", "Name is required")
             return
         
-        # Add to food items list
+        # Save to the database (which keeps names unique and skips a name it already has) in the background
+        if self.db:
+            def on_added(count):
+                if not count:
+                    messagebox.showwarning("Duplicate Food Item",
+                                           f"A food item named '{food_item['Name']}' already exists. Nothing was saved.")
+                    return
+                self.food_items = self.food_items + [food_item]
+                self.food_generation += 1
+                messagebox.showinfo("Success", "Food item saved successfully!")
+                self.show_food_items()
+
+            self.io.submit(self.db.add_food_items, [food_item], callback=on_added,
+                           errback=lambda e: messagebox.showerror("Error", f"Failed to save food item: {e}"),
+                           status="Saving food item...")
+            return
+
+        # Add to food items list and save to CSV file
         self.food_items.append(food_item)
-        
-        # Save to CSV file
-        self.save_food_items_to_csv()
+        self.save_food_items_to_csv(self.food_items)
         
         # Show success message
         messagebox.showinfo("Success", "Food item saved successfully!")
@@ -1239,34 +4672,6 @@ class App(tk.Tk):
         # Go back to food items list
         self.show_food_items()
 
-    def save_food_items_to_csv(self):
-        """Save all food items to CSV file"""
-        if not self.food_items:
-            return
-        
-        # Define the field names (columns)
-        fieldnames = [
-            "Name", "Amount", "Calories / Energy", "Protein", "Total Fat",
-            "Saturated Fat", "Monounsaturated Fat", "Polyunsaturated Fat",
-            "Trans Fat", "Cholesterol", "Carbohydrates", "Dietary Fiber",
-            "Soluble Fiber", "Insoluble Fiber", "Total Sugars", "Added Sugars",
-            "Sodium", "Potassium", "Calcium", "Iron", "Magnesium", "Zinc",
-            "Phosphorus", "Iodine", "Vitamin A", "Vitamin C", "Vitamin D",
-            "Vitamin E", "Vitamin K", "Vitamin B1 (Thiamine)", 
-            "Vitamin B2 (Riboflavin)", "Vitamin B3 (Niacin)", "Vitamin B6",
-            "Vitamin B9 (Folate)", "Vitamin B12", "Omega-3 Fatty Acids",
-            "Omega-6 Fatty Acids"
-        ]
-        
-        try:
-            with open(self.csv_file, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for item in self.food_items:
-                    writer.writerow(item)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save to CSV: {str(e)}")
-
     def delete_selected_food_item(self):
         """Delete the selected food item from the list."""
         selected_items = self.food_tree.selection()
@@ -1287,16 +4692,18 @@ class App(tk.Tk):
                 # Remove from the tree view
                 self.food_tree.delete(selected_item)
                 
-                # Update the CSV file by rewriting it with remaining items
-                remaining_items = []
-                for item_id in self.food_tree.get_children():
-                    values = self.food_tree.item(item_id, 'values')
-                    # Create a dictionary from the values
-                    item_dict = dict(zip(self.display_columns, values))
-                    remaining_items.append(item_dict)
-                
-                # Save the updated list
-                self.save_food_items_to_csv(remaining_items)
+                # Drop it from the full items, so columns hidden from the list are kept in the CSV
+                items = self.load_food_items()
+                index = next((i for i, item in enumerate(items) if item.get('Name') == food_name), None)
+                if self.db:
+                    if index is not None:
+                        self.food_items = items[:index] + items[index + 1:]
+                        self.food_generation += 1
+                    self.io.submit(self.db.delete_food_item, food_name,
+                                   errback=lambda e: messagebox.showerror("Error", f"Failed to delete food item: {e}"),
+                                   status=f"Deleting {food_name}...")
+                elif index is not None:
+                    self.save_food_items_to_csv(items[:index] + items[index + 1:])
                 
                 messagebox.showinfo("Success", f"Food item '{food_name}' has been deleted.")
                 
@@ -1304,63 +4711,220 @@ class App(tk.Tk):
                 messagebox.showerror("Error", f"Failed to delete food item: {e}")
 
     def save_food_items_to_csv(self, items):
-        """Save the food items list to CSV file."""
+        """Save the food items list to CSV file.
+
+        The items are the food items in memory from now on; the CSV text is
+        rendered here and written on the I/O thread.
+        """
+        unit_of = nutrient_schema().unit_of
         try:
-            with open(self.csv_file, mode='w', newline='', encoding='utf-8') as file:
-                if items:
-                    # Write header
-                    fieldnames = list(items[0].keys())
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    writer.writeheader()
-                    
-                    # Write units row
-                    units_row = {}
-                    for field in fieldnames:
-                        if field == 'Name':
-                            units_row[field] = ''
-                        elif field == 'Amount':
-                            units_row[field] = 'g'
-                        else:
-                            # Find the unit for this field from NUTRIENT_FIELDS
-                            unit = ''
-                            for nutrient_name, nutrient_unit in NUTRIENT_FIELDS:
-                                if field == nutrient_name:
-                                    unit = nutrient_unit
-                                    break
-                            units_row[field] = unit
-                    writer.writerow(units_row)
-                    
-                    # Write data rows
-                    writer.writerows(items)
-                else:
-                    # If no items, just write headers and units
-                    fieldnames = [field[0] for field in NUTRIENT_FIELDS]
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    writer.writeheader()
-                    
-                    # Write units row
-                    units_row = {field[0]: field[1] for field in NUTRIENT_FIELDS}
-                    writer.writerow(units_row)
-                    
+            file = io.StringIO()
+            # Keep every column the items have, in file header order (new ones last);
+            # an empty store gets the schema columns
+            fieldnames = (list(dict.fromkeys(key for item in items for key in item if key is not None))
+                          or list(nutrient_schema().food_fields))
+            writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+
+            # Write units row
+            writer.writerow({field: '' if field == 'Name' else unit_of.get(field, '') for field in fieldnames})
+
+            # Write data rows
+            writer.writerows(items)
+
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save food items: {e}")
+            return
+
+        self.food_items = items
+        self.food_generation += 1
+        # Like plan saves, a save while one is being written only keeps the newest text
+        if self.csv_file in self.pending_food_saves:
+            self.pending_food_saves[self.csv_file] = file.getvalue()
+            return
+        self.write_food_items(file.getvalue(), self._food_file_stamp)
+
+    def write_food_items(self, csv_text, stamp):
+        """Write the food CSV text in the background unless the file changed since stamp."""
+        self.pending_food_saves[self.csv_file] = None
+
+        def on_written(result):
+            newer = self.pending_food_saves.pop(self.csv_file, None)
+            saved, disk_stamp = result
+            if not saved:
+                self.resolve_food_conflict(csv_text if newer is None else newer, disk_stamp)
+                return
+            self._food_file_stamp = disk_stamp
+            if newer is not None:
+                self.write_food_items(newer, disk_stamp)
+
+        def on_error(e):
+            self.pending_food_saves.pop(self.csv_file, None)
+            messagebox.showerror("Error", f"Failed to save food items: {e}")
+            self.reload_food_items()  # Show what the file still holds
+
+        self.io.submit(self.write_food_csv, csv_text, stamp, callback=on_written, errback=on_error,
+                       status="Saving food items...")
+
+    def resolve_food_conflict(self, csv_text, disk_stamp):
+        """Ask whether to overwrite food items saved elsewhere since we read them, or load those."""
+        keep_ours = messagebox.askyesno(
+            "Food Items Changed Elsewhere",
+            "The food items were saved from another place since they were loaded.\n\n"
+            "Yes: overwrite them with your version\nNo: discard your last change and load the saved version",
+            parent=self)
+        if keep_ours:
+            self.write_food_items(csv_text, disk_stamp)
+        else:
+            self.reload_food_items()
+
+    def write_food_csv(self, csv_text, stamp):
+        """Replace the food CSV's contents unless it changed since stamp; runs on the I/O thread.
+
+        Returns (True, new stamp), or (False, stamp on disk) on a conflict.
+        """
+        with file_lock(self.csv_file):
+            disk_stamp = None
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(self.csv_file)
+                disk_stamp = (stat.st_mtime_ns, stat.st_size)
+            if disk_stamp != stamp:
+                return False, disk_stamp
+            with open(self.csv_file, mode='w', newline='', encoding='utf-8') as file:
+                file.write(csv_text)
+            stat = os.stat(self.csv_file)
+        return True, (stat.st_mtime_ns, stat.st_size)
 
     def load_food_items(self):
-        """Load food items from the CSV file, ensuring it always returns a list."""
-        if not os.path.exists(self.csv_file):
-            return []  # Return an empty list if the file doesn't exist
+        """Return the food items, always as a list.
+
+        These are the items in memory, kept current by reload_food_items and the
+        food saves, so neither the CSV nor the database is read here.
+        """
+        if self._initial_food_load is not None:
+            # Before the start-up read arrives the store would look empty, so wait for it once
+            self.io.wait(self._initial_food_load)
+            self._initial_food_load = None
+        return self.food_items
+
+    def read_food_store(self):
+        """Read the food store as (food items, file stamp); runs on the I/O thread.
+
+        The database has no file stamp, since it is not polled for changes.
+        """
+        if self.db:
+            return self.db.load_food_items(), None
+        try:
+            stat = os.stat(self.csv_file)
+        except FileNotFoundError:
+            return [], None  # An empty list if the file doesn't exist
+        return read_food_items(self.csv_file), (stat.st_mtime_ns, stat.st_size)
+
+    def reload_food_items(self, stamp=None):
+        """Re-read the food store in the background and refresh the food list when it arrives.
+
+        stamp is the file stamp that prompted the reload; a failed read is not
+        retried until the file changes again. Returns the read's future.
+        """
+        generation = self.food_generation
+
+        def on_read(result):
+            # Items saved here meanwhile are newer than the file that was read
+            if self.food_generation != generation:
+                return
+            self.food_items, self._food_file_stamp = result
+            self.food_generation += 1
+            food_view = self.views.get('food_items')
+            if food_view is not None and food_view.winfo_manager():
+                self.refresh_food_list_if_stale()
+
+        def on_error(e):
+            self._food_file_stamp = stamp
+            messagebox.showerror("Error", f"An error occurred while loading food items: {e}")
+
+        return self.io.submit(self.read_food_store, callback=on_read, errback=on_error,
+                              status="Loading food items...")
+
+    def import_food_items(self):
+        """Bulk import food items from an external CSV/TSV composition table."""
+        source_path = filedialog.askopenfilename(
+            title="Import Food Composition Table",
+            filetypes=[("CSV/TSV files", "*.csv *.tsv *.txt"), ("All files", "*.*")],
+            parent=self)
+        if not source_path:
+            return
 
+        basis_amount = simpledialog.askfloat("Import", "Source values are given per how many grams?",
+                                             initialvalue=100.0, minvalue=0.1, parent=self)
+        if basis_amount is None:
+            return
+
+        # Offer to map the columns that match no food store field by name
         try:
-            with open(self.csv_file, mode='r', newline='', encoding='utf-8') as file:
-                # Use DictReader to read the file directly
-                dict_reader = csv.DictReader(file)
-                return list(dict_reader)
+            with open(source_path, mode='r', newline='', encoding='utf-8-sig') as source:
+                header = next(csv.reader(source, delimiter=detect_delimiter(source, source_path)), [])
         except Exception as e:
-            messagebox.showerror("Error", f"An error occurred while loading food items: {e}")
-            return []
+            messagebox.showerror("Error", f"Failed to import food items: {e}")
+            return
+        column_map = {}
+        unmatched = resolve_import_columns(header)[3]
+        if unmatched:
+            answer = simpledialog.askstring(
+                "Import",
+                f"These columns match no food field and will be skipped:\n{', '.join(unmatched)}\n\n"
+                "To import some of them, enter Column = Field pairs separated by semicolons:", parent=self)
+            if answer is None:
+                return
+            field_lookup = {name.casefold(): name for name in nutrient_schema().food_fields}
+            for pair in filter(None, (part.strip() for part in answer.split(";"))):
+                column, _, field = (text.strip() for text in pair.rpartition("="))
+                if not column or field.casefold() not in field_lookup:
+                    messagebox.showerror("Error", f"Not a Column = Field pair with a known field: {pair}")
+                    return
+                column_map[column] = field_lookup[field.casefold()]
+
+        # Show progress in the status bar while the file streams in
+        progress = [0, 0]
+
+        def import_status():
+            return f"Importing... {progress[0]} rows read, {progress[1]} imported"
+
+        def on_progress(rows_read, rows_imported):
+            progress[:] = rows_read, rows_imported
+            if self.io.inline:
+                # An inline import holds the Tk thread, so draw the progress right away
+                self.status_label.config(text=import_status())
+                self.update_idletasks()
+
+        def on_imported(stats):
+            self.status_label.config(text="")
+            self.reload_food_items()
+            ignored = f"\n\nColumns not imported: {', '.join(stats['ignored'])}" if stats['ignored'] else ""
+            messagebox.showinfo("Import Complete",
+                                f"Imported {stats['imported']} food items "
+                                f"({stats['duplicates']} duplicates and {stats['skipped']} unnamed rows skipped)."
+                                + ignored)
+
+        def on_error(e):
+            self.status_label.config(text="")
+            messagebox.showerror("Error", f"Failed to import food items: {e}")
+
+        self.io.submit(functools.partial(import_food_table, column_map=column_map, basis_amount=basis_amount,
+                                         progress_callback=on_progress),
+                       source_path, self.db or self.csv_file, callback=on_imported, errback=on_error,
+                       status=import_status)
+
+    def food_data_stamp(self):
+        """Cheap fingerprint of the food items, used to skip rebuilding unchanged lists."""
+        return self.food_generation
+
+    def refresh_food_list_if_stale(self):
+        if self.food_data_stamp() != self._food_list_stamp:
+            self.refresh_food_list()
 
     def refresh_food_list(self):
-        # Reload food items from CSV
+        # Show the current food items (see load_food_items)
+        self._food_list_stamp = self.food_data_stamp()
         self.food_items = self.load_food_items()
         
         # Clear existing items
@@ -1373,13 +4937,54 @@ class App(tk.Tk):
             self.food_tree.insert("", "end", values=values)
 
     def show_settings(self):
-        self.hide_menu()
-        self.clear_main_frame()
-        label = ttk.Label(self.main_frame, text="Settings Page")
+        self.show_view("settings", self._build_settings_view, self.refresh_cache_stats)
+
+    def _build_settings_view(self, frame):
+        label = ttk.Label(frame, text="Settings Page")
         label.pack()
-        back_button = ttk.Button(self.main_frame, text="Back", command=self.show_menu)
+
+        # Instrumentation: how often food rows are served from the shared row cache
+        stats_frame = ttk.LabelFrame(frame, text="Performance")
+        stats_frame.pack(pady=10, fill='x')
+        self.cache_stats_label = ttk.Label(stats_frame, justify='left')
+        self.cache_stats_label.pack(side='left', padx=10, pady=5)
+        ttk.Button(stats_frame, text="Clear Cache", command=lambda: (FOOD_ROWS.clear(), self.refresh_cache_stats())
+                   ).pack(side='right', padx=10, pady=5)
+        ttk.Button(stats_frame, text="Refresh", command=self.refresh_cache_stats).pack(side='right', pady=5)
+        self.refresh_cache_stats()
+
+        if self.db:
+            export_button = ttk.Button(frame, text="Export Database to CSV",
+                                       command=self.export_database)
+            export_button.pack(pady=10)
+        back_button = ttk.Button(frame, text="Back", command=self.show_menu)
         back_button.pack(pady=10)
 
+    def refresh_cache_stats(self):
+        stats = FOOD_ROWS.stats()
+        self.cache_stats_label.config(
+            text=f"Food row cache: {stats['hits']} hits, {stats['misses']} misses "
+                 f"({stats['hit_rate']:.0%} hit rate), {stats['size']} of {stats['maxsize']} rows cached")
+
+    def export_database(self):
+        """Write the SQLite database back out to the food CSV and plan CSV files in the background."""
+        self.io.submit(self.db.export_csv, self.csv_file, self.plans_dir,
+                       callback=lambda _: messagebox.showinfo(
+                           "Export Complete", f"Exported foods to {self.csv_file} and plans to {self.plans_dir}."),
+                       errback=lambda e: messagebox.showerror("Error", f"Failed to export database: {e}"),
+                       status="Exporting database...")
+
+    def on_close(self):
+        """Write any queued plan edits and pending saves, then close the window."""
+        self.status_label.config(text="Saving...")
+        self.update_idletasks()
+        if getattr(self, 'pending_edit_job', None) is not None:
+            self.flush_plan_edits()
+        # The newest frame of a coalesced plan save is only queued by its write's callback, which
+        # shutdown runs here since the Tk loop will not
+        self.io.shutdown()
+        self.destroy()
+
     def show_menu(self):
         # Hide the main content frame completely when showing menu
         self.main_frame.pack_forget()
@@ -1393,10 +4998,106 @@ class App(tk.Tk):
         # Restore the main content frame
         self.main_frame.pack(fill="both", expand=True, padx=20, pady=10)
 
+    def show_view(self, name, build, refresh=None):
+        """Show a cached screen, building it on first use.
+
+        Other cached screens are only hidden; revisiting one just calls refresh
+        so it can update its data. The least recently shown screen is destroyed
+        once more than VIEW_CACHE_LIMIT are kept.
+        """
+        self.hide_menu()
+        self.clear_main_frame()
+        frame = self.views.get(name)
+        if frame is None:
+            frame = ttk.Frame(self.main_frame)
+            build(frame)
+            self.views[name] = frame
+            while len(self.views) > VIEW_CACHE_LIMIT:
+                _, evicted = self.views.popitem(last=False)
+                evicted.destroy()
+        else:
+            self.views.move_to_end(name)
+            if refresh:
+                refresh()
+        frame.pack(fill="both", expand=True)
+
+    def when_current(self, show):
+        """Wrap the callback that shows a screen once its data is read in the background.
+
+        The screen is not shown if the user has moved to another one meanwhile.
+        """
+        request = self._screen_request = object()
+
+        def show_if_current(result):
+            if self._screen_request is request:
+                show(result)
+        return show_if_current
+
     def clear_main_frame(self):
+        """Hide cached screens and destroy everything else in the main frame."""
+        self._screen_request = None
+        cached = set(self.views.values())
         for widget in self.main_frame.winfo_children():
-            widget.destroy()
+            if widget in cached:
+                widget.pack_forget()
+            else:
+                widget.destroy()
 
 if __name__ == "__main__":
-    app = App()
-    app.mainloop()
+    parser = argparse.ArgumentParser(description="Gürgen Diet Tool")
+    parser.add_argument("--serve", action="store_true", help="run the local HTTP/JSON API instead of the GUI")
+    parser.add_argument("--host", default="127.0.0.1", help="address for --serve (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port for --serve (default: 8765)")
+    parser.add_argument("--generate-plans", metavar="ROSTER",
+                        help="create one plan per row of a roster CSV (name column plus optional nutrient targets)")
+    parser.add_argument("--template", help="plan template for --generate-plans (default: templates/plan_template.csv)")
+    parser.add_argument("--workers", type=int, help="writer threads for --generate-plans")
+    parser.add_argument("--overwrite", action="store_true", help="replace existing plans with --generate-plans")
+    parser.add_argument("--retarget", metavar="PROFILES",
+                        help="recompute Recommended targets from a CSV of plan names and client profiles")
+    parser.add_argument("--rules", help="target rules for profiles (default: data/target_rules.csv)")
+    parser.add_argument("--export", metavar="DIR",
+                        help="write the food database and all plans as long-format records into DIR")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl",
+                        help="file format for --export (parquet needs pyarrow)")
+    parser.add_argument("--full", action="store_true", help="re-export unchanged plans with --export")
+    parser.add_argument("--archive-older-than", type=float, metavar="DAYS",
+                        help="move plans not modified for DAYS days into plans/archive/")
+    args = parser.parse_args()
+    csv_file = os.path.join(get_base_path(), "data", "food_items.csv")
+    if args.generate_plans:
+        stats = generate_plans(args.generate_plans, "plans", template_path=args.template,
+                               store=open_configured_store(csv_file, "plans"), max_workers=args.workers,
+                               overwrite=args.overwrite, rules_path=args.rules,
+                               progress_callback=lambda done, total: print(f"{done}/{total} plans written"))
+        print(f"Created {stats['created']} plans ({stats['skipped']} skipped, {stats['failed']} failed) "
+              f"in {stats['seconds']:.2f}s, {stats['plans_per_second']:.0f} plans/s")
+    elif args.retarget:
+        stats = retarget_plans(args.retarget, "plans", store=open_configured_store(csv_file, "plans"),
+                               rules_path=args.rules, max_workers=args.workers)
+        print(f"Retargeted {stats['updated']} plans ({stats['missing']} missing, {stats['skipped']} without "
+              f"a valid profile, {stats['failed']} failed) in {stats['seconds']:.2f}s, "
+              f"{stats['plans_per_second']:.0f} plans/s")
+    elif args.export:
+        try:
+            stats = export_dataset(args.export, csv_file, "plans", store=open_configured_store(csv_file, "plans"),
+                                   fmt=args.format, full=args.full)
+        except RuntimeError as e:
+            sys.exit(f"Error: {e}")
+        print(f"Exported {stats['exported']} files ({stats['skipped']} unchanged, {stats['removed']} removed), "
+              f"{stats['records']} records in {stats['seconds']:.2f}s")
+    elif args.archive_older_than is not None:
+        if open_configured_store(csv_file, "plans") is not None:
+            # The database keeps no per-plan modification time to compare against
+            print("Warning: --archive-older-than needs CSV storage; archive plans from the Plans screen instead.")
+        else:
+            cutoff = time.time() - args.archive_older_than * 86400
+            names = sorted(os.path.splitext(name)[0] for name in os.listdir("plans")
+                           if name.endswith(".csv") and os.path.getmtime(os.path.join("plans", name)) < cutoff)
+            archived = archive_plans(names, "plans")
+            print(f"Archived {len(archived)} plans into {PlanArchive('plans').path}")
+    elif args.serve:
+        serve(args.host, args.port)
+    else:
+        app = App()
+        app.mainloop()